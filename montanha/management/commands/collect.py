@@ -15,12 +15,23 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import threading
+import traceback
+from multiprocessing import Process, Queue, RLock
+from Queue import Empty
+
+from cacheops import invalidate_model
 from django.conf import settings
 from django.core.management import call_command
-from django.core.management.base import BaseCommand
-from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.backends.utils import CursorWrapper
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
 
-from montanha.models import Mandate
+from collectors.registry import COLLECTORS, load_collector
+from montanha.models import ArchivedExpense, CollectionRun, Expense, PendingConsolidation
 
 
 # This hack makes django less memory hungry (it caches queries when running
@@ -29,109 +40,408 @@ settings.DEBUG = False
 
 debug_enabled = False
 
+# Number of archived expense ids copied by each insert when committing a run.
+COMMIT_CHUNK_SIZE = 50000
+
+# Number of ids in each statement of a diff commit, below SQLite's limit
+# of 999 parameters.
+DIFF_CHUNK_SIZE = 500
+
+# The columns copied from ArchivedExpense to Expense, which also tell
+# whether an expense changed between collections.
+EXPENSE_CONTENT_FIELDS = (
+    'number', 'nature_id', 'date', 'value', 'expensed', 'mandate_id', 'supplier_id'
+)
+
+COMMIT_MODES = ('replace', 'diff')
+
+# Batches of expenses waiting for the writer in parallel collections; when
+# full, the collectors wait for the writer to catch up.
+WRITER_QUEUE_SIZE = 16
+
+
+def content_hash(row):
+    return hashlib.md5(u'\x1f'.join(unicode(v) for v in row).encode('utf-8')).digest()
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class QueueWriter(object):
+    """Sends the expenses of a collector to the writer process."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, collection_run_id, expenses, progress, known_units):
+        fields = [f.attname for f in ArchivedExpense._meta.concrete_fields if not f.primary_key]
+        rows = [dict((field, getattr(expense, field)) for field in fields) for expense in expenses]
+        self.queue.put(('write', collection_run_id, rows, progress, known_units))
+
+
+class LockedCursorWrapper(CursorWrapper):
+    """Runs the statements that write while holding the collection's lock."""
+
+    def __init__(self, cursor, db, lock):
+        super(LockedCursorWrapper, self).__init__(cursor, db)
+        self.lock = lock
+
+    def writes(self, sql):
+        return sql.lstrip()[:6].lower() != 'select'
+
+    def execute(self, sql, params=None):
+        if not self.writes(sql):
+            return super(LockedCursorWrapper, self).execute(sql, params)
+        with self.lock:
+            return super(LockedCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with self.lock:
+            return super(LockedCursorWrapper, self).executemany(sql, param_list)
+
+
+def lock_writes(db, lock):
+    # Collectors write some rows themselves, such as those of their
+    # legislators, so all of their statements go through the lock.
+    db.make_cursor = lambda cursor: LockedCursorWrapper(cursor, db, lock)
+    db.make_debug_cursor = db.make_cursor
+
+
+def collect_task(house, options, queue, write_lock):
+    # Runs in a process of its own for each house, while the parent process
+    # writes the collected expenses.
+    lock_writes(connections['default'], write_lock)
+
+    command = Command()
+    command.collection_runs = []
+    try:
+        command.run_collector(house, options, writer=QueueWriter(queue), write_lock=write_lock)
+        queue.put(('done', house, [run.id for run in command.collection_runs]))
+    except Exception:
+        queue.put(('error', house, traceback.format_exc()))
+
 
 class Command(BaseCommand):
     help = "Collects data for a number of sources"
     collection_runs = []
 
     def add_arguments(self, parser):
-        parser.add_argument('house', type=str, nargs='+')
+        parser.add_argument('house', type=str, nargs='+', choices=COLLECTORS.keys())
         parser.add_argument(
             '--debug',
             action='store_true',
             dest='debug',
             default=False,
         )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            dest='jobs',
+            default=1,
+            help='Number of processes consolidating the collected houses.',
+        )
+        parser.add_argument(
+            '--commit',
+            choices=COMMIT_MODES,
+            dest='commit',
+            default='replace',
+            help='replace deletes and inserts all expenses of the legislature; '
+                 'diff only touches the expenses that changed.',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only retrieve months that are not closed yet, copying the '
+                 'closed ones from the previous collection.',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Continue the last unfinished collection of each house, '
+                 'instead of starting it over. Only almg, algo, alepe and '
+                 'cdep can be resumed.',
+        )
+        parser.add_argument(
+            '--parallel',
+            action='store_true',
+            dest='parallel',
+            default=False,
+            help='Collect each house in a process of its own, committing and '
+                 'consolidating each of them as soon as it is done.',
+        )
 
     def handle(self, *args, **options):
         global debug_enabled
 
+        houses = [house for house in COLLECTORS if house in options.get('house')]
+
+        if options.get('resume'):
+            not_resumable = [house for house in houses if not load_collector(house).resumable]
+            if not_resumable:
+                raise CommandError(u'Cannot resume the collection of {0}, collect them again '
+                                   u'without --resume.'.format(', '.join(not_resumable)))
+
         settings.expense_locked_for_collection = True
 
         debug_enabled = False
         if options.get('debug'):
             debug_enabled = True
 
-        houses_to_consolidate = []
-
-        if 'almg' in options.get('house'):
-            from collectors.almg import ALMG
-            almg = ALMG(self.collection_runs, debug_enabled)
-            almg.update_legislators()
-            almg.update_data()
-            almg.update_legislators_data()
-            del almg
-            houses_to_consolidate.append("almg")
-
-        if 'algo' in options.get('house'):
-            from collectors.algo import ALGO
-            algo = ALGO(self.collection_runs, debug_enabled)
-            algo.update_legislators()
-            algo.update_data()
-            del algo
-            houses_to_consolidate.append("algo")
-
-        if 'alepe' in options.get('house'):
-            from collectors.alepe import ALEPE
-            alepe = ALEPE(self.collection_runs, debug_enabled)
-            alepe.update_legislators()
-            alepe.update_data()
-            del alepe
-            houses_to_consolidate.append("alepe")
-
-        if 'senado' in options.get('house'):
-            from collectors.senado import Senado
-            senado = Senado(self.collection_runs, debug_enabled)
-            senado.update_data()
-            del senado
-            houses_to_consolidate.append("senado")
-
-        if 'cmbh' in options.get('house'):
-            from collectors.cmbh import CMBH
-            cmbh = CMBH(self.collection_runs, debug_enabled)
-            cmbh.update_legislators()
-            cmbh.update_data()
-            del cmbh
-            houses_to_consolidate.append("cmbh")
-
-        if 'cmsp' in options.get('house'):
-            from collectors.cmsp import CMSP
-            cmsp = CMSP(self.collection_runs, debug_enabled)
-            cmsp.update_data()
-            del cmsp
-            houses_to_consolidate.append("cmsp")
-
-        if 'cdep' in options.get('house'):
-            from collectors.cdep import CamaraDosDeputados
-            cdep = CamaraDosDeputados(self.collection_runs, debug_enabled)
-            cdep.update_legislators()
-            cdep.update_data()
-            del cdep
-            houses_to_consolidate.append("cdep")
+        if options.get('parallel'):
+            self.collect_in_parallel(houses, options)
+            return
+
+        for house in houses:
+            self.run_collector(house, options)
 
         settings.expense_locked_for_collection = False
 
-        for run in self.collection_runs:
-            legislature = run.legislature
-            mandates = Mandate.objects.filter(legislature=legislature)
+        self.commit_runs(self.collection_runs, options)
+
+        # Only the months changed by the runs we just committed need to be
+        # consolidated again.
+        if houses:
+            call_command(
+                "consolidate", *houses,
+                incremental=True, jobs=options.get('jobs')
+            )
+
+    def run_collector(self, house, options, writer=None, write_lock=None):
+        collector = load_collector(house)(self.collection_runs, debug_enabled)
+        collector.writer = writer
+        if write_lock is not None:
+            collector.write_lock = write_lock
+        collector.incremental = options.get('incremental')
+        collector.resume = options.get('resume')
+        for phase in COLLECTORS[house].phases:
+            getattr(collector, phase)()
+
+    def collect_in_parallel(self, houses, options):
+        # Forked collectors must not share the parent's database connection,
+        # each of them opens its own.
+        connections.close_all()
 
-            with transaction.atomic():
-                cursor = connection.cursor()
-                for m in mandates:
+        # Only one process writes at a time: either the parent, or one of
+        # the collectors creating rows shared by all houses.
+        write_lock = RLock()
+
+        queue = Queue(maxsize=WRITER_QUEUE_SIZE)
+        processes = dict()
+        for house in houses:
+            process = Process(target=collect_task, args=(house, options, queue, write_lock),
+                              name='collect-{0}'.format(house))
+            process.start()
+            processes[house] = process
+
+        settings.expense_locked_for_collection = False
+
+        try:
+            failed = self.write_collected(queue, processes, options, write_lock)
+        except BaseException:
+            # Nothing reads the queue any more, collectors waiting for room
+            # in it would never exit.
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+            raise
+        finally:
+            for process in processes.values():
+                process.join()
+
+        if failed:
+            raise CommandError(u'Failed to collect {0}'.format(', '.join(sorted(failed))))
+
+    def write_collected(self, queue, processes, options, write_lock=None):
+        # The only process writing expenses: the collectors send their
+        # batches here, and each house is committed and consolidated as
+        # soon as its collector is done. Returns the houses that failed.
+        from collectors.basecollector import write_batch
+
+        if write_lock is None:
+            write_lock = threading.RLock()
+
+        pending = set(processes)
+        failed = set()
+        while pending:
+            try:
+                message = queue.get(timeout=1)
+            except Empty:
+                for house in list(pending):
+                    if not processes[house].is_alive():
+                        print u'Collector for %s exited unexpectedly' % house
+                        pending.discard(house)
+                        failed.add(house)
+                continue
+
+            if message[0] == 'write':
+                collection_run_id, rows, progress, known_units = message[1:]
+                expenses = [ArchivedExpense(**row) for row in rows]
+                with write_lock:
+                    write_batch(collection_run_id, expenses, progress, known_units)
+            elif message[0] == 'done':
+                house, run_ids = message[1:]
+                pending.discard(house)
+
+                with write_lock:
+                    self.commit_runs(CollectionRun.objects.filter(id__in=run_ids).order_by('id'), options)
+                    call_command("consolidate", house, incremental=True, jobs=options.get('jobs'))
+            elif message[0] == 'error':
+                house, error = message[1:]
+                pending.discard(house)
+                failed.add(house)
+                print u'Failed to collect %s:\n%s' % (house, error)
+
+        return failed
+
+    def commit_runs(self, runs, options):
+        for run in runs:
+            if options.get('commit') == 'diff':
+                self.diff_collection_run(run)
+            else:
+                self.commit_collection_run(run)
+
+    def commit_collection_run(self, run):
+        # Replaces the legislature's expenses with the ones collected by the
+        # run: a single delete for the whole legislature, and an insert done
+        # in chunks of archived expense ids, so we can report progress. All
+        # of it happens in one transaction, so readers never see the
+        # legislature with no expenses or only some of them.
+        archived = ArchivedExpense.objects.filter(collection_run=run)
+        bounds = archived.aggregate(Min('id'), Max('id'))
+        first, last = bounds['id__min'], bounds['id__max']
+
+        columns = ", ".join(EXPENSE_CONTENT_FIELDS)
+
+        with transaction.atomic():
+            self.record_changes(run)
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "delete from montanha_expense where mandate_id in "
+                    "(select id from montanha_mandate where legislature_id=%s)",
+                    (run.legislature_id,)
+                )
+                print u'Deleted %d expenses for %s' % (cursor.rowcount, run.legislature)
+
+                inserted = 0
+                start = first
+                while first is not None and start <= last:
+                    end = start + COMMIT_CHUNK_SIZE
                     cursor.execute(
-                        "delete from montanha_expense where mandate_id=%s", (m.id,)
+                        "insert into montanha_expense (%s) select %s from montanha_archivedexpense "
+                        "where collection_run_id=%%s and id >= %%s and id < %%s" % (columns, columns),
+                        (run.id, start, end)
                     )
+                    inserted += cursor.rowcount
+                    start = end
 
-                columns = "number, nature_id, date, value, expensed, mandate_id, supplier_id"
-                cursor.execute(
-                    "insert into montanha_expense (%s) select %s from montanha_archivedexpense where collection_run_id=%d" % (
-                        columns, columns, run.id
+                    print u'Committed %d expenses for %s (%d%%)' % (
+                        inserted, run.legislature, 100 * (min(end, last + 1) - first) / (last + 1 - first)
                     )
-                )
-                cursor.close()
 
             run.committed = True
             run.save()
 
-        for house in houses_to_consolidate:
-            call_command("consolidate", house)
+        # Raw statements do not invalidate cached querysets.
+        invalidate_model(Expense)
+
+    def diff_collection_run(self, run):
+        # Matches the collected expenses against the current ones by their
+        # content, and only deletes and inserts the rows that differ.
+        fields = ('id', 'mandate__legislator_id') + EXPENSE_CONTENT_FIELDS
+
+        current = dict()
+        expenses = Expense.objects.filter(mandate__legislature=run.legislature)
+        for row in expenses.values_list(*fields).iterator():
+            current.setdefault(content_hash(row[2:]), []).append(row)
+
+        inserts = list()
+        archived = ArchivedExpense.objects.filter(collection_run=run)
+        for row in archived.values_list(*fields).iterator():
+            key = content_hash(row[2:])
+            if key in current:
+                current[key].pop()
+                if not current[key]:
+                    del current[key]
+            else:
+                inserts.append(row)
+
+        deletes = [row for rows in current.values() for row in rows]
+
+        # (nature, legislator, year, month) of every row that changed.
+        changes = set((row[3], row[1], row[4].year, row[4].month) for row in inserts + deletes)
+
+        columns = ", ".join(EXPENSE_CONTENT_FIELDS)
+
+        with transaction.atomic():
+            self.record_pending(run.legislature.institution_id, changes)
+
+            cursor = connection.cursor()
+            for ids in chunks([row[0] for row in deletes], DIFF_CHUNK_SIZE):
+                cursor.execute(
+                    "delete from montanha_expense where id in (%s)" % ", ".join(["%s"] * len(ids)),
+                    ids
+                )
+
+            for ids in chunks([row[0] for row in inserts], DIFF_CHUNK_SIZE):
+                cursor.execute(
+                    "insert into montanha_expense (%s) select %s from montanha_archivedexpense where id in (%s)" % (
+                        columns, columns, ", ".join(["%s"] * len(ids))
+                    ),
+                    ids
+                )
+            cursor.close()
+
+        print u'Committed %s: %d expenses deleted, %d inserted, %d months changed' % (
+            run.legislature, len(deletes), len(inserts), len(changes)
+        )
+
+        run.committed = True
+        run.save()
+
+        invalidate_model(Expense)
+
+        return changes
+
+    def monthly_totals(self, queryset):
+        totals = queryset \
+            .annotate(year=ExtractYear('date'), month=ExtractMonth('date')) \
+            .values('nature_id', 'mandate__legislator_id', 'year', 'month') \
+            .annotate(expensed=Sum('expensed'), count=Count('id')) \
+            .order_by()
+
+        return dict(
+            ((t['nature_id'], t['mandate__legislator_id'], t['year'], t['month']),
+             (t['expensed'], t['count']))
+            for t in totals
+        )
+
+    def record_changes(self, run):
+        # Remembers which months differ between the expenses we are about to
+        # replace and the ones collected by this run, so that consolidate
+        # --incremental only needs to look at those.
+        legislature = run.legislature
+
+        old = self.monthly_totals(Expense.objects.filter(mandate__legislature=legislature))
+        new = self.monthly_totals(ArchivedExpense.objects.filter(collection_run=run))
+
+        changes = [key for key in set(old) | set(new) if old.get(key) != new.get(key)]
+        self.record_pending(legislature.institution_id, changes)
+
+    def record_pending(self, institution_id, changes):
+        PendingConsolidation.objects.bulk_create([
+            PendingConsolidation(
+                institution_id=institution_id,
+                nature_id=nature_id,
+                legislator_id=legislator_id,
+                year=year,
+                month=month,
+            )
+            for nature_id, legislator_id, year, month in changes
+        ], batch_size=1000)
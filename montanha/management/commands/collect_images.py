@@ -17,12 +17,14 @@
 
 from django.core.management.base import BaseCommand
 
+from collectors.registry import COLLECTORS, load_collector
+
 
 class Command(BaseCommand):
     help = "Collects data for a number of sources"
 
     def add_arguments(self, parser):
-        parser.add_argument('house', type=str, nargs='+')
+        parser.add_argument('house', type=str, nargs='+', choices=COLLECTORS.keys())
         parser.add_argument(
             '--debug',
             action='store_true',
@@ -37,7 +39,11 @@ class Command(BaseCommand):
         if options.get('debug'):
             debug_enabled = True
 
-        if 'algo' in options.get('house'):
-            from collectors.algo import ALGO
-            algo = ALGO(collection_runs, debug_enabled)
-            algo.update_images()
+        for house in options.get('house'):
+            if not COLLECTORS[house].image_phases:
+                print u'No images to collect for %s' % house
+                continue
+
+            collector = load_collector(house)(collection_runs, debug_enabled)
+            for phase in COLLECTORS[house].image_phases:
+                getattr(collector, phase)()
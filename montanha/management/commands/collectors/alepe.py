@@ -20,9 +20,9 @@ from datetime import datetime
 from slugify import slugify
 
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from montanha.models import (
-    ArchivedExpense, ExpenseNature, Institution, Legislature, Legislator,
-    PoliticalParty
+    ArchivedExpense, Institution, Legislature, PoliticalParty
 )
 
 
@@ -53,9 +53,11 @@ def merge_lists(l1, l2, key):
 
 
 class ALEPE(BaseCollector):
+    resumable = True
 
     def __init__(self, collection_runs, debug_enabled=False):
         super(ALEPE, self).__init__(collection_runs, debug_enabled)
+        self.http_cache = HTTPCache.for_house('alepe')
 
         self.institution, _ = Institution.objects.get_or_create(
             siglum='ALEPE',
@@ -109,7 +111,7 @@ class ALEPE(BaseCollector):
                 legislator_html.find('figure').find('img')['src'],
             )
 
-            legislator, created = Legislator.objects.get_or_create(name=name)
+            legislator, created = self.get_or_create_legislator(name)
             if created:
                 self.debug(u'New legislator: %s' % unicode(legislator))
             else:
@@ -136,57 +138,63 @@ class ALEPE(BaseCollector):
         mandates = self.legislature.mandate_set.all()
         year_start = self.legislature.date_start.year
         year_end = self.legislature.date_end.year
+
+        requests = list()
         for year in range(year_start, year_end + 1):
-            self.debug(u'Updating data for year {0}'.format(year))
             for month in range(1, 13):
                 today = datetime.now()
                 if today.year == year and month > today.month:
                     continue
 
-                self.debug(u'Updating data for month {0}'.format(month))
-                self._update_data_for_year(mandates, year, month)
-
-    def _update_data_for_year(self, mandates, year, month):
-        for mandate in mandates:
-            url = '{0}/?dep={1}&ano={2}&mes={3}'.format(
-                TRANSPARENCIA_URL,
-                mandate.original_id,
-                year,
-                month,
-            )
-            expense_natures = {}
-            expenses_data = self.retrieve_uri(url)
-            natures = expenses_data.find(id='div-com-verba').findAll('h4')
-            for nature in natures:
-                # memory cache
-                nature_name = nature.text.split('-')[1].strip()
-                expense_nature = expense_natures.get(nature_name)
-                if not expense_nature:
-                    expense_nature, _ = ExpenseNature.objects.get_or_create(
-                        name=nature_name,
+                for mandate in mandates:
+                    if not self.needs_update(mandate, year, month):
+                        continue
+                    url = '{0}/?dep={1}&ano={2}&mes={3}'.format(
+                        TRANSPARENCIA_URL,
+                        mandate.original_id,
+                        year,
+                        month,
                     )
-                    expense_natures[nature_name] = expense_nature
-
-                my_table = nature.findNextSibling().find('table')
-                tds = my_table.findAll('td')
-
-                date = parse_date(tds[0].text)
-                cpf_cnpj = self.normalize_cnpj_or_cpf(tds[1].text)
-                supplier_name = tds[2].text
-                expensed = parse_money(tds[3].text)
-
-                supplier = self.get_or_create_supplier(cpf_cnpj, supplier_name)
-
-                expense = ArchivedExpense(
-                    original_id='',
-                    number='',
-                    nature=expense_nature,
-                    date=date,
-                    value=expensed,
-                    expensed=expensed,
-                    mandate=mandate,
-                    supplier=supplier,
-                    collection_run=self.collection_run,
-                )
-                expense.save()
-                self.debug(u'New expense found: {0}'.format(unicode(expense)))
+                    requests.append(((mandate, year, month), url, dict(closed=self.is_closed_month(year, month))))
+
+        for (mandate, year, month), expenses_data in self.retrieve_many(requests):
+            self.debug(u'Updating data for {0}/{1}: {2}'.format(month, year, mandate))
+            self.start_month(mandate, year, month)
+            self._update_data_for_month(mandate, expenses_data)
+
+        self.save_checkpoints()
+
+    def _update_data_for_month(self, mandate, expenses_data):
+        expense_natures = {}
+        natures = expenses_data.find(id='div-com-verba').findAll('h4')
+        for nature in natures:
+            # memory cache
+            nature_name = nature.text.split('-')[1].strip()
+            expense_nature = expense_natures.get(nature_name)
+            if not expense_nature:
+                expense_nature, _ = self.get_or_create_nature(nature_name)
+                expense_natures[nature_name] = expense_nature
+
+            my_table = nature.findNextSibling().find('table')
+            tds = my_table.findAll('td')
+
+            date = parse_date(tds[0].text)
+            cpf_cnpj = self.normalize_cnpj_or_cpf(tds[1].text)
+            supplier_name = tds[2].text
+            expensed = parse_money(tds[3].text)
+
+            supplier = self.get_or_create_supplier(cpf_cnpj, supplier_name)
+
+            expense = ArchivedExpense(
+                original_id='',
+                number='',
+                nature=expense_nature,
+                date=date,
+                value=expensed,
+                expensed=expensed,
+                mandate=mandate,
+                supplier=supplier,
+                collection_run=self.collection_run,
+            )
+            self.add_expense(expense)
+            self.debug(u'New expense found: {0}'.format(unicode(expense)))
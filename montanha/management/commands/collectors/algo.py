@@ -31,8 +31,9 @@ from cachetools import Cache, cachedmethod
 from django.core.files import File
 
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from montanha.models import (
-    Institution, Legislature, PoliticalParty, Legislator, ExpenseNature,
+    Institution, Legislature, PoliticalParty,
     ArchivedExpense, Mandate
 )
 
@@ -40,9 +41,11 @@ from montanha.models import (
 class ALGO(BaseCollector):
     TITLE_REGEX = re.compile(r'\d+ - (.*)')
     MONEY_RE = re.compile(r'([0-9.,]+)[,.]([0-9]{2})$')
+    resumable = True
 
     def __init__(self, *args, **kwargs):
         super(ALGO, self).__init__(*args, **kwargs)
+        self.http_cache = HTTPCache.for_house('algo')
 
         self.base_url = 'http://al.go.leg.br'
 
@@ -97,7 +100,7 @@ class ALGO(BaseCollector):
 
             self.debug(u'New party: {0}'.format(party))
 
-            legislator, created = Legislator.objects.get_or_create(name=row.nome)
+            legislator, created = self.get_or_create_legislator(row.nome)
 
             legislator.site = self.base_url + row.url
             legislator.email = email
@@ -151,7 +154,7 @@ class ALGO(BaseCollector):
         data = json.loads(self.retrieve_uri(url, force_encoding='utf8').text)
         return data['deputados']
 
-    def find_data_for_month(self, mandate, year, month):
+    def uri_for_month(self, mandate, year, month):
         parlamentar_id = self.get_parlamentar_id(year, month, mandate.legislator.name)
 
         if not parlamentar_id:
@@ -160,13 +163,22 @@ class ALGO(BaseCollector):
                     year, month, mandate.legislator.name,
                 )
             )
-            raise StopIteration
+            return
 
-        url = '{0}/transparencia/verbaindenizatoria/exibir?ano={1}&mes={2}&parlamentar_id={3}'.format(
+        return '{0}/transparencia/verbaindenizatoria/exibir?ano={1}&mes={2}&parlamentar_id={3}'.format(
             self.base_url, year, month, parlamentar_id
         )
-        data = self.retrieve_uri(url, force_encoding='utf8')
 
+    def find_data_for_month(self, mandate, year, month):
+        url = self.uri_for_month(mandate, year, month)
+        if not url:
+            raise StopIteration
+
+        data = self.retrieve_uri(url, force_encoding='utf8', closed=self.is_closed_month(year, month))
+        for item in self.parse_data_for_month(mandate, year, month, data):
+            yield item
+
+    def parse_data_for_month(self, mandate, year, month, data):
         if u'parlamentar não prestou contas para o mês' in data.text:
             self.debug(u'not found data for: {0} -> {1}/{2}'.format(
                 mandate.legislator, year, month
@@ -264,18 +276,38 @@ class ALGO(BaseCollector):
 
     def get_or_create_expense_nature(self, name):
         if name not in self.expenses_nature_cached:
-            try:
-                nature = ExpenseNature.objects.get(name=name)
-            except ExpenseNature.DoesNotExist:
-                nature = ExpenseNature(name=name)
-                nature.save()
-
+            nature, _ = self.get_or_create_nature(name)
             self.expenses_nature_cached[name] = nature
 
         return self.expenses_nature_cached[name]
 
+    def update_data(self):
+        self.collection_run = self.create_collection_run(self.legislature)
+
+        requests = list()
+        mandates = Mandate.objects.filter(date_start__year=self.legislature.date_start.year,
+                                          legislature=self.legislature).select_related('legislator')
+        for mandate in mandates:
+            for year in range(self.legislature.date_start.year, datetime.now().year + 1):
+                for month in range(1, 13):
+                    if not self.needs_update(mandate, year, month):
+                        continue
+                    url = self.uri_for_month(mandate, year, month)
+                    if url:
+                        options = dict(force_encoding='utf8', closed=self.is_closed_month(year, month))
+                        requests.append(((mandate, year, month), url, options))
+
+        for (mandate, year, month), data in self.retrieve_many(requests):
+            self.start_month(mandate, year, month)
+            self.update_data_from_rows(mandate, self.parse_data_for_month(mandate, year, month, data))
+
+        self.save_checkpoints()
+
     def update_data_for_month(self, mandate, year, month):
-        for data in self.find_data_for_month(mandate, year, month):
+        self.update_data_from_rows(mandate, self.find_data_for_month(mandate, year, month))
+
+    def update_data_from_rows(self, mandate, month_data):
+        for data in month_data:
             nature = self.get_or_create_expense_nature(
                 '{0}: {1}'.format(data['budget_title'], data['budget_subtitle'])
             )
@@ -298,7 +330,7 @@ class ALGO(BaseCollector):
                 collection_run=self.collection_run,
             )
 
-            expense.save()
+            self.add_expense(expense)
 
     def update_images(self):
         mandates = Mandate.objects.filter(legislature=self.legislature, legislator__picture='')
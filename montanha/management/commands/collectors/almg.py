@@ -20,19 +20,23 @@
 import json
 import re
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from datetime import datetime
 from montanha.models import (
-    Institution, Legislature, Legislator, PoliticalParty, ExpenseNature,
+    Institution, Legislature, Legislator, Mandate, PoliticalParty, ExpenseNature,
     ArchivedExpense
 )
 
 
 class ALMG(BaseCollector):
+    resumable = True
+
     def __init__(self, collection_runs, debug_enabled=False):
         super(ALMG, self).__init__(collection_runs, debug_enabled)
+        self.http_cache = HTTPCache.for_house('almg')
 
         self.user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2227.0 Safari/537.36'
-        self.headers = {'user-agent': self.user_agent}
+        self.default_headers = {'user-agent': self.user_agent}
         self.almg_url = 'http://dadosabertos.almg.gov.br/ws'
 
         try:
@@ -63,19 +67,13 @@ class ALMG(BaseCollector):
     def update_legislators(self):
         for situation in ['em_exercicio', 'que_exerceram_mandato']:
             uri = "%s/deputados/%s?formato=json" % (self.almg_url, situation)
-            legislators = self.retrieve_uri(uri, force_encoding='utf-8', headers=self.headers)["list"]
+            legislators = self.retrieve_uri(uri, force_encoding='utf-8')["list"]
             for entry in legislators:
-                try:
-                    party = PoliticalParty.objects.get(siglum=entry["partido"])
-                except PoliticalParty.DoesNotExist:
-                    party = PoliticalParty(siglum=entry["partido"])
-                    party.save()
-
+                party, created = PoliticalParty.objects.get_or_create(siglum=entry["partido"])
+                if created:
                     self.debug("New party: %s" % unicode(party))
 
-                legislator, created = self.try_name_disambiguation(entry['nome'])
-                if not legislator:
-                    legislator, created = Legislator.objects.get_or_create(name=entry['nome'])
+                legislator, created = self.get_or_create_legislator(entry['nome'])
 
                 if created:
                     self.debug("New legislator: %s" % unicode(legislator))
@@ -90,7 +88,7 @@ class ALMG(BaseCollector):
         for mandate in mandates:
             original_id = mandate.original_id
             uri = "%s/deputados/%s?formato=json" % (self.almg_url, original_id)
-            entry = self.retrieve_uri(uri, headers=self.headers)["deputado"]
+            entry = self.retrieve_uri(uri)["deputado"]
 
             self.debug("Legislator %s" % unicode(mandate.legislator))
 
@@ -119,12 +117,37 @@ class ALMG(BaseCollector):
 
             mandate.legislator.save()
 
+    def uri_for_month(self, mandate, year, month):
+        return "%s/prestacao_contas/verbas_indenizatorias/deputados/%s/%d/%d?formato=json" % (self.almg_url,
+                                                                                              mandate.original_id,
+                                                                                              year, month)
+
+    def update_data(self):
+        self.collection_run = self.create_collection_run(self.legislature)
+
+        requests = list()
+        for mandate in Mandate.objects.filter(date_start__year=self.legislature.date_start.year,
+                                              legislature=self.legislature):
+            for year in range(self.legislature.date_start.year, datetime.now().year + 1):
+                for month in range(1, 13):
+                    if not self.needs_update(mandate, year, month):
+                        continue
+                    uri = self.uri_for_month(mandate, year, month)
+                    requests.append(((mandate, year, month), uri, dict(closed=self.is_closed_month(year, month))))
+
+        for (mandate, year, month), data in self.retrieve_many(requests):
+            self.start_month(mandate, year, month)
+            self.update_data_from_json(mandate, year, month, data)
+
+        self.save_checkpoints()
+
     def update_data_for_month(self, mandate, year, month):
+        data = self.retrieve_uri(self.uri_for_month(mandate, year, month), closed=self.is_closed_month(year, month))
+        self.update_data_from_json(mandate, year, month, data)
+
+    def update_data_from_json(self, mandate, year, month, data):
         self.debug("Updating data for %d-%d - %s" % (year, month, unicode(mandate)))
-        uri = "%s/prestacao_contas/verbas_indenizatorias/deputados/%s/%d/%d?formato=json" % (self.almg_url,
-                                                                                             mandate.original_id,
-                                                                                             year, month)
-        for entry in self.retrieve_uri(uri, headers=self.headers)["list"]:
+        for entry in data["list"]:
             try:
                 nature = ExpenseNature.objects.get(original_id=entry["codTipoDespesa"])
             except ExpenseNature.DoesNotExist:
@@ -155,6 +178,6 @@ class ALMG(BaseCollector):
                                           mandate=mandate,
                                           supplier=supplier,
                                           collection_run=self.collection_run)
-                expense.save()
+                self.add_expense(expense)
 
                 self.debug("New expense found: %s" % unicode(expense))
@@ -17,29 +17,127 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
 import time
+import unicodedata
+from contextlib import closing
 from datetime import datetime, date
+from urlparse import urlsplit
 
 import requests
-from django.db import connection
+from requests.adapters import HTTPAdapter
+from django.db import connection, reset_queries, transaction
 from BeautifulSoup import BeautifulSoup, BeautifulStoneSoup
 
-from montanha.models import Mandate, CollectionRun, Supplier
+from bulkload import bulk_load
+from fetch import Fetcher
+from retry import RetryPolicy
+from montanha.models import (
+    AlternativeLegislatorName, ArchivedExpense, CollectionCheckpoint,
+    CollectionProgress, CollectionRun, ExpenseNature, Legislator, Mandate, Supplier
+)
+
+
+# Below SQLite's limit of 999 parameters per query.
+SUPPLIERS_LOOKUP_SIZE = 500
+CHECKPOINTS_CHUNK_SIZE = 500
+
+
+def write_batch(collection_run_id, expenses, progress, known_units, batch_size=1000):
+    # Writes expenses along with the progress of the units they belong to,
+    # see BaseCollector.mark_progress().
+    with transaction.atomic():
+        bulk_load(ArchivedExpense, expenses, batch_size=batch_size)
+
+        new_units = list()
+        for unit, position in progress.items():
+            if unit in known_units:
+                CollectionProgress.objects.filter(collection_run_id=collection_run_id, unit=unit) \
+                                          .update(position=position)
+            else:
+                new_units.append(CollectionProgress(collection_run_id=collection_run_id, unit=unit,
+                                                    position=position))
+        CollectionProgress.objects.bulk_create(new_units, batch_size=batch_size)
+
+
+def fold_name(name):
+    # Case and accent insensitive form of a name, used to match legislators.
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    return u' '.join(name.lower().split())
 
 
 class BaseCollector(object):
+    # Resumable collectors only write expenses along with the units they
+    # belong to, see mark_progress(), so that a resumed run can skip those
+    # units. Other collectors cannot resume and start over.
+    resumable = False
+
     def __init__(self, collection_runs, debug_enabled):
         self.debug_enabled = debug_enabled
         self.collection_runs = collection_runs
         self.collection_run = None
 
         self.default_timeout = 20
-        self.max_tries = 10
-        self.try_again_timer = 10
+        self.retry_policy = RetryPolicy()
+
+        # Limits for retrieve_many().
+        self.fetch_workers = 8
+        self.fetch_per_host = 4
+        self.log_lock = threading.Lock()
+
+        # Keep-alive sessions, one per host, see session_for().
+        self.default_headers = {}
+        self.http_pool_size = 10
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        # Responses kept on disk, see retrieve_uri(). Months that ended
+        # more than closed_month_grace days ago are not revalidated.
+        self.http_cache = None
+        self.closed_month_grace = 60
 
         self.mandates_cache = {}
         self.legislature = None
 
+        # Months of the current legislature and the runs that collected
+        # them, see needs_update() and start_month(). Incremental runs skip
+        # the closed ones.
+        self.incremental = False
+        self.checkpoints = None
+        self.checkpoint = None
+        self.collected_checkpoints = []
+        self.carried_checkpoints = []
+
+        # Units of work done by the current run, see mark_progress().
+        self.resume = False
+        self.progress = {}
+        self.pending_progress = {}
+
+        # Expenses are written in batches, see add_expense(). They go
+        # through the writer instead, when set by a parallel collection.
+        self.expenses_batch_size = 1000
+        self.pending_expenses = []
+        self.writer = None
+
+        # Held while writing anything else, or while looking up rows that
+        # are created when missing. Parallel collections share it with
+        # each other and with the writer, so only one of them writes at a
+        # time. It must not be held while sending to the writer, which
+        # needs it to write.
+        self.write_lock = threading.RLock()
+
+        # Supplier identifiers to ids, loaded on first use.
+        self.suppliers = None
+
+        # Folded legislator names to legislators, loaded on first use,
+        # along with the id of the last legislator loaded.
+        self.legislators = None
+        self.legislators_last_id = 0
+        self.new_suppliers = {}
+
     def debug(self, message):
         message = message.encode('utf-8')
 
@@ -54,46 +152,286 @@ class BaseCollector(object):
         self.log_to_file(message)
 
     def log_to_file(self, message):
-        if not hasattr(self, 'logfile'):
-            fname = self.legislature.institution.siglum.lower()
-            self.logfile = open(fname + '.log', 'a')
-
-        timestamp = datetime.fromtimestamp(time.time()).strftime('%F:%H:%M:%S')
-        self.logfile.write('%s %s\n' % (timestamp, message))
-
-    def mandate_for_legislator(self, legislator, party, state=None, original_id=None):
-        cache_key = (legislator, party, state, original_id)
-        if cache_key in self.mandates_cache:
-            return self.mandates_cache[cache_key]
-
-        try:
-            mandate = Mandate.objects.get(legislator=legislator, date_start=self.legislature.date_start)
-        except Mandate.DoesNotExist:
-            mandate = Mandate(legislator=legislator, date_start=self.legislature.date_start, party=party,
-                              legislature=self.legislature, state=state)
+        # Also called from the threads of retrieve_many().
+        with self.log_lock:
+            if not hasattr(self, 'logfile'):
+                fname = self.legislature.institution.siglum.lower()
+                self.logfile = open(fname + '.log', 'a')
+
+            timestamp = datetime.fromtimestamp(time.time()).strftime('%F:%H:%M:%S')
+            self.logfile.write('%s %s\n' % (timestamp, message))
+
+    def mandates_for_legislature(self, legislature):
+        # All mandates of a legislature are loaded on first use, indexed by
+        # legislator.
+        if legislature.id not in self.mandates_cache:
+            mandates = Mandate.objects \
+                .filter(legislature=legislature, date_start=legislature.date_start) \
+                .select_related('legislator')
+            self.mandates_cache[legislature.id] = dict((m.legislator_id, m) for m in mandates)
+        return self.mandates_cache[legislature.id]
+
+    def mandate_for_legislator(self, legislator, party, state=None, original_id=None, legislature=None):
+        legislature = legislature or self.legislature
+        mandates = self.mandates_for_legislature(legislature)
+
+        mandate = mandates.get(legislator.id)
+        if mandate is None:
+            mandate = Mandate(legislator=legislator, date_start=legislature.date_start, party=party,
+                              legislature=legislature, state=state, original_id=original_id)
             mandate.save()
-            self.debug("Mandate starting on %s did not exist, created." % self.legislature.date_start.strftime("%F"))
-
-        if original_id:
+            mandates[legislator.id] = mandate
+            self.debug("Mandate starting on %s did not exist, created." % legislature.date_start.strftime("%F"))
+        elif original_id and unicode(original_id) != unicode(mandate.original_id):
             mandate.original_id = original_id
-            mandate.save()
-
-        self.mandates_cache[cache_key] = mandate
+            mandate.save(update_fields=['original_id'])
 
         return mandate
 
+    def load_legislators(self):
+        legislators = dict((legislator.id, legislator) for legislator in Legislator.objects.all())
+
+        # Alternative names go first so that actual names take precedence,
+        # and the oldest legislator wins for duplicated names.
+        self.legislators = dict()
+        alternative_names = Legislator.alternative_names.through.objects \
+            .order_by('-id') \
+            .values_list('alternativelegislatorname__name', 'legislator_id')
+        for name, legislator_id in alternative_names:
+            self.legislators[fold_name(name)] = legislators[legislator_id]
+
+        for legislator_id in sorted(legislators, reverse=True):
+            legislator = legislators[legislator_id]
+            self.legislators[fold_name(legislator.name)] = legislator
+
+        self.legislators_last_id = max(legislators) if legislators else 0
+
+    def load_new_legislators(self):
+        # Adds the legislators created by other collectors since ours were
+        # loaded, the ones we already know take precedence.
+        for legislator in Legislator.objects.filter(id__gt=self.legislators_last_id).order_by('id'):
+            self.legislators.setdefault(fold_name(legislator.name), legislator)
+            self.legislators_last_id = legislator.id
+
+    def try_name_disambiguation(self, name):
+        return None, False
+
+    def get_or_create_legislator(self, name):
+        legislator, created = self.try_name_disambiguation(name)
+        if legislator:
+            return legislator, created
+
+        if self.legislators is None:
+            self.load_legislators()
+
+        key = fold_name(name)
+        legislator = self.legislators.get(key)
+        if legislator is not None:
+            return legislator, False
+
+        with self.write_lock:
+            self.load_new_legislators()
+            legislator = self.legislators.get(key)
+            if legislator is not None:
+                return legislator, False
+
+            legislator = Legislator(name=name)
+            legislator.save()
+            self.legislators[key] = legislator
+            return legislator, True
+
+    def add_alternative_name(self, legislator, name):
+        if self.legislators is None:
+            self.load_legislators()
+
+        key = fold_name(name)
+        if self.legislators.get(key) == legislator:
+            return
+
+        with self.write_lock:
+            alternative_name, _ = AlternativeLegislatorName.objects.get_or_create(name=name)
+            legislator.alternative_names.add(alternative_name)
+        self.legislators.setdefault(key, legislator)
+
+    def get_or_create_nature(self, name):
+        # Natures are shared by all houses, but their names are not unique.
+        with self.write_lock:
+            return ExpenseNature.objects.get_or_create(name=name)
+
     def update_legislators(self):
         raise Exception("Not implemented.")  # pragma: no cover
 
     def update_data_for_year(self, mandate, year):
         self.debug("Updating data for year %d" % year)
         for month in range(1, 13):
-            self.update_data_for_month(mandate, year, month)
+            if self.needs_update(mandate, year, month):
+                self.start_month(mandate, year, month)
+                self.update_data_for_month(mandate, year, month)
 
     def update_data_for_month(self, mandate, year, month):
         raise Exception("Not implemented.")  # pragma: no cover
 
+    def load_checkpoints(self):
+        checkpoints = CollectionCheckpoint.objects.filter(mandate__legislature=self.collection_run.legislature)
+        self.checkpoints = dict(((c.mandate_id, c.year, c.month), c) for c in checkpoints)
+
+    def month_unit(self, mandate_id, year, month):
+        return 'mandate-{0}-{1}-{2:02d}'.format(mandate_id, year, month)
+
+    def needs_update(self, mandate, year, month):
+        # Closed months are copied forward by save_checkpoints() instead.
+        if self.checkpoints is None:
+            self.load_checkpoints()
+
+        checkpoint = self.checkpoints.get((mandate.id, year, month))
+
+        if self.month_unit(mandate.id, year, month) in self.progress:
+            # Already collected before the run was interrupted.
+            if checkpoint is not None:
+                self.collected_checkpoints.append(checkpoint)
+            return False
+
+        if not self.incremental:
+            return True
+
+        if checkpoint is None or not checkpoint.closed:
+            return True
+
+        self.carried_checkpoints.append(checkpoint)
+        return False
+
+    def start_month(self, mandate, year, month):
+        # Expenses added from now on belong to this month, and the
+        # previous month is done.
+        self.finish_month()
+        if self.checkpoints is None:
+            self.load_checkpoints()
+
+        key = (mandate.id, year, month)
+        checkpoint = self.checkpoints.get(key)
+        if checkpoint is None:
+            checkpoint = CollectionCheckpoint.objects.create(mandate=mandate, year=year, month=month,
+                                                             collection_run=self.collection_run)
+            self.checkpoints[key] = checkpoint
+
+        self.checkpoint = checkpoint
+        self.collected_checkpoints.append(checkpoint)
+
+    def finish_month(self):
+        if self.checkpoint is not None:
+            checkpoint = self.checkpoint
+            self.mark_progress(self.month_unit(checkpoint.mandate_id, checkpoint.year, checkpoint.month))
+            self.checkpoint = None
+
+    def save_checkpoints(self):
+        # Collectors that track months with start_month() call this,
+        # instead of flush_expenses(), once they are done with a run.
+        self.finish_month()
+        self.flush_expenses()
+
+        run = self.collection_run
+        if self.carried_checkpoints:
+            columns = ", ".join(f.column for f in ArchivedExpense._meta.concrete_fields
+                                if not f.primary_key and f.name != 'collection_run')
+
+            by_run = dict()
+            for checkpoint in self.carried_checkpoints:
+                by_run.setdefault(checkpoint.collection_run_id, []).append(checkpoint.id)
+
+            copied = 0
+            with connection.cursor() as cursor:
+                for previous_run, ids in by_run.items():
+                    for i in range(0, len(ids), CHECKPOINTS_CHUNK_SIZE):
+                        chunk = ids[i:i + CHECKPOINTS_CHUNK_SIZE]
+                        cursor.execute(
+                            "insert into montanha_archivedexpense (%s, collection_run_id) "
+                            "select %s, %%s from montanha_archivedexpense "
+                            "where collection_run_id = %%s and checkpoint_id in (%s)" % (
+                                columns, columns, ", ".join(["%s"] * len(chunk))
+                            ),
+                            [run.id, previous_run] + chunk
+                        )
+                        copied += cursor.rowcount
+
+            self.info(u"Copied %d expenses of %d closed months forward" % (copied, len(self.carried_checkpoints)))
+
+        closed = [c.id for c in self.collected_checkpoints if self.is_closed_month(c.year, c.month)]
+        still_open = [c.id for c in self.collected_checkpoints if not self.is_closed_month(c.year, c.month)]
+        carried = [c.id for c in self.carried_checkpoints]
+
+        for ids, values in ((closed, dict(closed=True)), (still_open, dict(closed=False)), (carried, {})):
+            for i in range(0, len(ids), CHECKPOINTS_CHUNK_SIZE):
+                CollectionCheckpoint.objects.filter(id__in=ids[i:i + CHECKPOINTS_CHUNK_SIZE]) \
+                                            .update(collection_run=run, **values)
+
+        self.collected_checkpoints = []
+        self.carried_checkpoints = []
+
+    def add_expense(self, expense):
+        if self.checkpoint is not None:
+            expense.checkpoint = self.checkpoint
+        self.pending_expenses.append(expense)
+        if not self.resumable and len(self.pending_expenses) >= self.expenses_batch_size:
+            self.flush_expenses()
+
+    def mark_progress(self, unit, position=0):
+        # Tells that all expenses of a unit, or of its first `position`
+        # records, have been added.
+        self.pending_progress[unit] = position
+        if len(self.pending_expenses) >= self.expenses_batch_size:
+            self.flush_expenses()
+
+    def flush_expenses(self):
+        # Collectors must call this once they are done adding expenses.
+        if not self.pending_expenses and not self.pending_progress:
+            return
+
+        self.flush_suppliers()
+        for expense in self.pending_expenses:
+            if expense.supplier_id is None:
+                # Refreshes the id of a supplier that has just been saved.
+                expense.supplier = expense.supplier
+
+        collection_run_id = self.collection_run.id if self.collection_run else None
+        known_units = [unit for unit in self.pending_progress if unit in self.progress]
+        if self.writer is not None:
+            self.writer.write(collection_run_id, self.pending_expenses, self.pending_progress, known_units)
+        else:
+            write_batch(collection_run_id, self.pending_expenses, self.pending_progress, known_units,
+                        batch_size=self.expenses_batch_size)
+
+        self.progress.update(self.pending_progress)
+        self.pending_progress = {}
+        self.pending_expenses = []
+
+        # To help with debug mode using up memory for query logs.
+        reset_queries()
+
+    def resumable_run(self, legislature):
+        return CollectionRun.objects.filter(legislature=legislature, committed=False) \
+                                    .order_by('-date', '-id').first()
+
     def create_collection_run(self, legislature):
+        # Expenses for the previous run must not outlive it.
+        self.save_checkpoints()
+        self.checkpoints = None
+        self.progress = {}
+
+        if self.resumable:
+            collection_run = self.resumable_run(legislature)
+            if collection_run and self.resume:
+                self.debug(u"Resuming %s" % collection_run)
+                self.collection_runs.append(collection_run)
+
+                units = CollectionProgress.objects.filter(collection_run=collection_run)
+                self.progress = dict(units.values_list('unit', 'position'))
+                return collection_run
+
+            # Otherwise, a run that was interrupted is started over.
+            if collection_run and collection_run.date != date.today():
+                self.debug(u"Removing unfinished %s" % collection_run)
+                self.remove_collection_run(collection_run.id)
+
         collection_run, created = CollectionRun.objects.get_or_create(date=date.today(),
                                                                       legislature=legislature)
         self.collection_runs.append(collection_run)
@@ -104,6 +442,9 @@ class BaseCollector(object):
             self.debug("Collection run for %s already exists for legislature %s, clearing." % (date.today().strftime("%F"), legislature))
             self.remove_collection_run(collection_run.id, remove_run=False)
 
+            # Its months have to be collected again.
+            CollectionCheckpoint.objects.filter(collection_run=collection_run).update(closed=False)
+
         return collection_run
 
     def remove_collection_run(self, crid, remove_run=True):
@@ -111,7 +452,14 @@ class BaseCollector(object):
         with connection.cursor() as cursor:
             query = 'DELETE FROM montanha_archivedexpense WHERE collection_run_id = {0}'.format(crid)
             cursor.execute(query)
+            query = 'DELETE FROM montanha_collectionprogress WHERE collection_run_id = {0}'.format(crid)
+            cursor.execute(query)
             if remove_run:
+                query = ('UPDATE montanha_archivedexpense SET checkpoint_id = NULL WHERE checkpoint_id IN '
+                         '(SELECT id FROM montanha_collectioncheckpoint WHERE collection_run_id = {0})'.format(crid))
+                cursor.execute(query)
+                query = 'DELETE FROM montanha_collectioncheckpoint WHERE collection_run_id = {0}'.format(crid)
+                cursor.execute(query)
                 query = 'DELETE FROM montanha_collectionrun WHERE id = {0}'.format(crid)
                 cursor.execute(query)
 
@@ -121,39 +469,111 @@ class BaseCollector(object):
                                               legislature=self.legislature):
             for year in range(self.legislature.date_start.year, datetime.now().year + 1):
                 self.update_data_for_year(mandate, year)
-
-    def retrieve_uri(self, uri, data=None, headers=None, post_process=True, force_encoding=None, return_content=False):
-        retries = 0
-
+        self.save_checkpoints()
+
+    def session_for(self, uri):
+        # Reusing a session per host keeps its connections alive across
+        # requests, instead of opening a new one for every retrieval.
+        host = urlsplit(uri).netloc
+        with self.sessions_lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update(self.default_headers)
+
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.http_pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def is_closed_month(self, year, month):
+        # Houses still amend recent months, so only older ones are closed.
+        month_end = date(year + month // 12, month % 12 + 1, 1)
+        return (date.today() - month_end).days >= self.closed_month_grace
+
+    def retrieve_uri(self, uri, data=None, headers=None, post_process=True, force_encoding=None, return_content=False,
+                     closed=False, return_response=False):
         pargs = (uri, unicode(data), unicode(headers), int(post_process), unicode(force_encoding))
         self.debug(u"Retrieving %s data: %s headers: %s post_process? %d force_encoding: %s" % pargs)
 
-        while retries < self.max_tries:
+        method = 'POST' if data else 'GET'
+        entry = self.http_cache.get(method, uri, data) if self.http_cache else None
+
+        if entry and closed:
+            self.debug(u"Using cached copy of %s" % uri)
+            r = entry.response()
+        else:
+            if entry:
+                headers = dict(headers or {}, **entry.validators())
+
+            r = self.request_with_retries(uri, data, headers)
+
+            if entry and r.status_code == requests.codes.not_modified:
+                self.debug(u"Cached copy of %s is still valid" % uri)
+                r.close()
+                r = entry.response()
+            elif self.http_cache and r.status_code == requests.codes.ok:
+                if closed or 'ETag' in r.headers or 'Last-Modified' in r.headers:
+                    self.http_cache.store(method, uri, data, r)
+
+        if force_encoding:
+            r.encoding = force_encoding
+        if return_response:
+            # Lets the collector stream the body; it closes the response.
+            return r
+
+        with closing(r):
+            if post_process:
+                return self.post_process_uri(r.text)
+            elif return_content:
+                return r.content
+            else:
+                return r.text
+
+    def request_with_retries(self, uri, data=None, headers=None):
+        policy = self.retry_policy
+        host = urlsplit(uri).netloc
+
+        for attempt in range(policy.max_tries):
+            policy.wait(host)
+
             try:
                 options = dict(data=data, headers=headers, timeout=self.default_timeout, stream=True)
+                session = self.session_for(uri)
                 if data:
-                    r = requests.post(uri, **options)
-                else:
-                    r = requests.get(uri, **options)
-
-                if force_encoding:
-                    r.encoding = force_encoding
-                if r.status_code == requests.codes.not_found:
-                    raise
-                if post_process:
-                    return self.post_process_uri(r.text)
-                elif return_content:
-                    return r.content
+                    r = session.post(uri, **options)
                 else:
-                    return r.text
-
+                    r = session.get(uri, **options)
             except requests.exceptions.RequestException:
-                retries += 1
-                print "Unable to retrieve %s try(%d) - will try again in %d seconds." % (uri, retries, self.try_again_timer)
-
-            time.sleep(self.try_again_timer)
-
-        raise RuntimeError("Error: Unable to retrieve %s; Tried %d times." % (uri, self.max_tries))
+                r = None
+            else:
+                if r.status_code < 400:
+                    policy.succeeded(host)
+                    return r
+                # The body of a failed response is never read, so its
+                # connection goes back to the pool right away.
+                r.close()
+                if not policy.retryable(r):
+                    # Client errors such as a missing page will not go away
+                    # by trying again.
+                    message = "%d Error: Unable to retrieve %s" % (r.status_code, uri)
+                    raise requests.exceptions.HTTPError(message, response=r)
+
+            delay = policy.failed(host, attempt, r)
+            print "Unable to retrieve %s try(%d) - will try again in %.1f seconds." % (uri, attempt + 1, delay)
+            time.sleep(delay)
+
+        raise RuntimeError("Error: Unable to retrieve %s; Tried %d times." % (uri, policy.max_tries))
+
+    def retrieve_many(self, requests):
+        """Retrieves (key, uri, options) requests concurrently.
+
+        Yields (key, result) as each retrieval completes, where result is
+        what retrieve_uri(uri, **options) returns.
+        """
+        fetcher = Fetcher(self.retrieve_uri, workers=self.fetch_workers, per_host=self.fetch_per_host)
+        return fetcher.fetch(requests)
 
     def normalize_party_name(self, name):
         names_map = {
@@ -174,12 +594,55 @@ class BaseCollector(object):
     def normalize_cnpj_or_cpf(self, identifier):
         return identifier.replace('.', '').replace('-', '').replace('/', '').strip()
 
+    def load_suppliers(self):
+        # Maps identifiers to ids, the oldest supplier wins for duplicates.
+        suppliers = Supplier.objects.order_by('-id').values_list('identifier', 'id')
+        self.suppliers = dict(suppliers.iterator())
+
     def get_or_create_supplier(self, identifier, name=None):
+        # Returns a Supplier with only its id and identifier loaded, which is
+        # all expenses need. New suppliers are only saved when expenses are
+        # flushed, see flush_suppliers().
         identifier = self.normalize_cnpj_or_cpf(identifier)
-        try:
-            supplier = Supplier.objects.get(identifier=identifier)
-        except Supplier.DoesNotExist:
+
+        if self.suppliers is None:
+            self.load_suppliers()
+
+        supplier_id = self.suppliers.get(identifier)
+        if supplier_id is not None:
+            return Supplier(id=supplier_id, identifier=identifier)
+
+        supplier = self.new_suppliers.get(identifier)
+        if supplier is None:
             supplier = Supplier(identifier=identifier, name=name)
-            supplier.save()
+            self.new_suppliers[identifier] = supplier
             self.debug(u'New supplier found: {0}'.format(unicode(supplier)))
         return supplier
+
+    def lookup_suppliers(self, identifiers):
+        for i in range(0, len(identifiers), SUPPLIERS_LOOKUP_SIZE):
+            suppliers = Supplier.objects \
+                .filter(identifier__in=identifiers[i:i + SUPPLIERS_LOOKUP_SIZE]) \
+                .order_by('-id') \
+                .values_list('identifier', 'id')
+            self.suppliers.update(suppliers)
+
+    def flush_suppliers(self):
+        if not self.new_suppliers:
+            return
+
+        with self.write_lock:
+            # Other collectors may have created some of them since ours
+            # were loaded.
+            self.lookup_suppliers(self.new_suppliers.keys())
+            missing = [identifier for identifier in self.new_suppliers if identifier not in self.suppliers]
+
+            # bulk_create() does not set primary keys on every database, so
+            # we look them up afterwards.
+            Supplier.objects.bulk_create([self.new_suppliers[identifier] for identifier in missing],
+                                         batch_size=self.expenses_batch_size)
+            self.lookup_suppliers(missing)
+
+        for identifier, supplier in self.new_suppliers.items():
+            supplier.id = self.suppliers[identifier]
+        self.new_suppliers = {}
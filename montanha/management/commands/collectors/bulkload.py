@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2010-2013 Gustavo Noronha Silva
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from io import BytesIO
+
+from django.db import connection
+
+
+class BulkLoader(object):
+    """Inserts model instances with as few statements as possible.
+
+    The base loader sends each batch as a single insert with one row of
+    values per instance. Subclasses use the fastest way a database has of
+    loading many rows, see `loader_for()`. Primary keys are left for the
+    database to assign and are not set on the instances.
+    """
+
+    def __init__(self, model, connection=connection):
+        self.connection = connection
+        self.table = model._meta.db_table
+        self.fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+
+    @property
+    def columns(self):
+        quote = self.connection.ops.quote_name
+        return ", ".join(quote(f.column) for f in self.fields)
+
+    def values(self, obj):
+        return [f.get_db_prep_save(getattr(obj, f.attname), self.connection) for f in self.fields]
+
+    def load(self, objects, batch_size=1000):
+        with self.connection.cursor() as cursor:
+            for i in range(0, len(objects), batch_size):
+                self.load_batch(cursor, objects[i:i + batch_size])
+
+    def load_batch(self, cursor, objects):
+        row = "(%s)" % ", ".join(["%s"] * len(self.fields))
+        params = list()
+        for obj in objects:
+            params.extend(self.values(obj))
+        cursor.execute("insert into %s (%s) values %s" % (
+            self.connection.ops.quote_name(self.table), self.columns, ", ".join([row] * len(objects))
+        ), params)
+
+
+class SQLiteBulkLoader(BulkLoader):
+    # SQLite takes at most 999 parameters per statement, but reuses a
+    # single prepared statement for every row given to executemany().
+    def load_batch(self, cursor, objects):
+        cursor.executemany("insert into %s (%s) values (%s)" % (
+            self.connection.ops.quote_name(self.table), self.columns, ", ".join(["%s"] * len(self.fields))
+        ), [self.values(obj) for obj in objects])
+
+
+class PostgreSQLBulkLoader(BulkLoader):
+    # Streams each batch through COPY, in its text format.
+    def load_batch(self, cursor, objects):
+        data = BytesIO()
+        for obj in objects:
+            line = u"\t".join(self.copy_value(value) for value in self.values(obj))
+            data.write(line.encode('utf-8') + b"\n")
+        data.seek(0)
+
+        cursor.copy_expert("copy %s (%s) from stdin" % (
+            self.connection.ops.quote_name(self.table), self.columns
+        ), data)
+
+    def copy_value(self, value):
+        if value is None:
+            return u"\\N"
+        if isinstance(value, bool):
+            return u"t" if value else u"f"
+        if isinstance(value, float):
+            value = repr(value)
+        return unicode(value).replace(u"\\", u"\\\\").replace(u"\t", u"\\t") \
+                             .replace(u"\n", u"\\n").replace(u"\r", u"\\r")
+
+
+LOADERS = {
+    'sqlite': SQLiteBulkLoader,
+    'postgresql': PostgreSQLBulkLoader,
+}
+
+
+def loader_for(model, connection=connection):
+    # MySQL, like any other database, uses multi-row inserts.
+    return LOADERS.get(connection.vendor, BulkLoader)(model, connection)
+
+
+def bulk_load(model, objects, batch_size=1000):
+    loader_for(model).load(objects, batch_size=batch_size)
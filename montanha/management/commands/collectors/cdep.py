@@ -17,66 +17,220 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cPickle as pickle
+import errno
 import os
 import requests
-import threading
+import tempfile
+import traceback
+from contextlib import closing
 from datetime import date, datetime
 from zipfile import ZipFile
-from Queue import Queue, Empty
-from django.db import reset_queries, connection
 from email.utils import formatdate as http_date
 from lxml.etree import iterparse
+from multiprocessing import Process, Queue
+from Queue import Empty
 
 from basecollector import BaseCollector
 from montanha.models import (
-    Institution, Legislature, Legislator,
-    AlternativeLegislatorName, ExpenseNature, PoliticalParty,
+    ArchivedExpense, Institution, Legislature, Legislator,
+    ExpenseNature, PoliticalParty,
 )
 
 
-OBJECT_LIST_MAXIMUM_COUNTER = 1000
+# Entries sent by the parsing processes in each batch, and batches waiting
+# for the collector; when full, the parsers wait for it to catch up.
+PARSE_BATCH_SIZE = 1000
+PARSE_QUEUE_SIZE = 16
 
+# Bumped whenever the rows parsed from an entry change, so that cached
+# rows are parsed again.
+PARSED_CACHE_VERSION = 1
 
-def db_thread(cdep):
-    cursor = connection.cursor()
-    query = u'INSERT INTO `montanha_archivedexpense` '
-    query += u'(`original_id`, `number`, `nature_id`, `date`, `value`, `expensed`, `mandate_id`, `supplier_id`, `collection_run_id`) '
-    query += u'VALUES (NULL, %(number)s, %(nature)s, %(date)s, NULL, %(expensed)s, %(mandate)s, %(supplier)s, %(collection_run)s)'
 
-    data_to_insert = []
-    force_insert = False
-    while True:
-        # If empty, we want to force inserting what we already have and
-        # let the queue know we are done.
-        try:
-            data = cdep.db_queue.get(timeout=2)
-            cdep.debug(u"New expense found: %s" % unicode(data))
-            data_to_insert.append(data)
-        except Empty:
-            force_insert = True
+def cleanup_element(elem):
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
 
-        if force_insert or len(data_to_insert) == OBJECT_LIST_MAXIMUM_COUNTER:
-            # To help with debug mode using up memory for query logs.
-            reset_queries()
-            force_insert = False
 
-            if cdep.db_queue.qsize() or data_to_insert:
-                cdep.info('Queue size: {} rows to insert: {}'.format(cdep.db_queue.qsize(), len(data_to_insert)))
+def parse_expense(elem, years):
+    """Extracts the fields of a DESPESA element as a tuple of plain values.
 
-            cursor.executemany(query, data_to_insert)
-            for d in data_to_insert:
-                cdep.db_queue.task_done()
-            data_to_insert[:] = []
+    Returns None for entries outside of the legislature starting and
+    ending in the given years.
+    """
+    first_year, last_year = years
 
+    # Some entries lack numLegislatura, so we fallback to numAno.
+    legislature_year = elem.find('nuLegislatura').text
+    if legislature_year is not None:
+        legislature_year = int(legislature_year)
+    else:
+        legislature_year = int(elem.find('numAno').text)
+        if legislature_year < first_year or legislature_year > last_year:
+            legislature_year = None
+        else:
+            legislature_year = first_year
 
-def cleanup_element(elem):
-    elem.clear()
-    while elem.getprevious() is not None:
-        del elem.getparent()[0]
+    if legislature_year != first_year:
+        return None
+
+    name = elem.find('txNomeParlamentar').text.title().strip()
+
+    nature_name = elem.find('txtDescricao').text.title().strip()
+
+    supplier_name = elem.find('txtBeneficiario')
+    if supplier_name is not None:
+        supplier_name = supplier_name.text.title().strip()
+    else:
+        supplier_name = u'Sem nome'
+
+    supplier_identifier = elem.find('txtCNPJCPF')
+    if supplier_identifier is not None and supplier_identifier.text is not None:
+        supplier_identifier = supplier_identifier.text
+
+    if not supplier_identifier:
+        supplier_identifier = u'Sem CNPJ/CPF (%s)' % supplier_name
+
+    docnumber = elem.find('txtNumero').text
+    if docnumber:
+        docnumber = docnumber.strip()
+    else:
+        docnumber = ''
+
+    expense_date = elem.find('datEmissao')
+    if expense_date and expense_date.text is not None:
+        expense_date = date(*((int(x.lstrip('0')) for x in expense_date.text[:10].split('-'))))
+    else:
+        expense_year = int(elem.find('numAno').text)
+        expense_month = int(elem.find('numMes').text)
+        expense_date = date(expense_year, expense_month, 1)
+
+    expensed = float(elem.find('vlrLiquido').text)
+
+    party_siglum = elem.find('sgPartido').text
+
+    state = elem.find('sgUF').text.strip()
+
+    if elem.find('ideCadastro') is None:
+        original_id = elem.find('idecadastro').text.strip()
+    else:
+        original_id = elem.find('ideCadastro').text.strip()
+
+    return (name, nature_name, supplier_identifier, supplier_name, docnumber,
+            expense_date, expensed, party_siglum, state, original_id)
+
+
+class ParsedCache(object):
+    """Keeps the rows parsed from a file of the zip archives on disk.
+
+    Entries are keyed by the CRC and size the archive records for the file,
+    so an unchanged file is read back as batches of rows instead of being
+    parsed again. Only the latest entry of each file is kept.
+    """
+
+    def __init__(self, path, xml_file_name, info, years):
+        self.path = path
+        self.prefix = xml_file_name + '-'
+        self.name = '{0}v{1}-{2:08x}-{3}-{4}-{5}.pickle'.format(
+            self.prefix, PARSED_CACHE_VERSION, info.CRC, info.file_size, *years
+        )
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, self.name))
+
+    def read(self):
+        with open(os.path.join(self.path, self.name), 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def store(self, batches):
+        # Passes the batches through while writing them, the entry is only
+        # put in place once all of them were written.
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for rows in batches:
+                    pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+                    yield rows
+            os.rename(tmp_path, os.path.join(self.path, self.name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        for name in os.listdir(self.path):
+            if name.startswith(self.prefix) and name != self.name:
+                os.unlink(os.path.join(self.path, name))
+
+
+def parse_batches(xml_file, years):
+    rows = []
+    position = 0
+    for event, elem in iterparse(xml_file, events=("start", "end")):
+        if event != "end" or elem.tag != "DESPESA":
+            continue
+
+        position += 1
+        row = parse_expense(elem, years)
+        if row is not None:
+            rows.append((position,) + row)
+        cleanup_element(elem)
+
+        if len(rows) >= PARSE_BATCH_SIZE:
+            yield rows
+            rows = []
+
+    if rows:
+        yield rows
+
+
+def parse_task(zip_path, xml_file_name, done, years, queue, cache_path=None):
+    # Runs in a process of its own for each file, sending the entries it
+    # finds in batches of tuples; entries up to `done` were collected by
+    # an interrupted run and are skipped. Even those are parsed when the
+    # file is not in the cache, so that its entry is complete.
+    try:
+        zf = ZipFile(zip_path, 'r')
+
+        cache = None
+        if cache_path is not None:
+            cache = ParsedCache(cache_path, xml_file_name, zf.getinfo(xml_file_name), years)
+
+        xml_file = None
+        if cache is not None and cache.exists():
+            batches = cache.read()
+        else:
+            xml_file = zf.open(xml_file_name)
+            batches = parse_batches(xml_file, years)
+            if cache is not None:
+                batches = cache.store(batches)
+
+        for rows in batches:
+            rows = [row for row in rows if row[0] > done]
+            if rows:
+                queue.put(('rows', xml_file_name, rows))
+
+        if xml_file is not None:
+            xml_file.close()
+        zf.close()
+
+        queue.put(('done', xml_file_name, None))
+    except Exception:
+        queue.put(('error', xml_file_name, traceback.format_exc()))
 
 
 class CamaraDosDeputados(BaseCollector):
-    db_queue = Queue(maxsize=5000)
+    resumable = True
 
     def __init__(self, collection_runs, debug_enabled=False):
         super(CamaraDosDeputados, self).__init__(collection_runs, debug_enabled)
@@ -110,7 +264,7 @@ class CamaraDosDeputados(BaseCollector):
             name = name.text.title().strip()
 
             self.debug(u"Looking for legislator: %s" % unicode(name))
-            legislator, created = Legislator.objects.get_or_create(name=name)
+            legislator, created = self.get_or_create_legislator(name)
 
             if created:
                 self.debug(u"New legislator: %s" % unicode(legislator))
@@ -118,11 +272,7 @@ class CamaraDosDeputados(BaseCollector):
                 self.debug(u"Found existing legislator: %s" % unicode(legislator))
 
             if alternative_name:
-                try:
-                    legislator.alternative_names.get(name=alternative_name)
-                except AlternativeLegislatorName.DoesNotExist:
-                    alternative_name, _ = AlternativeLegislatorName.objects.get_or_create(name=alternative_name)
-                    legislator.alternative_name = alternative_name
+                self.add_alternative_name(legislator, alternative_name)
 
             legislator.email = l.find('email').text
             legislator.save()
@@ -136,14 +286,57 @@ class CamaraDosDeputados(BaseCollector):
 
             self.mandate_for_legislator(legislator, party, state=state, original_id=original_id)
 
-    def update_data(self):
-        if os.path.exists('cdep-collection-run'):
-            crid = int(open('cdep-collection-run').read())
-            self.remove_collection_run(crid)
-            os.unlink('cdep-collection-run')
+    def parsed_rows(self, files, years, cache_path=None):
+        """Yields (unit, row) for the entries of each (zip, xml, done) file.
+
+        Each file is parsed by a process of its own, so the rows of
+        different files come interleaved; the rows of a file come in order.
+        Rows are cached in `cache_path`, when given, see ParsedCache.
+        """
+        # The parsers never touch the database, so unlike the collectors
+        # they can share the connection they inherit.
+        queue = Queue(maxsize=PARSE_QUEUE_SIZE)
+        processes = dict()
+        for zip_path, xml_file_name, done in files:
+            self.debug(u"Processing %s…" % xml_file_name)
+            process = Process(target=parse_task, args=(zip_path, xml_file_name, done, years, queue, cache_path),
+                              name='parse-{0}'.format(xml_file_name))
+            process.daemon = True
+            process.start()
+            processes[xml_file_name] = process
+
+        pending = set(processes)
+        try:
+            while pending:
+                try:
+                    message = queue.get(timeout=1)
+                except Empty:
+                    for unit in list(pending):
+                        if not processes[unit].is_alive():
+                            raise RuntimeError(u"Parser for %s exited unexpectedly" % unit)
+                    continue
 
+                kind, unit, payload = message
+                if kind == 'rows':
+                    for row in payload:
+                        yield unit, row
+                elif kind == 'done':
+                    pending.discard(unit)
+                elif kind == 'error':
+                    raise RuntimeError(u"Failed to parse %s:\n%s" % (unit, payload))
+        finally:
+            # Parsers left behind may be blocked on the full queue.
+            for process in processes.values():
+                if process.is_alive() and pending:
+                    process.terminate()
+                process.join()
+
+    def update_data(self):
         self.collection_run = self.create_collection_run(self.legislature)
 
+        # A resumed run must read the same files it started with.
+        resumed = bool(self.progress)
+
         data_path = os.path.join(os.getcwd(), 'data', 'cdep')
         if not os.path.isdir(data_path):
             os.makedirs(data_path)
@@ -161,10 +354,17 @@ class CamaraDosDeputados(BaseCollector):
         files_to_process = list()
         for file_name in files_to_download:
             xml_file_name = file_name.replace('zip', 'xml')
+            full_path = os.path.join(data_path, file_name)
+            files_to_process.append((full_path, xml_file_name))
+
+            # The XML is now read straight from the zip file, copies
+            # extracted by earlier versions are no longer needed.
             full_xml_path = os.path.join(data_path, xml_file_name)
-            files_to_process.append(os.path.join(data_path, full_xml_path))
+            if os.path.exists(full_xml_path):
+                os.unlink(full_xml_path)
 
-            full_path = os.path.join(data_path, file_name)
+            if resumed and os.path.exists(full_path):
+                continue
 
             headers = dict()
             if os.path.exists(full_path):
@@ -172,146 +372,79 @@ class CamaraDosDeputados(BaseCollector):
 
             uri = 'http://www.camara.gov.br/cotas/' + file_name
             self.debug(u"Preparing to download %s…" % (uri))
-            r = requests.get(uri, headers=headers, stream=True)
-
-            if r.status_code == requests.codes.not_modified:
-                self.debug(u"File %s not updated since last download, skipping…" % file_name)
-                continue
-
-            with open(full_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-
-            self.debug(u"Unzipping %s…" % (file_name))
-            zf = ZipFile(full_path, 'r')
-            zf.extract(xml_file_name, data_path)
-
-        with open('cdep-collection-run', 'w') as fh:
-            fh.write('%d' % (self.collection_run.id))
-
-        for i in range(2):
-            db_worker = threading.Thread(name='db-worker-{}'.format(i), target=db_thread, args=(self,))
-            db_worker.daemon = True
-            db_worker.start()
-
-        legislators = {}
-        parties = {}
-        natures = {}
-        for file_name in reversed(files_to_process):
-            self.debug(u"Processing %s…" % file_name)
-
-            context = iterparse(file_name, events=("start", "end"))
-
-            # turn it into an iterator
-            context = iter(context)
-
-            for event, elem in context:
-                if event != "end" or elem.tag != "DESPESA":
-                    continue
-
-                # Some entries lack numLegislatura, so we fallback to numAno.
-                legislature_year = elem.find('nuLegislatura').text
-                if legislature_year is not None:
-                    legislature_year = int(legislature_year)
-                else:
-                    legislature_year = int(elem.find('numAno').text)
-                    if legislature_year < self.legislature.date_start.year or \
-                       legislature_year > self.legislature.date_end.year:
-                        legislature_year = None
-                    else:
-                        legislature_year = self.legislature.date_start.year
-
-                if legislature_year != self.legislature.date_start.year:
-                    self.debug(u"Ignoring entry because it's out of the target legislature…")
-                    cleanup_element(elem)
+            r = self.session_for(uri).get(uri, headers=headers, stream=True)
+            with closing(r):
+                if r.status_code == requests.codes.not_modified:
+                    self.debug(u"File %s not updated since last download, skipping…" % file_name)
                     continue
 
-                name = elem.find('txNomeParlamentar').text.title().strip()
-
-                nature_name = elem.find('txtDescricao').text.title().strip()
-
-                supplier_name = elem.find('txtBeneficiario')
-                if supplier_name is not None:
-                    supplier_name = supplier_name.text.title().strip()
-                else:
-                    supplier_name = u'Sem nome'
-
-                supplier_identifier = elem.find('txtCNPJCPF')
-                if supplier_identifier is not None and supplier_identifier.text is not None:
-                    supplier_identifier = supplier_identifier.text
+                # An error page must not replace the archive we already have,
+                # nor should a download that fails midway.
+                r.raise_for_status()
 
-                if not supplier_identifier:
-                    supplier_identifier = u'Sem CNPJ/CPF (%s)' % supplier_name
-
-                supplier = self.get_or_create_supplier(supplier_identifier, supplier_name)
-
-                docnumber = elem.find('txtNumero').text
-                if docnumber:
-                    docnumber = docnumber.strip()
-                else:
-                    docnumber = ''
-
-                expense_date = elem.find('datEmissao')
-                if expense_date and expense_date.text is not None:
-                    expense_date = date(*((int(x.lstrip('0')) for x in expense_date.text[:10].split('-'))))
-                else:
-                    expense_year = int(elem.find('numAno').text)
-                    expense_month = int(elem.find('numMes').text)
-                    expense_date = date(expense_year, expense_month, 1)
-
-                expensed = float(elem.find('vlrLiquido').text)
-
-                # memory cache
-                nature = natures.get(nature_name)
-                if not nature:
-                    nature, _ = ExpenseNature.objects.get_or_create(name=nature_name)
-                    natures[nature_name] = nature
-
-                # memory cache
-                party_siglum = elem.find('sgPartido').text
+                fd, tmp_path = tempfile.mkstemp(dir=data_path)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=8192):
+                            if chunk:
+                                f.write(chunk)
+                    os.rename(tmp_path, full_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+
+        # Files are parsed in processes of their own, we only resolve the
+        # names they find against maps of what is already in the database.
+        natures = dict((n.name, n) for n in ExpenseNature.objects.all())
+        parties = dict((p.siglum, p) for p in PoliticalParty.objects.all())
+        if self.legislators is None:
+            self.load_legislators()
+        if self.suppliers is None:
+            self.load_suppliers()
+
+        files = [(path, name, self.progress.get(name, 0)) for path, name in reversed(files_to_process)]
+        years = (self.legislature.date_start.year, self.legislature.date_end.year)
+
+        cache_path = os.path.join(data_path, 'parsed-cache')
+        for unit, row in self.parsed_rows(files, years, cache_path):
+            (position, name, nature_name, supplier_identifier, supplier_name, docnumber,
+             expense_date, expensed, party_siglum, state, original_id) = row
+
+            supplier = self.get_or_create_supplier(supplier_identifier, supplier_name)
+
+            nature = natures.get(nature_name)
+            if not nature:
+                nature, _ = self.get_or_create_nature(nature_name)
+                natures[nature_name] = nature
+
+            party = None
+            if party_siglum is not None:
                 party = parties.get(party_siglum)
-                if not party and party_siglum is not None:
-                    party_siglum = self.normalize_party_name(party_siglum)
-                    party, _ = PoliticalParty.objects.get_or_create(siglum=party_siglum)
+                if not party:
+                    party, _ = PoliticalParty.objects.get_or_create(
+                        siglum=self.normalize_party_name(party_siglum))
                     parties[party_siglum] = party
 
-                state = elem.find('sgUF').text.strip()
-
-                if elem.find('ideCadastro') is None:
-                    original_id = elem.find('idecadastro').text.strip()
-                else:
-                    original_id = elem.find('ideCadastro').text.strip()
-
-                # memory cache
-                legislator = legislators.get(name)
-                if not legislator:
-                    try:
-                        legislator = Legislator.objects.get(name__iexact=name)
-                    except Legislator.DoesNotExist:
-                        # Some legislators do are not listed in the other WS because they are not
-                        # in exercise.
-                        self.debug(u"Found legislator who's not in exercise: %s" % name)
-                        legislator = Legislator(name=name)
-                        legislator.save()
-                    legislators[name] = legislator
-
-                mandate = self.mandate_for_legislator(legislator, party,
-                                                      state=state, original_id=original_id)
-
-                # Model objects should not cross thread boundaries
-                self.db_queue.put(
-                    dict(
-                        number=docnumber,
-                        nature=nature.id,
-                        date=expense_date,
-                        expensed=expensed,
-                        mandate=mandate.id,
-                        supplier=supplier.id,
-                        collection_run=self.collection_run.id,
-                    )
-                )
-
-                cleanup_element(elem)
-
-        os.unlink('cdep-collection-run')
+            legislator, created = self.get_or_create_legislator(name)
+            if created:
+                # Some legislators do are not listed in the other WS because they are not
+                # in exercise.
+                self.debug(u"Found legislator who's not in exercise: %s" % name)
+
+            mandate = self.mandate_for_legislator(legislator, party,
+                                                  state=state, original_id=original_id)
+
+            expense = ArchivedExpense(
+                number=docnumber,
+                nature=nature,
+                date=expense_date,
+                expensed=expensed,
+                mandate=mandate,
+                supplier=supplier,
+                collection_run=self.collection_run,
+            )
+            self.add_expense(expense)
+            self.mark_progress(unit, position)
+            self.debug(u"New expense found: %s %s %s" % (docnumber, expense_date, expensed))
+
+        self.flush_expenses()
@@ -21,8 +21,9 @@ import time
 from datetime import datetime, date
 
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from montanha.models import (
-    Institution, Legislature, ExpenseNature, Legislator, ArchivedExpense
+    Institution, Legislature, ArchivedExpense
 )
 
 
@@ -44,6 +45,7 @@ MAX_PENDING = 100
 class CMBH(BaseCollector):
     def __init__(self, collection_runs, debug_enabled=False):
         super(CMBH, self).__init__(collection_runs, debug_enabled)
+        self.http_cache = HTTPCache.for_house('cmbh')
 
         self.institution, _ = Institution.objects.get_or_create(
             siglum='CMBH', name=u'Câmara Municipal de Belo Horizonte'
@@ -55,6 +57,12 @@ class CMBH(BaseCollector):
             date_end=datetime(2016, 12, 31)
         )
 
+        self.default_headers = {
+            'Origin': 'https://www.cmbh.mg.gov.br',
+            'Referer': 'https://www.cmbh.mg.gov.br/transparencia/verba-indenizatoria',
+        }
+        self.http_pool_size = NUM_THREADS
+
         self.download_threads = []
         for x in range(NUM_THREADS):
             thread = threading.Thread(target=self._download_thread)
@@ -102,20 +110,12 @@ class CMBH(BaseCollector):
     def retrieve_month(self, month, year):
         uri = 'https://www.cmbh.mg.gov.br/transparencia/vereadores/verba-indenizatoria'
         data = {'codVereadorVI': '', 'mes': '{:0>2}'.format(month), 'ano': year}
-        headers = {
-            'Origin': 'https://www.cmbh.mg.gov.br',
-            'Referer': 'https://www.cmbh.mg.gov.br/transparencia/verba-indenizatoria',
-        }
-        return BaseCollector.retrieve_uri(self, uri, data, headers)
+        return BaseCollector.retrieve_uri(self, uri, data, closed=self.is_closed_month(year, month))
 
     def retrieve_actual_data(self, code, month, year):
         uri = 'https://www.cmbh.mg.gov.br/transparencia/vereadores/verba-indenizatoria'
         data = {'codVereadorVI': '', 'mes': '{:0>2}'.format(month), 'ano': year, 'vereador': code}
-        headers = {
-            'Origin': 'https://www.cmbh.mg.gov.br',
-            'Referer': 'https://www.cmbh.mg.gov.br/transparencia/verba-indenizatoria',
-        }
-        return BaseCollector.retrieve_uri(self, uri, data, headers)
+        return BaseCollector.retrieve_uri(self, uri, data, closed=self.is_closed_month(year, month))
 
     def update_legislators(self):
         pass
@@ -156,7 +156,7 @@ class CMBH(BaseCollector):
 
         legislator = data.find('h2').findChildren()[0].next
         legislator = self._normalize_name(legislator)
-        legislator, created = Legislator.objects.get_or_create(name=legislator)
+        legislator, created = self.get_or_create_legislator(legislator)
 
         if created:
             self.debug("New legislator: %s" % unicode(legislator))
@@ -167,7 +167,7 @@ class CMBH(BaseCollector):
 
         natures = data.findAll('h3')
         for data in natures:
-            nature, _ = ExpenseNature.objects.get_or_create(name=self._normalize_nature(data.text))
+            nature, _ = self.get_or_create_nature(self._normalize_nature(data.text))
             rows = data.findNext().findAll('tr')[1:-1]
             for row in rows:
                 columns = row.findAll('td')
@@ -197,7 +197,7 @@ class CMBH(BaseCollector):
                                           mandate=mandate,
                                           supplier=supplier,
                                           collection_run=self.collection_run)
-                expense.save()
+                self.add_expense(expense)
 
                 self.debug("New expense found: %s" % unicode(expense))
 
@@ -235,6 +235,8 @@ class CMBH(BaseCollector):
             thread.join()
         self.download_threads = []
 
+        self.flush_expenses()
+
     def update_data_for_year(self, year=datetime.now().year):
         for month in range(1, 13):
             data = self.retrieve_month(month, year)
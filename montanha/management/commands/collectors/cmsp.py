@@ -22,8 +22,9 @@ from datetime import datetime
 from django.core.files import File
 
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from montanha.models import (
-    Institution, Legislator, Mandate, PoliticalParty, ExpenseNature,
+    Institution, PoliticalParty,
     ArchivedExpense, Legislature
 )
 
@@ -46,6 +47,7 @@ def parse_cmsp_date(month, year):
 class CMSP(BaseCollector):
     def __init__(self, collection_runs, debug_enabled=False):
         super(CMSP, self).__init__(collection_runs, debug_enabled)
+        self.http_cache = HTTPCache.for_house('cmsp')
 
         institution, institution_created = Institution.objects.get_or_create(
             siglum='CMSP',
@@ -53,6 +55,12 @@ class CMSP(BaseCollector):
 
         self.institution = institution
 
+        # Expenses are only collected for the current legislature.
+        self.legislature, _ = Legislature.objects.get_or_create(
+            institution=institution,
+            date_start=datetime(2013, 1, 1),
+            date_end=datetime(2016, 12, 31))
+
     def _normalize_party_siglum(self, siglum):
         names_map = {
             'DEMOCRATAS': 'DEM',
@@ -60,14 +68,16 @@ class CMSP(BaseCollector):
         return names_map.get(siglum, siglum)
 
     def retrieve_expenses(self, month, year):
+        closed = self.is_closed_month(year, month)
         month = '%02d' % month
         uri = 'http://www2.camara.sp.gov.br/sisgv/Arquivos/%s%s.XML' % (year, month)
-        return BaseCollector.retrieve_uri(self, uri, force_encoding='utf-8')
+        return BaseCollector.retrieve_uri(self, uri, force_encoding='utf-8', closed=closed)
 
     def retrieve_expenses_obsolete(self, month, year):
+        closed = self.is_closed_month(year, month)
         month = '%02d' % month
         uri = 'http://www.camara.sp.gov.br/wp-content/uploads/transparencia/saeg/%s%s.XML' % (year, month)
-        return BaseCollector.retrieve_uri(self, uri, force_encoding='utf-8')
+        return BaseCollector.retrieve_uri(self, uri, force_encoding='utf-8', closed=closed)
 
     def retrieve_legislators(self):
         uri = 'http://www1.camara.sp.gov.br/vereadores_joomla.asp'
@@ -78,7 +88,7 @@ class CMSP(BaseCollector):
         return BaseCollector.retrieve_uri(self, uri)
 
     def add_legislator(self, name):
-        legislator, created = Legislator.objects.get_or_create(name=name)
+        legislator, created = self.get_or_create_legislator(name)
 
         if created:
             self.debug(u'New legislator found: %s' % legislator)
@@ -126,19 +136,7 @@ class CMSP(BaseCollector):
 
                 self.debug('Updating legislator picture.')
 
-            try:
-                mandate = Mandate.objects.get(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                self.debug(u'Found existing Mandate: %s' % mandate)
-            except Mandate.DoesNotExist:
-                mandate = Mandate(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                mandate.save()
-                self.debug(u'New Mandate found: %s' % mandate)
+            mandate = self.mandate_for_legislator(legislator, None, legislature=legislature)
 
             party_name = html_legislator.find(
                 'img',
@@ -153,9 +151,10 @@ class CMSP(BaseCollector):
                 party, party_created = PoliticalParty.objects.get_or_create(
                     siglum=party_siglum)
 
-                mandate.party = party
-                mandate.save()
-                self.debug('Updating legislator party: %s' % party_siglum)
+                if mandate.party_id != party.id:
+                    mandate.party = party
+                    mandate.save(update_fields=['party'])
+                    self.debug('Updating legislator party: %s' % party_siglum)
 
     def process_expenses(self, month, year, legislature, collection_run):
         if year < 2015:
@@ -177,19 +176,7 @@ class CMSP(BaseCollector):
             name = x.find('vereador').getText().capitalize()
             legislator = self.add_legislator(name)
 
-            try:
-                mandate = Mandate.objects.get(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                self.debug(u'Found existing Mandate: %s' % mandate)
-            except Mandate.DoesNotExist:
-                mandate = Mandate(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                mandate.save()
-                self.debug(u'New Mandate found: %s' % mandate)
+            mandate = self.mandate_for_legislator(legislator, None, legislature=legislature)
 
             nature_text = x.find('despesa').getText()
 
@@ -200,8 +187,7 @@ class CMSP(BaseCollector):
 
             nature_text = nature_text.capitalize()
 
-            nature, nature_created = ExpenseNature.objects.get_or_create(
-                name=nature_text)
+            nature, nature_created = self.get_or_create_nature(nature_text)
 
             if nature_created:
                 self.debug(u'New ExpenseNature found: %s' % nature)
@@ -230,7 +216,7 @@ class CMSP(BaseCollector):
                                       mandate=mandate,
                                       supplier=supplier,
                                       collection_run=collection_run)
-            expense.save()
+            self.add_expense(expense)
 
             self.debug(u'New expense found: %s' % expense)
 
@@ -243,19 +229,7 @@ class CMSP(BaseCollector):
             name = x.find('nm_deputado').getText().capitalize()
             legislator = self.add_legislator(name)
 
-            try:
-                mandate = Mandate.objects.get(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                self.debug(u'Found existing Mandate: %s' % mandate)
-            except Mandate.DoesNotExist:
-                mandate = Mandate(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-                mandate.save()
-                self.debug(u'New Mandate found: %s' % mandate)
+            mandate = self.mandate_for_legislator(legislator, None, legislature=legislature)
 
             expense_type = x.find('list_g_tipo_despesa')
 
@@ -273,8 +247,7 @@ class CMSP(BaseCollector):
                 if ignore_matches:
                     continue
 
-                nature, nature_created = ExpenseNature.objects.get_or_create(
-                    name=nature_text)
+                nature, nature_created = self.get_or_create_nature(nature_text)
 
                 if nature_created:
                     self.debug(u'New ExpenseNature found: %s' % nature)
@@ -304,7 +277,7 @@ class CMSP(BaseCollector):
                                               mandate=mandate,
                                               supplier=supplier,
                                               collection_run=collection_run)
-                    expense.save()
+                    self.add_expense(expense)
 
                     self.debug(u'New expense found: %s' % expense)
 
@@ -343,6 +316,8 @@ class CMSP(BaseCollector):
                 self.debug('Adding expenses from %s/%s' % (month, year))
                 self.process_expenses(month, year, legislature, collection_run)
 
+        self.flush_expenses()
+
     def process_current_legislators(self):
         current_legislature = self.get_legislature(2013)
         self.process_legislators(current_legislature)
@@ -387,23 +362,16 @@ class CMSP(BaseCollector):
 
                 legislature = self.get_legislature(start_year)
 
-                mandate, mandate_created = Mandate.objects.get_or_create(
-                    legislator=legislator,
-                    date_start=legislature.date_start,
-                    legislature=legislature)
-
-                if mandate_created:
-                    self.debug(u'New Mandate found: %s' % mandate)
-                else:
-                    self.debug(u'Found existing Mandate: %s' % mandate)
+                mandate = self.mandate_for_legislator(legislator, None, legislature=legislature)
 
                 if party_siglum and 'Sem' or 'Vereaores' not in party_siglum:
                     party, party_created = PoliticalParty.objects.get_or_create(
                         siglum=party_siglum)
 
-                    mandate.party = party
-                    mandate.save()
-                    self.debug('Updating legislator party: %s' % party)
+                    if mandate.party_id != party.id:
+                        mandate.party = party
+                        mandate.save(update_fields=['party'])
+                        self.debug('Updating legislator party: %s' % party)
 
     def update_data(self):
         self.process_all_legislators()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2010-2013 Gustavo Noronha Silva
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+from Queue import Queue, Empty, Full
+from urlparse import urlsplit
+
+from django.utils import six
+
+
+class Fetcher(object):
+    """Retrieves a batch of URIs from a bounded pool of threads.
+
+    Results are handed back as they complete, with at most `per_host`
+    requests running against the same host at any time.
+    """
+
+    def __init__(self, retrieve, workers=8, per_host=4):
+        self.retrieve = retrieve
+        self.workers = workers
+        self.per_host = per_host
+
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+
+    def host_semaphore(self, uri):
+        host = urlsplit(uri).netloc
+        with self.hosts_lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def worker(self, pending, done, stopped):
+        while not stopped.is_set():
+            try:
+                key, uri, options = pending.get_nowait()
+            except Empty:
+                return
+
+            try:
+                with self.host_semaphore(uri):
+                    result = (key, self.retrieve(uri, **options), None)
+            except Exception:
+                result = (key, None, sys.exc_info())
+
+            # The queue of results is bounded, so that we do not download
+            # much faster than the collector can process.
+            while not stopped.is_set():
+                try:
+                    done.put(result, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+    def fetch(self, requests):
+        """Yields (key, result) for each (key, uri, options) request.
+
+        Options are passed on to the retrieve function. Errors are raised
+        when their result would be yielded, and the remaining requests
+        are cancelled.
+        """
+        pending = Queue()
+        for request in requests:
+            pending.put(request)
+
+        count = pending.qsize()
+        if not count:
+            return
+
+        done = Queue(maxsize=self.workers * 2)
+        stopped = threading.Event()
+
+        threads = []
+        for i in range(min(self.workers, count)):
+            thread = threading.Thread(name='fetch-worker-{}'.format(i), target=self.worker,
+                                      args=(pending, done, stopped))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for i in range(count):
+                key, result, exc_info = done.get()
+                if exc_info:
+                    six.reraise(*exc_info)
+                yield key, result
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2010-2013 Gustavo Noronha Silva
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import io
+import json
+import os
+import tempfile
+from hashlib import sha1
+from urllib import urlencode
+
+import requests
+
+
+def encode(value):
+    # Keys are hashed as UTF-8, so that non-ASCII URIs and form values work.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class CachedBody(io.FileIO):
+    # Response.close() only closes a body that was not read to the end,
+    # but it always releases the connection, which closes the file.
+    def release_conn(self):
+        self.close()
+
+
+class CachedEntry(object):
+    def __init__(self, meta, path):
+        self.meta = meta
+        self.path = path
+
+    def validators(self):
+        # Headers that let the server answer 304 if nothing changed.
+        headers = dict()
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+    def response(self):
+        # The body is read from disk as the response is, so it can be
+        # streamed with iter_content().
+        response = requests.Response()
+        response.status_code = requests.codes.ok
+        response.url = self.meta['url']
+        response.encoding = self.meta.get('encoding')
+        response.raw = CachedBody(self.path)
+        return response
+
+
+class HTTPCache(object):
+    """Keeps the responses a collector retrieved on disk.
+
+    Entries are keyed by method, URL and body. They are stored along with
+    their ETag and Last-Modified headers, so they can be revalidated with
+    conditional requests instead of downloaded again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_house(cls, house):
+        return cls(os.path.join(os.getcwd(), 'data', house, 'http-cache'))
+
+    def key(self, method, uri, data=None):
+        if isinstance(data, dict):
+            data = urlencode(sorted((encode(k), encode(v)) for k, v in data.items()))
+        return sha1('\n'.join(encode(part) for part in [method, uri, data or ''])).hexdigest()
+
+    def get(self, method, uri, data=None):
+        key = self.key(method, uri, data)
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        body_path = os.path.join(self.path, key + '.body')
+        if not os.path.exists(body_path):
+            return None
+        return CachedEntry(meta, body_path)
+
+    def store(self, method, uri, data, response):
+        """Stores the body of the response as it is read.
+
+        The body is written to disk along with the chunks the caller reads,
+        so it never needs to be in memory as a whole. The entry is only put
+        in place once all of it was read.
+        """
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        key = self.key(method, uri, data)
+        meta = dict(
+            url=uri,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            encoding=response.encoding,
+        )
+
+        iter_content = response.iter_content
+
+        def tee(chunk_size=1, decode_unicode=False):
+            if decode_unicode:
+                for chunk in iter_content(chunk_size, decode_unicode):
+                    yield chunk
+                return
+
+            # Retrievals run in several threads, so entries are replaced
+            # atomically rather than written in place.
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter_content(chunk_size):
+                        f.write(chunk)
+                        yield chunk
+
+                # Body first, so that a readable meta file always has its body.
+                os.rename(tmp_path, os.path.join(self.path, key + '.body'))
+                self._write(key + '.json', json.dumps(meta))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+        # Reading the response's content goes through iter_content() too.
+        response.iter_content = tee
+
+    def _write(self, name, contents):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        os.rename(tmp_path, os.path.join(self.path, name))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2010-2013 Gustavo Noronha Silva
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict, namedtuple
+from importlib import import_module
+
+
+# A collector class, as a path relative to this package so that the
+# modules of a house, and their dependencies, are only imported when it
+# is collected, and the methods to call, in order, to collect it.
+Collector = namedtuple('Collector', 'path phases image_phases')
+
+# Houses in the order they are collected.
+COLLECTORS = OrderedDict([
+    ('almg', Collector('almg.ALMG', ('update_legislators', 'update_data', 'update_legislators_data'), ())),
+    ('algo', Collector('algo.ALGO', ('update_legislators', 'update_data'), ('update_images',))),
+    ('alepe', Collector('alepe.ALEPE', ('update_legislators', 'update_data'), ())),
+    ('senado', Collector('senado.Senado', ('update_data',), ())),
+    ('cmbh', Collector('cmbh.CMBH', ('update_legislators', 'update_data'), ())),
+    ('cmsp', Collector('cmsp.CMSP', ('update_data',), ())),
+    ('cdep', Collector('cdep.CamaraDosDeputados', ('update_legislators', 'update_data'), ())),
+])
+
+
+def load_collector(house):
+    module_name, class_name = COLLECTORS[house].path.rsplit('.', 1)
+    module = import_module('.' + module_name, __name__.rpartition('.')[0])
+    return getattr(module, class_name)
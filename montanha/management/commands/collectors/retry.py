@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2010-2013 Gustavo Noronha Silva
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+
+# Statuses worth trying again, any other error status fails right away.
+RETRY_STATUSES = (408, 429)
+
+
+class RetryPolicy(object):
+    """Decides whether and when a failed retrieval is tried again.
+
+    Waits grow exponentially with each try, with some jitter so that
+    concurrent workers do not retry in lockstep, and honour the server's
+    Retry-After header when there is one; none is longer than `max_delay`.
+    Every host also has an error budget: once `host_budget` errors happen
+    in a row, all retrievals from that host are paused for `host_pause`
+    seconds.
+    """
+
+    def __init__(self, max_tries=10, base_delay=1, max_delay=60, host_budget=5, host_pause=30):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.host_budget = host_budget
+        self.host_pause = host_pause
+
+        self.errors = {}
+        self.paused_until = {}
+        self.lock = threading.Lock()
+
+    def retryable(self, response):
+        status = response.status_code
+        return status in RETRY_STATUSES or status >= 500
+
+    def retry_after(self, response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+    def delay(self, attempt, response=None):
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            # Servers may ask for hours, or a date far ahead.
+            return min(self.max_delay, retry_after)
+
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+    def failed(self, host, attempt, response=None):
+        """Records a failed try, returns how long to wait before the next."""
+        delay = self.delay(attempt, response)
+
+        with self.lock:
+            self.errors[host] = self.errors.get(host, 0) + 1
+            if self.errors[host] >= self.host_budget:
+                self.errors[host] = 0
+                paused_until = time.time() + self.host_pause
+                self.paused_until[host] = max(paused_until, self.paused_until.get(host, 0))
+
+        return delay
+
+    def succeeded(self, host):
+        with self.lock:
+            self.errors.pop(host, None)
+
+    def wait(self, host):
+        """Blocks while the host is paused for having used up its budget."""
+        while True:
+            with self.lock:
+                remaining = self.paused_until.get(host, 0) - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
@@ -18,29 +18,110 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import datetime
+import csv
+import tempfile
+from contextlib import closing
+from datetime import date, datetime
+from decimal import Decimal
 from io import BytesIO
+from itertools import chain
 
 import rows
-from django.db import reset_queries
 
 from basecollector import BaseCollector
+from httpcache import HTTPCache
 from montanha.models import (
     ArchivedExpense, Institution, Legislature,
-    Legislator, Mandate, ExpenseNature, PoliticalParty
+    Mandate, PoliticalParty
 )
 
 
-OBJECT_LIST_MAXIMUM_COUNTER = 1000
-
-
 extract_text = rows.plugins.html.extract_text
 extract_links = rows.plugins.html.extract_links
 
+CSV_ENCODING = 'windows-1252'
+CSV_CHUNK_SIZE = 64 * 1024
+
+EXPECTED_HEADER = [
+    u'ano',
+    u'mes',
+    u'senador',
+    u'tipo_despesa',
+    u'cnpj_cpf',
+    u'fornecedor',
+    u'documento',
+    u'data',
+    u'detalhamento',
+    u'valor_reembolsado',
+]
+
+
+class BadCSV(ValueError):
+    pass
+
+
+def iter_lines(chunks):
+    # Splits a body into lines as it is downloaded, keeping their line
+    # breaks so that the csv module can tell them apart from the ones
+    # inside quoted fields.
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(True)
+        pending = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def parse_value(value):
+    # Values use a decimal comma, and may be split across lines.
+    value = value.replace('\r', '').replace('\n', '').strip()
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    return Decimal(value)
+
+
+def read_expenses(lines):
+    """Yields a tuple for each expense of a yearly CSV file of the Senado.
+
+    Tuples hold the senator, nature, supplier identifier, supplier name,
+    document number, date and reimbursed value of the expense. Fields are
+    decoded one at a time, so the file never needs to be in memory.
+    """
+    lines = iter(lines)
+
+    # The first line is a title, the header comes next.
+    next(lines, None)
+    header_line = next(lines, None)
+    if header_line is None:
+        return
+
+    dialect = csv.Sniffer().sniff(header_line, delimiters=';,')
+    header = [f.decode(CSV_ENCODING).strip().lower() for f in next(csv.reader([header_line], dialect))]
+    if header != EXPECTED_HEADER:
+        raise BadCSV(u'Bad CSV: expected header {0}, got {1}'.format(EXPECTED_HEADER, header))
+
+    for row in csv.reader(lines, dialect):
+        # Skips blank and truncated lines.
+        if len(row) != len(EXPECTED_HEADER):
+            continue
+
+        (year, month, name, nature, cpf_cnpj, supplier_name,
+         docnumber, expense_date, _, expensed) = [f.decode(CSV_ENCODING) for f in row]
+
+        if expense_date:
+            expense_date = datetime.strptime(expense_date, '%d/%m/%Y').date()
+        else:
+            expense_date = date(int(year), int(month), 1)
+
+        yield (name, nature, cpf_cnpj, supplier_name, docnumber, expense_date, parse_value(expensed))
+
 
 class Senado(BaseCollector):
     def __init__(self, collection_runs, debug_enabled=False):
         super(Senado, self).__init__(collection_runs, debug_enabled)
+        self.http_cache = HTTPCache.for_house('senado')
 
         self.institution, _ = Institution.objects.get_or_create(
             siglum='Senado', name=u'Senado Federal'
@@ -88,7 +169,8 @@ class Senado(BaseCollector):
         self.debug(u'Downloading {0}'.format(uri))
 
         return BaseCollector.retrieve_uri(
-            self, uri, force_encoding='windows-1252', post_process=False
+            self, uri, force_encoding='windows-1252', post_process=False,
+            closed=self.is_closed_month(year, 12), return_response=True
         )
 
     def try_name_disambiguation(self, name):
@@ -103,9 +185,7 @@ class Senado(BaseCollector):
         return None, False
 
     def _get_or_create_legislator(self, name):
-        legislator, created = self.try_name_disambiguation(name)
-        if not legislator:
-            legislator, created = Legislator.objects.get_or_create(name=name)
+        legislator, created = self.get_or_create_legislator(name)
         if created:
             self.debug(u'New legislator: {0}'.format(legislator))
         else:
@@ -117,16 +197,17 @@ class Senado(BaseCollector):
             # Legislator
             name = extract_text(data.nome).replace('*', '').strip()
             legislator = self._get_or_create_legislator(name)
-            email = None
-            if hasattr(data, 'correio_eletronico'):
-                email = data.correio_eletronico
-                legislator.email = email
+            changed = False
+            if hasattr(data, 'correio_eletronico') and legislator.email != data.correio_eletronico:
+                legislator.email = data.correio_eletronico
+                changed = True
             site = extract_links(data.nome)[0]
-            if site:
+            if site and legislator.site != site:
                 legislator.site = site
-            if site or email:
+                changed = True
+            if changed:
                 legislator.save()
-            self.debug(u'Updated legislator data: {0}'.format(legislator))
+                self.debug(u'Updated legislator data: {0}'.format(legislator))
 
             # Mandate
             original_id = site.split('/')[-1]
@@ -134,9 +215,10 @@ class Senado(BaseCollector):
             mandate = self.mandate_for_legislator(
                 legislator, party, data.uf, original_id
             )
-            mandate.state = data.uf
-            mandate.save()
-            self.debug(u'Updated mandate data: {0}'.format(mandate))
+            if mandate.state != data.uf:
+                mandate.state = data.uf
+                mandate.save(update_fields=['state'])
+                self.debug(u'Updated mandate data: {0}'.format(mandate))
 
     def update_legislators(self, data):
         legislators = self.retrieve_legislators(data.get('legislators'))
@@ -153,80 +235,58 @@ class Senado(BaseCollector):
             for year in range(self.legislature.date_start.year, self.legislature.date_end.year + 1):
                 self.update_data_for_year(year)
 
+        self.flush_expenses()
+
     def update_data_for_year(self, year):
         self.debug(u'Updating data for year {0}'.format(year))
 
+        # The file is downloaded to disk before any of it is collected, so
+        # that a download failing midway only loses that year.
+        body = tempfile.TemporaryFile()
         try:
-            csv_data = self.retrieve_data_for_year(year).replace('\r\n', '\n')
+            response = self.retrieve_data_for_year(year)
+            with closing(response):
+                for chunk in response.iter_content(chunk_size=CSV_CHUNK_SIZE):
+                    body.write(chunk)
         except Exception:
+            body.close()
             print u'Not found data for year {0}'.format(year)
             return
 
-        # Skip first line
-        head, tail = csv_data.split('\n', 1)
-        self.debug(u'Reading file...')
-        data = rows.import_from_csv(BytesIO(tail.encode('utf-8')))
+        body.seek(0)
+        with body:
+            self.update_data_from_file(year, body)
 
-        if not data:
+    def update_data_from_file(self, year, body):
+        self.debug(u'Reading file...')
+        try:
+            chunks = iter(lambda: body.read(CSV_CHUNK_SIZE), b'')
+            expenses = read_expenses(iter_lines(chunks))
+            # Checks the header before anything is collected.
+            expenses = chain([next(expenses)], expenses)
+        except StopIteration:
             self.debug(u'Error downloading file for year {0}'.format(year))
             return
-
-        expected_header = [
-            u'ano',
-            u'mes',
-            u'senador',
-            u'tipo_despesa',
-            u'cnpj_cpf',
-            u'fornecedor',
-            u'documento',
-            u'data',
-            u'detalhamento',
-            u'valor_reembolsado',
-        ]
-
-        actual_header = data.fields.keys()
-
-        if actual_header != expected_header:
+        except BadCSV as e:
             # FIXME
-            print u'Bad CSV: expected header {0}, got {1}'.format(
-                expected_header, actual_header
-            )
+            print unicode(e)
             return
 
-        archived_expense_list = []
-        objects_counter = 0
-        archived_expense_list_counter = len(data)
-
         legislators = {}
         mandates = {}
         natures = {}
 
-        for row in data:
-            if not row.senador:
+        for name, nature, cpf_cnpj, supplier_name, docnumber, expense_date, expensed in expenses:
+            if not name:
                 self.debug(u'Error downloading file for year {0}')
                 continue
 
-            if not row.data:
-                date = '01/{0}/{1}'.format(row.mes, row.ano)
-                expense_date = datetime.strptime(date, '%d/%m/%Y')
-            else:
-                expense_date = datetime.strptime(row.data, '%d/%m/%Y')
-
-            name = self._normalize_name(row.senador)
-            nature = row.tipo_despesa
-            cpf_cnpj = row.cnpj_cpf
-            supplier_name = row.fornecedor
-            docnumber = row.documento
-            expensed = row.valor_reembolsado
-
-            # FIXME: WTF?
-            if isinstance(expensed, unicode):
-                expensed = float(expensed.replace(',', '.').replace('\r', '').replace('\n', ''))
+            name = self._normalize_name(name)
 
             # memory cache
             expense_nature = natures.get(nature)
             if not expense_nature:
-                expense_nature, _ = ExpenseNature.objects.get_or_create(name=nature)
+                expense_nature, _ = self.get_or_create_nature(nature)
                 natures[nature] = expense_nature
 
             supplier = self.get_or_create_supplier(cpf_cnpj, supplier_name)
@@ -252,19 +312,5 @@ class Senado(BaseCollector):
                 supplier=supplier,
                 collection_run=self.collection_run
             )
-            archived_expense_list.append(expense)
+            self.add_expense(expense)
             self.debug(u'New expense found: {0}'.format(unicode(expense)))
-
-            objects_counter += 1
-            archived_expense_list_counter -= 1
-
-            # We create a list with up to OBJECT_LIST_MAXIMUM_COUNTER.
-            # If that lists is equal to the maximum object count allowed
-            # or if there are no more objects in archived_expense_list,
-            # we bulk_create() them and clear the list.
-
-            if objects_counter == OBJECT_LIST_MAXIMUM_COUNTER or archived_expense_list_counter == 0:
-                ArchivedExpense.objects.bulk_create(archived_expense_list)
-                archived_expense_list[:] = []
-                objects_counter = 0
-                reset_queries()
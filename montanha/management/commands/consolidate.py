@@ -21,25 +21,51 @@
 
 import codecs
 import sys
+import traceback
+from multiprocessing import Pool
 from datetime import date
+from decimal import Decimal
 
+from cacheops import invalidate_model
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db.models import Sum
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max
 
+from consolidators.sql import SQLConsolidator
 from montanha.models import (
-    Institution, Expense, ExpenseNature, Legislator, Supplier, PerNature,
-    PerNatureByYear, PerNatureByMonth, PerLegislator, BiggestSupplierForYear
-)
-from montanha.util import (
-    filter_for_institution, get_date_ranges_from_data, ensure_years_in_range
+    Institution, PerNature, PerNatureByYear, PerNatureByMonth,
+    PerLegislator, BiggestSupplierForYear, PendingConsolidation
 )
+from montanha.util import get_date_bounds, bound_dates, ensure_years_in_range
 
 
 settings.DEBUG = False
 sys.stdout = codecs.getwriter("utf-8")(sys.stdout)
 sys.stderr = codecs.getwriter("utf-8")(sys.stderr)
 
+OBJECT_LIST_MAXIMUM_COUNTER = 1000
+
+ENGINES = ('sql', 'numpy')
+
+
+def consolidate_task(task):
+    # Runs in a pool worker: a house to consolidate, or None for the
+    # institution-agnostic totals.
+    house, engine, incremental = task
+
+    command = Command()
+    command.setup(engine)
+    try:
+        if house is None:
+            command.agnostic()
+            return set()
+        return command.consolidate(house, incremental)
+    except Exception:
+        # Database errors carry their traceback, which cannot be sent back
+        # to the parent process.
+        raise CommandError(traceback.format_exc())
+
 
 class Command(BaseCommand):
     help = "Collects data for a number of sources"
@@ -52,262 +78,373 @@ class Command(BaseCommand):
             dest='agnostic',
             default=False,
         )
+        parser.add_argument(
+            '--engine',
+            choices=ENGINES,
+            dest='engine',
+            default='sql',
+            help='sql runs grouped queries; numpy loads the expenses once and '
+                 'computes the totals in memory.',
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            dest='jobs',
+            default=1,
+            help='Number of processes consolidating institutions at the same '
+                 'time. Needs a database that allows concurrent writers.',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only consolidate again the months changed by collection '
+                 'runs committed since the last consolidation.',
+        )
 
     def handle(self, *args, **options):
-        for house in options.get('house'):
-            try:
-                institution = Institution.objects.get(siglum__iexact=house)
-                print u'Consolidating data for %s' % (institution.name)
-                self.per_nature(institution)
-                self.per_legislator(institution)
-            except Institution.DoesNotExist:
-                print u'Institution %s does not exist' % house
-
-        if options.get('agnostic'):
-            self.agnostic()
+        engine = options.get('engine') or 'sql'
+        incremental = options.get('incremental')
+        jobs = options.get('jobs', 1)
 
-    def per_nature(self, institution):
-        PerNature.objects.filter(institution=institution).delete()
-        PerNatureByYear.objects.filter(institution=institution).delete()
-        PerNatureByMonth.objects.filter(institution=institution).delete()
-
-        data = Expense.objects.all()
-        data = filter_for_institution(data, institution)
-
-        date_ranges = get_date_ranges_from_data(institution, data)
-
-        data = data \
-            .values('nature__id') \
-            .annotate(expensed=Sum('expensed')) \
-            .order_by('-expensed')
-
-        years = [d.year for d in Expense.objects.dates('date', 'year')]
-        years = ensure_years_in_range(date_ranges, years)
+        if engine == 'numpy':
+            try:
+                import numpy  # noqa
+            except ImportError:
+                raise CommandError('The numpy engine requires NumPy to be installed.')
+
+        if jobs < 1:
+            raise CommandError('--jobs must be at least 1.')
+
+        self.setup(engine)
+
+        if jobs > 1:
+            years = self.run_in_pool(options.get('house'), engine, incremental, options.get('agnostic'), jobs)
+        else:
+            years = set()
+            for house in options.get('house'):
+                years.update(self.consolidate(house, incremental))
+
+            if options.get('agnostic'):
+                self.agnostic()
+
+        # A full agnostic pass already covers the years changed by
+        # incremental consolidations.
+        if years and not options.get('agnostic'):
+            self.agnostic(years=years)
+
+    def setup(self, engine):
+        self.engine = engine
+        self.consolidators = {}
+
+    def run_in_pool(self, houses, engine, incremental, agnostic, jobs):
+        tasks = [(house, engine, incremental) for house in houses]
+        if agnostic:
+            tasks.append((None, engine, False))
+
+        # Forked workers must not share the parent's database connection,
+        # each of them opens its own.
+        connections.close_all()
+
+        pool = Pool(jobs)
+        try:
+            results = pool.map(consolidate_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        return set().union(*results)
+
+    def consolidate(self, house, incremental=False):
+        # Returns the years changed by an incremental consolidation, whose
+        # biggest suppliers need to be consolidated again.
+        try:
+            institution = Institution.objects.get(siglum__iexact=house)
+        except Institution.DoesNotExist:
+            print u'Institution %s does not exist' % house
+            return set()
+
+        # Databases upgraded from before pending months were recorded may
+        # have expenses that were never consolidated at all.
+        never_consolidated = not PerNature.objects.filter(institution=institution).exists()
+        if incremental and not never_consolidated:
+            return self.incremental(institution)
+
+        print u'Consolidating data for %s' % (institution.name)
+        pending = PendingConsolidation.objects.filter(institution=institution)
+        last_pending = pending.aggregate(Max('id'))['id__max']
+
+        self.per_nature(institution)
+        self.per_legislator(institution)
+        self.consolidators.pop(institution.id, None)
+
+        # Everything is up to date now.
+        if last_pending:
+            pending.filter(id__lte=last_pending).delete()
+
+        if incremental:
+            # Stands in for an incremental consolidation, whose years get
+            # their biggest suppliers consolidated again.
+            return set(PerNatureByYear.objects.filter(institution=institution)
+                                              .values_list('year', flat=True))
+        return set()
+
+    def incremental(self, institution):
+        pending = PendingConsolidation.objects.filter(institution=institution)
+        last_pending = pending.aggregate(Max('id'))['id__max']
+        if not last_pending:
+            print u'Nothing to consolidate for %s' % (institution.name)
+            return set()
+
+        pending = pending.filter(id__lte=last_pending)
+        changes = set(pending.values_list('nature_id', 'legislator_id', 'year', 'month'))
+
+        natures = set(c[0] for c in changes)
+        legislators = set(c[1] for c in changes)
+        years = set(c[2] for c in changes)
+
+        print u'Consolidating %d changed months for %s' % (len(changes), institution.name)
+        self.per_nature(institution, natures=natures, years=years)
+        self.per_legislator(institution, legislators=legislators)
+
+        pending.delete()
+
+        return years
+
+    def consolidator(self, institution=None, **filters):
+        # Partial consolidations only look at a few rows, so they always
+        # run grouped queries.
+        if filters:
+            return SQLConsolidator(institution, **filters)
+
+        # The numpy engine loads all expenses for the institution, so it is
+        # kept around for all the consolidations of that institution.
+        key = institution and institution.id
+        if key not in self.consolidators:
+            if self.engine == 'numpy':
+                from consolidators.columnar import ColumnarConsolidator
+                self.consolidators[key] = ColumnarConsolidator(institution)
+            else:
+                self.consolidators[key] = SQLConsolidator(institution)
+        return self.consolidators[key]
+
+    def per_nature(self, institution, natures=None, years=None):
+        # When natures and years are given, only their totals are computed
+        # again, unless the range of years changed, which affects them all.
+        if natures is None:
+            consolidator = self.consolidator(institution)
+        else:
+            consolidator = self.consolidator(institution, natures=natures)
+
+        date_ranges = consolidator.date_ranges()
+        date_bounds = get_date_bounds(institution)
+
+        all_years = ensure_years_in_range(date_ranges, consolidator.years())
+        if natures is not None:
+            consolidated_years = PerNatureByYear.objects \
+                .filter(institution=institution) \
+                .values_list('year', flat=True) \
+                .distinct()
+            if set(consolidated_years) != set(all_years):
+                print u'[%s] Years changed, consolidating all natures…' % institution.siglum
+                natures = years = None
+                consolidator = self.consolidator(institution)
+
+        if years is None:
+            years = all_years
+        else:
+            years = [y for y in all_years if y in years]
+
+        legislatures = list(institution.legislature_set.all())
+
+        totals = consolidator.nature_totals()
+
+        print u'[%s] Consolidating nature totals for legislatures…' % institution.siglum
+        by_legislature = consolidator.nature_totals_by_legislature()
+
+        print u'[%s] Consolidating nature totals for years and months…' % institution.siglum
+        by_month, last_dates = consolidator.nature_totals_by_month()
 
         per_natures_to_create = list()
         per_natures_by_year_to_create = list()
         per_natures_by_month_to_create = list()
 
-        for item in data:
+        for nature_id, expensed in totals:
             # Totals
-            nature = ExpenseNature.objects.get(id=item['nature__id'])
             p = PerNature(
                 institution=institution,
                 date_start=date_ranges['cdf'],
                 date_end=date_ranges['cdt'],
-                nature=nature,
-                expensed=item['expensed']
+                nature_id=nature_id,
+                expensed=expensed
             )
             per_natures_to_create.append(p)
 
             # Totals for Legislature
-            per_natures_to_create += self._per_nature_total_for_legislature(
-                institution, nature
-            )
-
-            # By Year
-            year_to_create, month_to_create = self._per_nature_by_year(
-                years, institution, nature
-            )
-            per_natures_by_year_to_create += year_to_create
-            per_natures_by_month_to_create += month_to_create
-
-        PerNature.objects.bulk_create(per_natures_to_create)
-        PerNatureByMonth.objects.bulk_create(per_natures_by_month_to_create)
-        PerNatureByYear.objects.bulk_create(per_natures_by_year_to_create)
-
-    def _per_nature_total_for_legislature(self, institution, nature):
-        per_natures_to_create = list()
-        for legislature in institution.legislature_set.all():
-            print u'[%s] Consolidating nature %s totals for legislature %d-%d…' % (
-                institution.siglum,
-                nature.name,
-                legislature.date_start.year,
-                legislature.date_end.year
-            )
-
-            legislature_data = Expense.objects \
-                .filter(nature=nature) \
-                .filter(mandate__legislature=legislature)
-
-            legislature_ranges = get_date_ranges_from_data(institution, legislature_data)
-
-            legislature_data = legislature_data \
-                .values('nature__id') \
-                .annotate(expensed=Sum('expensed')) \
-                .order_by('-expensed')
-
-            if legislature_data:
-                legislature_data = legislature_data[0]
-            else:
-                legislature_data = dict(expensed='0.')
-
-            p = PerNature(
-                institution=institution,
-                legislature=legislature,
-                date_start=legislature_ranges['cdf'],
-                date_end=legislature_ranges['cdt'],
-                nature=nature,
-                expensed=legislature_data['expensed']
-            )
-            per_natures_to_create.append(p)
-        return per_natures_to_create
-
-    def _per_nature_by_year(self, years, institution, nature):
-        per_natures_by_year_to_create = list()
-        per_natures_by_month_to_create = list()
-
-        for year in years:
-            print u'[%s] Consolidating nature %s totals for year %d…' % (
-                institution.siglum, nature.name, year
-            )
-
-            year_data = Expense.objects \
-                .filter(nature=nature) \
-                .filter(date__year=year)
+            for legislature in legislatures:
+                legislature_data = by_legislature.get((nature_id, legislature.id), {})
+                cdf, cdt = bound_dates(
+                    legislature_data.get('date_start'),
+                    legislature_data.get('date_end'),
+                    date_bounds
+                )
 
-            year_data = filter_for_institution(year_data, institution)
+                p = PerNature(
+                    institution=institution,
+                    legislature=legislature,
+                    date_start=cdf,
+                    date_end=cdt,
+                    nature_id=nature_id,
+                    expensed=legislature_data.get('expensed', Decimal(0))
+                )
+                per_natures_to_create.append(p)
 
-            # By Month
-            per_natures_by_month_to_create += self._per_nature_by_month(
-                year_data, year, institution, nature
-            )
+            # By Year
+            for year in years:
+                last_date = last_dates.get((nature_id, year)) or date.today()
+
+                # By Month
+                year_expensed = Decimal(0)
+                for month in range(1, 13):
+                    expensed = by_month.get((nature_id, year, month), Decimal(0))
+                    year_expensed += expensed
+
+                    month_date = date(year, month, 1)
+                    if month_date >= last_date:
+                        continue
+
+                    p = PerNatureByMonth(
+                        institution=institution,
+                        date=month_date,
+                        nature_id=nature_id,
+                        expensed=expensed
+                    )
+                    per_natures_by_month_to_create.append(p)
+
+                p = PerNatureByYear(
+                    institution=institution,
+                    year=year,
+                    nature_id=nature_id,
+                    expensed=year_expensed
+                )
+                per_natures_by_year_to_create.append(p)
 
-            year_data = year_data \
-                .values('nature__id') \
-                .annotate(expensed=Sum("expensed"))
+        per_natures = PerNature.objects.filter(institution=institution)
+        per_natures_by_month = PerNatureByMonth.objects.filter(institution=institution)
+        per_natures_by_year = PerNatureByYear.objects.filter(institution=institution)
 
-            if year_data:
-                year_data = year_data[0]
-            else:
-                year_data = dict(expensed='0.')
+        updates = []
+        if natures is not None:
+            # The institution's date range may have changed for the others.
+            updates.append((
+                per_natures.filter(legislature=None).exclude(nature__in=natures),
+                dict(date_start=date_ranges['cdf'], date_end=date_ranges['cdt'])
+            ))
 
-            p = PerNatureByYear(
-                institution=institution,
-                year=year,
-                nature=nature,
-                expensed=float(year_data['expensed'])
-            )
-            per_natures_by_year_to_create.append(p)
-        return per_natures_by_year_to_create, per_natures_by_month_to_create
+            per_natures = per_natures.filter(nature__in=natures)
+            per_natures_by_month = per_natures_by_month.filter(nature__in=natures, date__year__in=years)
+            per_natures_by_year = per_natures_by_year.filter(nature__in=natures, year__in=years)
 
-    def _per_nature_by_month(self, year_data, year, institution, nature):
-        per_natures_by_month_to_create = list()
+        self.replace_rows([
+            (per_natures, per_natures_to_create),
+            (per_natures_by_month, per_natures_by_month_to_create),
+            (per_natures_by_year, per_natures_by_year_to_create),
+        ], updates)
 
-        last_date = year_data and year_data.order_by('-date')[0].date or date.today()
-        for month in range(1, 13):
-            print u'[%s] Consolidating nature %s totals for %d-%d…' % (
-                institution.siglum, nature.name, year, month
-            )
+    def per_legislator(self, institution, legislators=None):
+        if legislators is None:
+            consolidator = self.consolidator(institution)
+        else:
+            consolidator = self.consolidator(institution, legislators=legislators)
 
-            month_date = date(year, month, 1)
+        date_ranges = consolidator.date_ranges()
 
-            if month_date >= last_date:
-                break
+        print u'[%s] Consolidating legislator totals…' % institution.siglum
 
-            mdata = year_data.filter(date__month=month) \
-                .values('nature__id') \
-                .annotate(expensed=Sum('expensed')) \
-                .order_by('-expensed')
+        # The all-time totals are the sum of the totals for each legislature.
+        by_legislature = consolidator.legislator_totals_by_legislature()
 
-            if mdata:
-                mdata = mdata[0]
-            else:
-                mdata = dict(expensed='0.')
+        totals = dict()
+        for (legislator_id, _), expensed in by_legislature.items():
+            totals[legislator_id] = totals.get(legislator_id, Decimal(0)) + expensed
 
-            p = PerNatureByMonth(
-                institution=institution,
-                date=month_date,
-                nature=nature,
-                expensed=float(mdata['expensed'])
-            )
-            per_natures_by_month_to_create.append(p)
-        return per_natures_by_month_to_create
-
-    def per_legislator(self, institution):
-        PerLegislator.objects.filter(institution=institution).delete()
-
-        data = Expense.objects.all()
-        data = filter_for_institution(data, institution)
-
-        date_ranges = get_date_ranges_from_data(institution, data)
-
-        data = data \
-            .values('mandate__legislator__id') \
-            .annotate(expensed=Sum('expensed'))
+        legislatures = list(institution.legislature_set.all())
 
         per_legislators_to_create = list()
-        for item in data:
-            legislator = Legislator.objects.get(id=int(item['mandate__legislator__id']))
-
+        for legislator_id in sorted(totals):
             # Totals for Legislature
-            for legislature in institution.legislature_set.all():
-                print u'[%s] Consolidating legislator %s totals for legislature %d-%d…' % (
-                    institution.siglum,
-                    legislator.name,
-                    legislature.date_start.year,
-                    legislature.date_end.year
-                )
-
-                legislature_data = Expense.objects \
-                    .filter(mandate__legislature=legislature) \
-                    .filter(mandate__legislator=legislator) \
-                    .values('mandate__legislator__id') \
-                    .annotate(expensed=Sum('expensed')) \
-                    .order_by('-expensed')
-
-                if legislature_data:
-                    legislature_data = legislature_data[0]
-                else:
-                    legislature_data = dict(expensed='0.')
-
+            for legislature in legislatures:
                 p = PerLegislator(
                     institution=institution,
                     legislature=legislature,
                     date_start=date_ranges['cdf'],
                     date_end=date_ranges['cdt'],
-                    legislator=legislator,
-                    expensed=legislature_data['expensed']
+                    legislator_id=legislator_id,
+                    expensed=by_legislature.get((legislator_id, legislature.id), Decimal(0))
                 )
                 per_legislators_to_create.append(p)
 
-            print u'[%s] Consolidating totals for legislator %s…' % (
-                institution.siglum, legislator.name
-            )
-
             p = PerLegislator(
                 institution=institution,
                 date_start=date_ranges['cdf'],
                 date_end=date_ranges['cdt'],
-                legislator=legislator,
-                expensed=item['expensed']
+                legislator_id=legislator_id,
+                expensed=totals[legislator_id]
             )
             per_legislators_to_create.append(p)
-        PerLegislator.objects.bulk_create(per_legislators_to_create)
 
-    def agnostic(self):
+        per_legislators = PerLegislator.objects.filter(institution=institution)
+
+        updates = []
+        if legislators is not None:
+            # The institution's date range may have changed for the others.
+            updates.append((
+                per_legislators.exclude(legislator__in=legislators),
+                dict(date_start=date_ranges['cdf'], date_end=date_ranges['cdt'])
+            ))
+            per_legislators = per_legislators.filter(legislator__in=legislators)
+
+        self.replace_rows([(per_legislators, per_legislators_to_create)], updates)
+
+    def agnostic(self, years=None):
         # Institution-agnostic consolidations - biggest suppliers
         print u'Consolidating institution-agnostic totals…'
 
-        BiggestSupplierForYear.objects.all().delete()
+        consolidator = self.consolidator()
 
-        years = [d.year for d in Expense.objects.dates('date', 'year')]
-        for year in years:
-            print u'Consolidating supplier totals for year %d…' % year
-            data = Expense.objects \
-                .filter(date__year=year) \
-                .values('supplier__id') \
-                .annotate(expensed=Sum('expensed')) \
-                .order_by('-expensed')
+        biggest_suppliers = BiggestSupplierForYear.objects.all()
+        if years is None:
+            years = consolidator.years()
+        else:
+            biggest_suppliers = biggest_suppliers.filter(year__in=years)
 
-            biggest_suppliers_for_year_to_add = list()
-            for item in data:
-                supplier = Supplier.objects.get(id=item['supplier__id'])
+        biggest_suppliers_for_year_to_add = list()
+        for year in sorted(years):
+            print u'Consolidating supplier totals for year %d…' % year
 
+            for supplier_id, expensed in consolidator.supplier_totals(year):
                 b = BiggestSupplierForYear(
-                    supplier=supplier,
+                    supplier_id=supplier_id,
                     year=year,
-                    expensed=item['expensed']
+                    expensed=expensed
                 )
                 biggest_suppliers_for_year_to_add.append(b)
-            BiggestSupplierForYear.objects.bulk_create(biggest_suppliers_for_year_to_add)
+
+        self.replace_rows([(biggest_suppliers, biggest_suppliers_for_year_to_add)])
+
+    def replace_rows(self, replacements, updates=()):
+        # New rows are computed before touching the consolidated tables and
+        # swapped for the old ones in a single short transaction, so readers
+        # never see empty or partial data while we consolidate.
+        with transaction.atomic():
+            for queryset, rows in replacements:
+                queryset.delete()
+                queryset.model.objects.bulk_create(rows, batch_size=OBJECT_LIST_MAXIMUM_COUNTER)
+
+            for queryset, values in updates:
+                queryset.update(**values)
+
+        # bulk_create() does not invalidate cached querysets.
+        for queryset, _ in replacements:
+            invalidate_model(queryset.model)
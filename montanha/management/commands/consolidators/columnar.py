@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2014 Gustavo Noronha Silva
+# Copyright (©) 2016 Marcelo Jorge Vieira
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from montanha.models import Expense
+from montanha.util import filter_for_institution, get_date_bounds, bound_dates
+
+
+def to_decimal(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def combine(*columns):
+    # Packs a number of non-negative integer columns into a single int64
+    # key, so we can group by all of them at once.
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        width = int(column.max()) + 1 if len(column) else 1
+        key = key * width + column
+    return key
+
+
+def group(key, cents):
+    # Returns the unique keys, the total in cents for each of them and the
+    # index of each row's group.
+    uniques, inverse = np.unique(key, return_inverse=True)
+    totals = np.zeros(len(uniques), dtype=np.int64)
+    np.add.at(totals, inverse, cents)
+    return uniques, totals, inverse
+
+
+class ColumnarConsolidator(object):
+    """Computes the consolidated totals in memory.
+
+    Expenses are read from the database only once, into compact integer
+    columns with values in cents, and every total is computed from those
+    columns with vectorized group-bys, so sums are exact.
+    """
+
+    def __init__(self, institution=None):
+        self.institution = institution
+        self.load()
+
+    def load(self):
+        data = filter_for_institution(Expense.objects.all(), self.institution)
+        data = data.values_list(
+            'nature_id', 'mandate__legislator_id', 'mandate__legislature_id',
+            'supplier_id', 'date', 'expensed'
+        )
+
+        columns = [array('l') for x in range(8)]
+        (nature, legislator, legislature, supplier,
+         ordinal, year, month, cents) = columns
+
+        for row in data.iterator():
+            nature.append(row[0])
+            legislator.append(row[1])
+            legislature.append(row[2])
+            supplier.append(row[3])
+            ordinal.append(row[4].toordinal())
+            year.append(row[4].year)
+            month.append(row[4].month)
+            cents.append(int((row[5] * 100).to_integral_value()))
+
+        columns = [np.fromiter(c, dtype=np.int64, count=len(c)) for c in columns]
+        (self.nature, self.legislator, self.legislature, self.supplier,
+         self.ordinal, self.year, self.month, self.cents) = columns
+
+    def years(self):
+        return [d.year for d in Expense.objects.dates('date', 'year')]
+
+    def date_ranges(self):
+        cdf = cdt = None
+        if len(self.ordinal):
+            cdf = date.fromordinal(int(self.ordinal.min()))
+            cdt = date.fromordinal(int(self.ordinal.max()))
+
+        cdf, cdt = bound_dates(cdf, cdt, get_date_bounds(self.institution))
+        return dict(cdf=cdf, cdt=cdt)
+
+    def nature_totals(self):
+        natures, totals, _ = group(self.nature, self.cents)
+
+        # Stable sort, biggest totals first.
+        order = np.argsort(-totals, kind='mergesort')
+        return [(int(natures[i]), to_decimal(totals[i])) for i in order]
+
+    def nature_totals_by_legislature(self):
+        key = combine(self.nature, self.legislature)
+        _, totals, inverse = group(key, self.cents)
+
+        first = np.full(len(totals), np.iinfo(np.int64).max, dtype=np.int64)
+        last = np.zeros(len(totals), dtype=np.int64)
+        np.minimum.at(first, inverse, self.ordinal)
+        np.maximum.at(last, inverse, self.ordinal)
+
+        # Any row of the group will do to recover its nature and legislature.
+        rows = np.zeros(len(totals), dtype=np.int64)
+        rows[inverse] = np.arange(len(inverse))
+
+        by_legislature = dict()
+        for i, row in enumerate(rows):
+            key = (int(self.nature[row]), int(self.legislature[row]))
+            by_legislature[key] = dict(
+                expensed=to_decimal(totals[i]),
+                date_start=date.fromordinal(int(first[i])),
+                date_end=date.fromordinal(int(last[i])),
+            )
+        return by_legislature
+
+    def nature_totals_by_month(self):
+        key = combine(self.nature, self.year, self.month)
+        _, totals, inverse = group(key, self.cents)
+
+        last = np.zeros(len(totals), dtype=np.int64)
+        np.maximum.at(last, inverse, self.ordinal)
+
+        rows = np.zeros(len(totals), dtype=np.int64)
+        rows[inverse] = np.arange(len(inverse))
+
+        by_month = dict()
+        last_dates = dict()
+        for i, row in enumerate(rows):
+            nature_id, year = int(self.nature[row]), int(self.year[row])
+            by_month[(nature_id, year, int(self.month[row]))] = to_decimal(totals[i])
+
+            last_date = date.fromordinal(int(last[i]))
+            if last_date > last_dates.get((nature_id, year), date.min):
+                last_dates[(nature_id, year)] = last_date
+        return by_month, last_dates
+
+    def legislator_totals_by_legislature(self):
+        key = combine(self.legislator, self.legislature)
+        _, totals, inverse = group(key, self.cents)
+
+        rows = np.zeros(len(totals), dtype=np.int64)
+        rows[inverse] = np.arange(len(inverse))
+
+        by_legislature = dict()
+        for i, row in enumerate(rows):
+            key = (int(self.legislator[row]), int(self.legislature[row]))
+            by_legislature[key] = to_decimal(totals[i])
+        return by_legislature
+
+    def supplier_totals(self, year):
+        selected = self.year == year
+        suppliers, totals, _ = group(self.supplier[selected], self.cents[selected])
+
+        order = np.argsort(-totals, kind='mergesort')
+        return [(int(suppliers[i]), to_decimal(totals[i])) for i in order]
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2014 Gustavo Noronha Silva
+# Copyright (©) 2016 Marcelo Jorge Vieira
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.db.models import Max, Min, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+from montanha.models import Expense
+from montanha.util import filter_for_institution, get_date_ranges_from_data
+
+
+class SQLConsolidator(object):
+    """Computes the consolidated totals with grouped queries."""
+
+    def __init__(self, institution=None, natures=None, legislators=None):
+        self.institution = institution
+        self.expenses = filter_for_institution(Expense.objects.all(), institution)
+
+        # Totals may be restricted to some natures or legislators, when
+        # only part of the data needs to be consolidated again.
+        self.data = self.expenses
+        if natures is not None:
+            self.data = self.data.filter(nature__in=natures)
+        if legislators is not None:
+            self.data = self.data.filter(mandate__legislator__in=legislators)
+
+    def years(self):
+        return [d.year for d in Expense.objects.dates('date', 'year')]
+
+    def date_ranges(self):
+        return get_date_ranges_from_data(self.institution, self.expenses)
+
+    def nature_totals(self):
+        data = self.data \
+            .values('nature__id') \
+            .annotate(expensed=Sum('expensed')) \
+            .order_by('-expensed')
+        return [(item['nature__id'], item['expensed']) for item in data]
+
+    def nature_totals_by_legislature(self):
+        # Totals and date ranges for every (nature, legislature) pair.
+        data = self.data \
+            .values('nature__id', 'mandate__legislature__id') \
+            .annotate(
+                expensed=Sum('expensed'),
+                date_start=Min('date'),
+                date_end=Max('date')) \
+            .order_by()
+
+        by_legislature = dict()
+        for item in data:
+            key = (item['nature__id'], item['mandate__legislature__id'])
+            by_legislature[key] = item
+        return by_legislature
+
+    def nature_totals_by_month(self):
+        # Totals for every (nature, year, month) and the last expense date
+        # for every (nature, year).
+        data = self.data \
+            .annotate(year=ExtractYear('date'), month=ExtractMonth('date')) \
+            .values('nature__id', 'year', 'month') \
+            .annotate(expensed=Sum('expensed'), last_date=Max('date')) \
+            .order_by()
+
+        by_month = dict()
+        last_dates = dict()
+        for item in data:
+            nature_id, year = item['nature__id'], item['year']
+            by_month[(nature_id, year, item['month'])] = item['expensed']
+
+            last_date = last_dates.get((nature_id, year))
+            if not last_date or item['last_date'] > last_date:
+                last_dates[(nature_id, year)] = item['last_date']
+        return by_month, last_dates
+
+    def legislator_totals_by_legislature(self):
+        data = self.data \
+            .values('mandate__legislator__id', 'mandate__legislature__id') \
+            .annotate(expensed=Sum('expensed')) \
+            .order_by('mandate__legislator__id')
+
+        by_legislature = dict()
+        for item in data:
+            key = (item['mandate__legislator__id'], item['mandate__legislature__id'])
+            by_legislature[key] = item['expensed']
+        return by_legislature
+
+    def supplier_totals(self, year):
+        data = self.data \
+            .filter(date__year=year) \
+            .values('supplier__id') \
+            .annotate(expensed=Sum('expensed')) \
+            .order_by('-expensed')
+        return [(item['supplier__id'], item['expensed']) for item in data]
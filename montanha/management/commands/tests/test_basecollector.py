@@ -15,19 +15,27 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import shutil
+import tempfile
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from StringIO import StringIO
 
 import requests
 from django.test import TestCase
-from mock import patch, Mock, call
+from mock import patch, call, MagicMock, Mock
 
-from montanha.models import ArchivedExpense
-from montanha.management.commands.collectors.basecollector import BaseCollector
+from montanha.models import (
+    AlternativeLegislatorName, ArchivedExpense, CollectionCheckpoint, CollectionProgress,
+    CollectionRun, Legislator, Supplier
+)
+from montanha.management.commands.collectors.basecollector import BaseCollector, fold_name
+from montanha.management.commands.collectors.httpcache import HTTPCache
+from montanha.management.commands.collectors.retry import RetryPolicy
 from montanha.tests.fixtures import (
     LegislatureFactory, ArchivedExpenseFactory, CollectionRunFactory,
     MandateFactory, LegislatorFactory, PoliticalPartyFactory, SupplierFactory,
+    ExpenseNatureFactory, CollectionCheckpointFactory,
 )
 
 
@@ -36,8 +44,7 @@ class BaseCollectorTestCase(TestCase):
     def setUp(self):
         self.base_collector = BaseCollector([], False)
         self.base_collector.default_timeout = 0.001
-        self.base_collector.max_tries = 3
-        self.base_collector.try_again_timer = 0.001
+        self.base_collector.retry_policy = RetryPolicy(max_tries=3, base_delay=0.001)
 
         date_start = datetime.now()
         date_end = date_start + timedelta(days=365 * 4)
@@ -51,6 +58,15 @@ class BaseCollectorTestCase(TestCase):
         )
         self.base_collector.legislature = self.legislature
 
+    def _expense(self, collection_run, checkpoint=None):
+        return ArchivedExpenseFactory.build(
+            collection_run=collection_run,
+            checkpoint=checkpoint,
+            mandate=self.mandate,
+            nature=ExpenseNatureFactory.create(),
+            supplier=SupplierFactory.create(),
+        )
+
 
 class BaseCollectorNormalizeCnpjOrCpfTestCase(BaseCollectorTestCase):
 
@@ -77,6 +93,40 @@ class BaseCollectorGetOrCreateSupplierTestCase(BaseCollectorTestCase):
         self.assertEqual(supplier.identifier, '01234567000189')
         self.assertEqual(supplier.name, 'Test Supplier')
 
+    def test_get_supplier_from_memory(self):
+        existing = SupplierFactory.create(identifier='01234567890')
+        self.base_collector.get_or_create_supplier('01234567890')
+
+        with self.assertNumQueries(0):
+            supplier = self.base_collector.get_or_create_supplier('012.345.678-90')
+        self.assertEqual(supplier.id, existing.id)
+
+    def test_create_supplier_on_flush(self):
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        supplier = self.base_collector.get_or_create_supplier('01234567890', 'Test Supplier')
+        same_supplier = self.base_collector.get_or_create_supplier('01234567890', 'Test Supplier')
+        self.assertIs(supplier, same_supplier)
+        self.assertEqual(Supplier.objects.filter(identifier='01234567890').count(), 0)
+
+        for x in range(2):
+            self.base_collector.add_expense(ArchivedExpenseFactory.build(
+                collection_run=collection_run,
+                mandate=self.mandate,
+                nature=ExpenseNatureFactory.create(),
+                supplier=supplier,
+            ))
+        self.base_collector.flush_expenses()
+
+        created = Supplier.objects.get(identifier='01234567890')
+        self.assertEqual(created.name, 'Test Supplier')
+        self.assertEqual(supplier.id, created.id)
+        self.assertEqual(
+            list(ArchivedExpense.objects.values_list('supplier_id', flat=True)),
+            [created.id, created.id]
+        )
+
+        self.assertEqual(self.base_collector.get_or_create_supplier('01234567890').id, created.id)
+
 
 class BaseCollectorPostProcessUriTestCase(BaseCollectorTestCase):
 
@@ -88,15 +138,27 @@ class BaseCollectorPostProcessUriTestCase(BaseCollectorTestCase):
 
 class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_with_status_not_found(self, mock_get):
         mock_get.return_value.status_code = 404
 
-        with self.assertRaises(Exception):
-            data = self.base_collector.retrieve_uri('http://olhoneles.org')
-            self.assertEqual(data, None)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.base_collector.retrieve_uri('http://olhoneles.org')
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_with_server_error(self, mock_get):
+        error = Mock(status_code=503, headers={})
+        success = Mock(status_code=200, text='<html><p>test</p></html>')
+        mock_get.side_effect = [error, success]
 
-    @patch('requests.get')
+        data = self.base_collector.retrieve_uri('http://olhoneles.org')
+        self.assertEqual(str(data), '<html><p>test</p></html>')
+        self.assertEqual(mock_get.call_count, 2)
+        error.close.assert_called_once_with()
+        success.close.assert_called_once_with()
+
+    @patch('requests.Session.get')
     def test_with_connection_error(self, mock_get):
         mock_get.side_effect = requests.exceptions.ConnectionError
 
@@ -108,7 +170,7 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
             'Error: Unable to retrieve http://olhoneles.org; Tried 3 times.'
         )
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_with_post_process_false_return_content_true(self, mock_get):
         mock_get.return_value.status_code = 200
         mock_get.return_value.content = '<html><p>test</p></html>'
@@ -118,7 +180,7 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
         )
         self.assertEqual(str(data), '<html><p>test</p></html>')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_post_process_false_return_content_false(self, mock_get):
         mock_get.return_value.status_code = 200
         mock_get.return_value.text = '<html><p>test</p></html>'
@@ -128,7 +190,7 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
         )
         self.assertEqual(str(data), '<html><p>test</p></html>')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_force_encoding_true(self, mock_get):
         mock_get.return_value.text = '<html><p>test</p></html>'
         mock_get.return_value.status_code = 200
@@ -138,7 +200,7 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
         )
         self.assertEqual(mock_get.return_value.encoding, 'utf-8')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_via_get(self, mock_get):
         mock_get.return_value.text = '<html><p>test</p></html>'
         mock_get.return_value.status_code = 200
@@ -146,7 +208,7 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
         data = self.base_collector.retrieve_uri('http://olhoneles.org')
         self.assertEqual(str(data), '<html><p>test</p></html>')
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_via_post(self, mock_post):
         mock_post.return_value.text = '<html><p>test</p></html>'
         mock_post.return_value.status_code = 200
@@ -158,6 +220,79 @@ class BaseCollectorRetrieveUriTestCase(BaseCollectorTestCase):
         self.assertEqual(str(data), '<html><p>test</p></html>')
 
 
+class BaseCollectorHTTPCacheTestCase(BaseCollectorTestCase):
+
+    def setUp(self):
+        super(BaseCollectorHTTPCacheTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.base_collector.http_cache = HTTPCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _response(self, status_code, content=''):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers['ETag'] = '"abc"'
+        response.raw = StringIO(content)
+        return response
+
+    @patch('requests.Session.get')
+    def test_revalidate_cached_response(self, mock_get):
+        mock_get.return_value = self._response(200, '<html><p>test</p></html>')
+        self.base_collector.retrieve_uri('http://olhoneles.org')
+
+        not_modified = self._response(304)
+        mock_get.return_value = not_modified
+        data = self.base_collector.retrieve_uri('http://olhoneles.org')
+
+        self.assertEqual(str(data), '<html><p>test</p></html>')
+        self.assertTrue(not_modified.raw.closed)
+        self.assertEqual(mock_get.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+
+    @patch('requests.Session.get')
+    def test_closed_month_from_disk(self, mock_get):
+        mock_get.return_value = self._response(200, '<html><p>test</p></html>')
+        self.base_collector.retrieve_uri('http://olhoneles.org', closed=True)
+
+        data = self.base_collector.retrieve_uri('http://olhoneles.org', closed=True)
+
+        self.assertEqual(str(data), '<html><p>test</p></html>')
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_is_closed_month(self):
+        today = date.today()
+        self.assertFalse(self.base_collector.is_closed_month(today.year, today.month))
+        self.assertTrue(self.base_collector.is_closed_month(today.year - 1, 1))
+
+
+class BaseCollectorSessionForTestCase(BaseCollectorTestCase):
+
+    def test_session_is_reused_per_host(self):
+        session = self.base_collector.session_for('http://olhoneles.org/a')
+
+        self.assertIs(self.base_collector.session_for('http://olhoneles.org/b'), session)
+        self.assertIsNot(self.base_collector.session_for('http://example.com/a'), session)
+
+    def test_session_uses_default_headers(self):
+        self.base_collector.default_headers = {'user-agent': 'test-agent'}
+
+        session = self.base_collector.session_for('http://olhoneles.org')
+        self.assertEqual(session.headers['user-agent'], 'test-agent')
+
+
+class BaseCollectorRetrieveManyTestCase(BaseCollectorTestCase):
+
+    @patch('requests.Session.get')
+    def test_retrieve_many(self, mock_get):
+        mock_get.side_effect = lambda uri, **kwargs: Mock(status_code=200, text=uri)
+
+        requests = [(i, 'http://example.com/{0}'.format(i), dict(post_process=False)) for i in range(5)]
+        results = dict(self.base_collector.retrieve_many(requests))
+
+        self.assertEqual(results, dict((i, 'http://example.com/{0}'.format(i)) for i in range(5)))
+
+
 class BaseCollectorCreateCollectionRunTestCase(BaseCollectorTestCase):
 
     def test_with_new_collection_run(self):
@@ -177,6 +312,130 @@ class BaseCollectorCreateCollectionRunTestCase(BaseCollectorTestCase):
         self.assertEqual(ArchivedExpense.objects.count(), 0)
 
 
+class BaseCollectorCheckpointsTestCase(BaseCollectorTestCase):
+
+    def setUp(self):
+        super(BaseCollectorCheckpointsTestCase, self).setUp()
+        self.previous_run = CollectionRunFactory.create(
+            legislature=self.legislature, date=date.today() - timedelta(days=30)
+        )
+
+    def test_start_month(self):
+        collection_run = self.base_collector.create_collection_run(self.legislature)
+        self.base_collector.collection_run = collection_run
+
+        self.base_collector.start_month(self.mandate, 2016, 1)
+        self.base_collector.add_expense(self._expense(collection_run))
+        self.base_collector.save_checkpoints()
+
+        checkpoint = CollectionCheckpoint.objects.get(mandate=self.mandate, year=2016, month=1)
+        self.assertEqual(checkpoint.collection_run, collection_run)
+        self.assertTrue(checkpoint.closed)
+        self.assertEqual(ArchivedExpense.objects.get().checkpoint, checkpoint)
+
+    def test_needs_update_without_incremental(self):
+        CollectionCheckpointFactory.create(mandate=self.mandate, year=2016, month=1,
+                                           collection_run=self.previous_run, closed=True)
+        self.base_collector.collection_run = self.base_collector.create_collection_run(self.legislature)
+
+        self.assertTrue(self.base_collector.needs_update(self.mandate, 2016, 1))
+
+    def test_incremental_copies_closed_months(self):
+        closed = CollectionCheckpointFactory.create(mandate=self.mandate, year=2016, month=1,
+                                                    collection_run=self.previous_run, closed=True)
+        still_open = CollectionCheckpointFactory.create(mandate=self.mandate, year=2016, month=2,
+                                                        collection_run=self.previous_run)
+        self._expense(self.previous_run, closed).save()
+        self._expense(self.previous_run, still_open).save()
+
+        self.base_collector.incremental = True
+        collection_run = self.base_collector.create_collection_run(self.legislature)
+        self.base_collector.collection_run = collection_run
+
+        self.assertFalse(self.base_collector.needs_update(self.mandate, 2016, 1))
+        self.assertTrue(self.base_collector.needs_update(self.mandate, 2016, 2))
+        self.assertTrue(self.base_collector.needs_update(self.mandate, 2016, 3))
+        self.base_collector.save_checkpoints()
+
+        copied = ArchivedExpense.objects.get(collection_run=collection_run)
+        self.assertEqual(copied.checkpoint, closed)
+
+        closed.refresh_from_db()
+        self.assertEqual(closed.collection_run, collection_run)
+        self.assertTrue(closed.closed)
+
+    def test_collecting_again_reopens_months(self):
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        checkpoint = CollectionCheckpointFactory.create(mandate=self.mandate, year=2016, month=1,
+                                                        collection_run=collection_run, closed=True)
+
+        self.base_collector.create_collection_run(self.legislature)
+
+        checkpoint.refresh_from_db()
+        self.assertFalse(checkpoint.closed)
+
+    def test_deleting_checkpoint_keeps_expenses(self):
+        checkpoint = CollectionCheckpointFactory.create(mandate=self.mandate, year=2016, month=1,
+                                                        collection_run=self.previous_run, closed=True)
+        self._expense(self.previous_run, checkpoint).save()
+
+        checkpoint.delete()
+
+        self.assertIsNone(ArchivedExpense.objects.get().checkpoint)
+
+
+class BaseCollectorResumeTestCase(BaseCollectorTestCase):
+
+    def setUp(self):
+        super(BaseCollectorResumeTestCase, self).setUp()
+        self.base_collector.resumable = True
+        self.previous_run = CollectionRunFactory.create(
+            legislature=self.legislature, date=date.today() - timedelta(days=1)
+        )
+
+    def test_expenses_written_with_progress(self):
+        self.base_collector.collection_run = self.previous_run
+        self.base_collector.expenses_batch_size = 2
+
+        self.base_collector.add_expense(self._expense(self.previous_run))
+        self.base_collector.add_expense(self._expense(self.previous_run))
+        self.base_collector.add_expense(self._expense(self.previous_run))
+        self.assertEqual(ArchivedExpense.objects.count(), 0)
+
+        self.base_collector.mark_progress('file.xml', 3)
+        self.assertEqual(ArchivedExpense.objects.count(), 3)
+        self.assertEqual(CollectionProgress.objects.get(collection_run=self.previous_run).position, 3)
+
+        self.base_collector.mark_progress('file.xml', 4)
+        self.base_collector.flush_expenses()
+        self.assertEqual(CollectionProgress.objects.get(collection_run=self.previous_run).position, 4)
+
+    def test_resume(self):
+        CollectionProgress.objects.create(collection_run=self.previous_run, unit='file.xml', position=10)
+        CollectionProgress.objects.create(collection_run=self.previous_run,
+                                          unit=self.base_collector.month_unit(self.mandate.id, 2016, 1))
+        self.base_collector.resume = True
+
+        collection_run = self.base_collector.create_collection_run(self.legislature)
+        self.base_collector.collection_run = collection_run
+
+        self.assertEqual(collection_run, self.previous_run)
+        self.assertEqual(self.base_collector.progress['file.xml'], 10)
+        self.assertFalse(self.base_collector.needs_update(self.mandate, 2016, 1))
+        self.assertTrue(self.base_collector.needs_update(self.mandate, 2016, 2))
+
+    def test_start_over(self):
+        self._expense(self.previous_run).save()
+        CollectionProgress.objects.create(collection_run=self.previous_run, unit='file.xml', position=1)
+
+        collection_run = self.base_collector.create_collection_run(self.legislature)
+
+        self.assertNotEqual(collection_run, self.previous_run)
+        self.assertFalse(CollectionRun.objects.filter(id=self.previous_run.id).exists())
+        self.assertEqual(ArchivedExpense.objects.count(), 0)
+        self.assertEqual(CollectionProgress.objects.count(), 0)
+
+
 class BaseCollectorUpdateDataTestCase(BaseCollectorTestCase):
 
     def test_update_data_for_year_was_called(self):
@@ -187,10 +446,47 @@ class BaseCollectorUpdateDataTestCase(BaseCollectorTestCase):
         self.assertEqual(self.base_collector.update_data_for_year.call_count, 1)
 
 
+class BaseCollectorAddExpenseTestCase(BaseCollectorTestCase):
+
+    def test_add_expense_in_batches(self):
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        self.base_collector.expenses_batch_size = 2
+
+        self.base_collector.add_expense(self._expense(collection_run))
+        self.assertEqual(ArchivedExpense.objects.count(), 0)
+
+        self.base_collector.add_expense(self._expense(collection_run))
+        self.assertEqual(ArchivedExpense.objects.count(), 2)
+
+        self.base_collector.add_expense(self._expense(collection_run))
+        self.assertEqual(ArchivedExpense.objects.count(), 2)
+
+        self.base_collector.flush_expenses()
+        self.assertEqual(ArchivedExpense.objects.count(), 3)
+
+    def test_flush_before_new_collection_run(self):
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        self.base_collector.add_expense(self._expense(collection_run))
+
+        self.base_collector.create_collection_run(LegislatureFactory.create())
+
+        self.assertEqual(ArchivedExpense.objects.filter(collection_run=collection_run).count(), 1)
+
+    def test_update_data_flushes_expenses(self):
+        def update_data_for_year(mandate, year):
+            self.base_collector.add_expense(self._expense(self.base_collector.collection_run))
+        self.base_collector.update_data_for_year = update_data_for_year
+
+        self.base_collector.update_data()
+
+        self.assertEqual(ArchivedExpense.objects.count(), 1)
+
+
 class BaseCollectorUpdateDataForYearTestCase(BaseCollectorTestCase):
 
     def test_update_data_for_year_was_called(self):
         self.base_collector.update_data_for_month = Mock()
+        self.base_collector.collection_run = CollectionRunFactory.create(legislature=self.legislature)
 
         self.base_collector.update_data_for_year(self.mandate, 2016)
 
@@ -234,6 +530,156 @@ class BaseCollectorMandateForLegislatorTestCase(BaseCollectorTestCase):
 
         self.assertEqual(mandate.original_id, 123)
 
+    def test_get_mandate_from_memory(self):
+        legislator = LegislatorFactory.create()
+        political_party = PoliticalPartyFactory.create()
+        mandate = MandateFactory.create(
+            legislature=self.legislature,
+            date_start=self.legislature.date_start,
+            legislator=legislator,
+            original_id='123',
+        )
+        self.base_collector.mandate_for_legislator(LegislatorFactory.create(), political_party)
+
+        with self.assertNumQueries(0):
+            found = self.base_collector.mandate_for_legislator(
+                legislator, political_party, original_id=123
+            )
+        self.assertEqual(found, mandate)
+
+    def test_update_original_id(self):
+        legislator = LegislatorFactory.create()
+        political_party = PoliticalPartyFactory.create()
+        mandate = MandateFactory.create(
+            legislature=self.legislature,
+            date_start=self.legislature.date_start,
+            legislator=legislator,
+            original_id='123',
+        )
+
+        self.base_collector.mandate_for_legislator(legislator, political_party, original_id=456)
+
+        mandate.refresh_from_db()
+        self.assertEqual(mandate.original_id, '456')
+
+    def test_mandate_for_other_legislature(self):
+        legislator = LegislatorFactory.create()
+        political_party = PoliticalPartyFactory.create()
+        legislature = LegislatureFactory.create()
+
+        mandate = self.base_collector.mandate_for_legislator(legislator, political_party)
+        other_mandate = self.base_collector.mandate_for_legislator(
+            legislator, political_party, legislature=legislature
+        )
+
+        self.assertEqual(mandate.legislature, self.legislature)
+        self.assertEqual(other_mandate.legislature, legislature)
+        self.assertNotEqual(mandate, other_mandate)
+
+
+class BaseCollectorGetOrCreateLegislatorTestCase(BaseCollectorTestCase):
+
+    def test_fold_name(self):
+        self.assertEqual(fold_name(u' José  da SILVA '), u'jose da silva')
+        self.assertEqual(fold_name('Jos\xc3\xa9'), u'jose')
+
+    def test_get_legislator_ignoring_case_and_accents(self):
+        existing = LegislatorFactory.create(name=u'José da Silva')
+
+        legislator, created = self.base_collector.get_or_create_legislator(u'JOSE DA SILVA')
+
+        self.assertFalse(created)
+        self.assertEqual(legislator, existing)
+
+    def test_get_legislator_from_memory(self):
+        existing = LegislatorFactory.create(name=u'José da Silva')
+        self.base_collector.get_or_create_legislator(u'Maria')
+
+        with self.assertNumQueries(0):
+            legislator, created = self.base_collector.get_or_create_legislator(u'José da silva')
+        self.assertEqual(legislator, existing)
+
+    def test_get_legislator_by_alternative_name(self):
+        existing = LegislatorFactory.create(name=u'Zé')
+        existing.alternative_names.add(AlternativeLegislatorName.objects.create(name=u'José da Silva'))
+
+        legislator, created = self.base_collector.get_or_create_legislator(u'Jose da Silva')
+
+        self.assertFalse(created)
+        self.assertEqual(legislator, existing)
+
+    def test_create_legislator(self):
+        legislator, created = self.base_collector.get_or_create_legislator(u'José da Silva')
+        same_legislator, same_created = self.base_collector.get_or_create_legislator(u'jose da silva')
+
+        self.assertTrue(created)
+        self.assertFalse(same_created)
+        self.assertEqual(legislator, same_legislator)
+        self.assertEqual(Legislator.objects.filter(name__icontains=u'silva').count(), 1)
+
+    def test_add_alternative_name(self):
+        legislator = LegislatorFactory.create(name=u'Zé')
+
+        self.base_collector.add_alternative_name(legislator, u'José da Silva')
+        self.base_collector.add_alternative_name(legislator, u'José da Silva')
+
+        self.assertEqual(
+            list(legislator.alternative_names.values_list('name', flat=True)),
+            [u'José da Silva']
+        )
+        self.assertEqual(self.base_collector.get_or_create_legislator(u'Jose da Silva'), (legislator, False))
+
+
+class BaseCollectorConcurrentHousesTestCase(BaseCollectorTestCase):
+    # Two houses collected in parallel, each with its own indexes, loaded
+    # before either of them created anything.
+
+    def setUp(self):
+        super(BaseCollectorConcurrentHousesTestCase, self).setUp()
+        self.other_collector = BaseCollector([], False)
+        self.other_collector.legislature = self.legislature
+        for collector in (self.base_collector, self.other_collector):
+            collector.load_suppliers()
+            collector.load_legislators()
+
+    def _flush_supplier(self, collector, identifier):
+        supplier = collector.get_or_create_supplier(identifier, 'Shared Supplier')
+        collector.flush_suppliers()
+        return supplier
+
+    def test_shared_supplier(self):
+        supplier = self._flush_supplier(self.base_collector, '01234567890')
+        other_supplier = self._flush_supplier(self.other_collector, '01234567890')
+
+        self.assertEqual(Supplier.objects.filter(identifier='01234567890').count(), 1)
+        self.assertEqual(other_supplier.id, supplier.id)
+
+    def test_shared_legislator(self):
+        legislator, created = self.base_collector.get_or_create_legislator(u'José da Silva')
+        other_legislator, other_created = self.other_collector.get_or_create_legislator(u'Jose da Silva')
+
+        self.assertTrue(created)
+        self.assertFalse(other_created)
+        self.assertEqual(other_legislator.id, legislator.id)
+        self.assertEqual(Legislator.objects.filter(name=u'José da Silva').count(), 1)
+
+    def test_shared_nature(self):
+        nature, created = self.base_collector.get_or_create_nature(u'Combustíveis')
+        other_nature, other_created = self.other_collector.get_or_create_nature(u'Combustíveis')
+
+        self.assertTrue(created)
+        self.assertEqual(other_nature.id, nature.id)
+
+    def test_writes_hold_the_lock(self):
+        lock = MagicMock()
+        self.base_collector.write_lock = lock
+
+        self._flush_supplier(self.base_collector, '01234567890')
+        self.base_collector.get_or_create_legislator(u'José da Silva')
+        self.base_collector.get_or_create_nature(u'Combustíveis')
+
+        self.assertEqual(lock.__enter__.call_count, 3)
+
 
 class BaseCollectorDebugTestCase(BaseCollectorTestCase):
 
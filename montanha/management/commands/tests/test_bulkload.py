@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date
+from decimal import Decimal
+
+from django.db import connection
+from django.test import TestCase
+
+from montanha.models import ArchivedExpense
+from montanha.tests.fixtures import (
+    ArchivedExpenseFactory, CollectionRunFactory, ExpenseNatureFactory, MandateFactory,
+    SupplierFactory
+)
+from montanha.management.commands.collectors.bulkload import (
+    BulkLoader, PostgreSQLBulkLoader, SQLiteBulkLoader, bulk_load, loader_for
+)
+
+
+class BulkLoaderTestCase(TestCase):
+
+    def setUp(self):
+        run = CollectionRunFactory.create()
+        nature = ExpenseNatureFactory.create()
+        mandate = MandateFactory.create()
+        supplier = SupplierFactory.create()
+        self.expenses = [
+            ArchivedExpenseFactory.build(collection_run=run, nature=nature, mandate=mandate,
+                                         supplier=supplier, value=None, expensed=Decimal('10.5'),
+                                         date=date(2016, 3, day), number=u'nº %d' % day)
+            for day in range(1, 6)
+        ]
+
+    def _assert_loaded(self):
+        loaded = ArchivedExpense.objects.order_by('date')
+        self.assertEqual([e.number for e in loaded], [e.number for e in self.expenses])
+        self.assertEqual([e.date for e in loaded], [e.date for e in self.expenses])
+        self.assertEqual(set(e.value for e in loaded), set([None]))
+        self.assertEqual(set(e.expensed for e in loaded), set([Decimal('10.5')]))
+
+    def test_loader_for(self):
+        self.assertIsInstance(loader_for(ArchivedExpense), SQLiteBulkLoader)
+
+    def test_bulk_load(self):
+        bulk_load(ArchivedExpense, self.expenses, batch_size=2)
+        self._assert_loaded()
+
+    def test_multi_row_insert(self):
+        BulkLoader(ArchivedExpense).load(self.expenses, batch_size=2)
+        self._assert_loaded()
+
+
+class PostgreSQLBulkLoaderTestCase(TestCase):
+
+    def test_copy_value(self):
+        loader = PostgreSQLBulkLoader(ArchivedExpense, connection)
+        self.assertEqual(loader.copy_value(None), u'\\N')
+        self.assertEqual(loader.copy_value(True), u't')
+        self.assertEqual(loader.copy_value(0.1), u'0.1')
+        self.assertEqual(loader.copy_value(date(2016, 3, 1)), u'2016-03-01')
+        self.assertEqual(loader.copy_value(u'a\tb\\c\nd'), u'a\\tb\\\\c\\nd')
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+from datetime import date
+from io import BytesIO
+from zipfile import ZipFile
+
+import requests
+from django.test import TestCase
+from mock import Mock, patch
+
+from montanha.management.commands.collectors.cdep import CamaraDosDeputados
+
+
+EXPENSE = u'''<DESPESA>
+<txNomeParlamentar>FULANO DE TAL</txNomeParlamentar>
+<ideCadastro>{id}</ideCadastro>
+<nuLegislatura>{legislature}</nuLegislatura>
+<sgUF>MG</sgUF>
+<sgPartido>PT</sgPartido>
+<txtDescricao>COMBUSTÍVEIS E LUBRIFICANTES.</txtDescricao>
+<txtBeneficiario>POSTO DE GASOLINA</txtBeneficiario>
+<txtCNPJCPF>12345678000190</txtCNPJCPF>
+<txtNumero> 42 </txtNumero>
+<datEmissao>2016-03-04T00:00:00</datEmissao>
+<vlrLiquido>100.5</vlrLiquido>
+<numMes>3</numMes>
+<numAno>2016</numAno>
+</DESPESA>'''
+
+
+class ParsedRowsTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.collector = CamaraDosDeputados([])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _create_zip(self, name, legislatures):
+        expenses = u''.join(EXPENSE.format(id=i, legislature=legislature)
+                            for i, legislature in enumerate(legislatures))
+        contents = u'<?xml version="1.0" encoding="utf-8"?><DESPESAS>%s</DESPESAS>' % expenses
+
+        zip_path = os.path.join(self.path, name + '.zip')
+        with ZipFile(zip_path, 'w') as zf:
+            zf.writestr(name + '.xml', contents.encode('utf-8'))
+        return zip_path
+
+    def test_parsed_rows(self):
+        zip_path = self._create_zip('AnoAtual', [2015, 2011, 2015])
+
+        rows = list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 0)], (2015, 2018)))
+
+        self.assertEqual(rows, [
+            ('AnoAtual.xml', (
+                position, u'Fulano De Tal', u'Combustíveis E Lubrificantes.', u'12345678000190',
+                u'Posto De Gasolina', u'42', date(2016, 3, 1), 100.5, u'PT', u'MG', str(original_id),
+            ))
+            for position, original_id in ((1, 0), (3, 2))
+        ])
+
+    def test_parsed_rows_skips_done_entries(self):
+        files = [
+            (self._create_zip('AnoAnterior', [2015, 2015]), 'AnoAnterior.xml', 1),
+            (self._create_zip('AnoAtual', [2015, 2015, 2015]), 'AnoAtual.xml', 0),
+        ]
+
+        rows = list(self.collector.parsed_rows(files, (2015, 2018)))
+
+        positions = sorted((unit, row[0]) for unit, row in rows)
+        self.assertEqual(positions, [
+            ('AnoAnterior.xml', 2), ('AnoAtual.xml', 1), ('AnoAtual.xml', 2), ('AnoAtual.xml', 3),
+        ])
+
+    def test_parsed_rows_with_broken_file(self):
+        zip_path = self._create_zip('AnoAtual', [2015])
+
+        with self.assertRaises(RuntimeError):
+            list(self.collector.parsed_rows([(zip_path, 'Missing.xml', 0)], (2015, 2018)))
+
+    def test_parsed_rows_cache(self):
+        zip_path = self._create_zip('AnoAtual', [2015, 2015, 2015])
+        cache_path = os.path.join(self.path, 'parsed-cache')
+
+        rows = list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 0)], (2015, 2018), cache_path))
+        self.assertEqual(len(os.listdir(cache_path)), 1)
+
+        # The unchanged file is not parsed again.
+        with patch('montanha.management.commands.collectors.cdep.parse_batches', side_effect=AssertionError):
+            cached = list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 0)], (2015, 2018), cache_path))
+            self.assertEqual(cached, rows)
+
+            resumed = list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 2)], (2015, 2018), cache_path))
+            self.assertEqual(resumed, rows[2:])
+
+    def test_parsed_rows_cache_replaces_changed_file(self):
+        cache_path = os.path.join(self.path, 'parsed-cache')
+
+        zip_path = self._create_zip('AnoAtual', [2015])
+        list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 0)], (2015, 2018), cache_path))
+        first_entries = os.listdir(cache_path)
+
+        zip_path = self._create_zip('AnoAtual', [2015, 2015])
+        rows = list(self.collector.parsed_rows([(zip_path, 'AnoAtual.xml', 0)], (2015, 2018), cache_path))
+
+        self.assertEqual(len(rows), 2)
+        entries = os.listdir(cache_path)
+        self.assertEqual(len(entries), 1)
+        self.assertNotEqual(entries, first_entries)
+
+
+class UpdateDataTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.path, 'data', 'cdep')
+        os.makedirs(self.data_path)
+
+        self.collector = CamaraDosDeputados([])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @patch('os.getcwd')
+    def test_error_page_keeps_archive(self, getcwd):
+        getcwd.return_value = self.path
+        zip_path = os.path.join(self.data_path, 'AnoAtual.zip')
+        with open(zip_path, 'wb') as f:
+            f.write('good zip')
+
+        response = requests.Response()
+        response.status_code = 503
+        response.raw = BytesIO('<html>Service Unavailable</html>')
+        self.collector.session_for = Mock(return_value=Mock(get=Mock(return_value=response)))
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.collector.update_data()
+
+        with open(zip_path, 'rb') as f:
+            self.assertEqual(f.read(), 'good zip')
+        self.assertEqual(os.listdir(self.data_path), ['AnoAtual.zip'])
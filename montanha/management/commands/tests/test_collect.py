@@ -15,15 +15,22 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from multiprocessing import Queue, RLock
 
+from django.db import DatabaseError, connection, connections
+from django.db.backends.utils import CursorWrapper
 from django.core.management.base import CommandError
 from django.core.management import call_command
 from django.test import TestCase
-from mock import patch, call
+from mock import patch, call, MagicMock, Mock
 
+from montanha.management.commands.collect import Command, LockedCursorWrapper, QueueWriter, collect_task
+from montanha.models import CollectionProgress, CollectionRun, Expense, PendingConsolidation
 from montanha.tests.fixtures import (
-    InstitutionFactory, LegislatureFactory, CollectionRunFactory
+    InstitutionFactory, LegislatureFactory, CollectionRunFactory,
+    MandateFactory, ExpenseFactory, ArchivedExpenseFactory, ExpenseNatureFactory,
+    SupplierFactory
 )
 
 
@@ -41,6 +48,10 @@ class CollectCommandsTestCase(TestCase):
         with self.assertRaises(CommandError):
             call_command('collect')
 
+    def test_command_collect_with_unknown_house(self):
+        with self.assertRaises(CommandError):
+            call_command('collect', 'xyz')
+
     @patch('montanha.management.commands.collect.Command.collection_runs')
     @patch('montanha.management.commands.collect.call_command')
     @patch('montanha.management.commands.collectors.almg.ALMG')
@@ -58,9 +69,46 @@ class CollectCommandsTestCase(TestCase):
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertIn(call().update_legislators_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'almg')]
+            mock_call_command.mock_calls, [call('consolidate', 'almg', incremental=True, jobs=1)]
         )
 
+    @patch('montanha.management.commands.collect.Command.collection_runs')
+    @patch('montanha.management.commands.collect.call_command')
+    @patch('montanha.management.commands.collectors.almg.ALMG')
+    def test_with_incremental(
+            self, mock_institution, mock_call_command, collection_runs_mock):
+
+        self._create_instituiton('ALMG')
+        collection_runs_mock.__iter__.return_value = []
+
+        call_command('collect', 'almg', '--incremental')
+
+        self.assertTrue(mock_institution.return_value.incremental)
+
+    @patch('montanha.management.commands.collect.Command.collection_runs')
+    @patch('montanha.management.commands.collect.call_command')
+    @patch('montanha.management.commands.collectors.cdep.CamaraDosDeputados')
+    def test_with_resume(
+            self, mock_institution, mock_call_command, collection_runs_mock):
+
+        self._create_instituiton('CDEP')
+        collection_runs_mock.__iter__.return_value = []
+
+        call_command('collect', 'cdep', '--resume')
+
+        self.assertTrue(mock_institution.return_value.resume)
+
+    @patch('montanha.management.commands.collectors.senado.Senado')
+    @patch('montanha.management.commands.collectors.cdep.CamaraDosDeputados')
+    def test_with_resume_not_resumable(self, mock_cdep, mock_senado):
+        mock_senado.resumable = False
+
+        with self.assertRaises(CommandError):
+            call_command('collect', 'cdep', 'senado', '--resume')
+
+        mock_cdep.assert_not_called()
+        mock_senado.assert_not_called()
+
     @patch('montanha.management.commands.collect.Command.collection_runs')
     @patch('montanha.management.commands.collect.call_command')
     @patch('montanha.management.commands.collectors.algo.ALGO')
@@ -77,7 +125,7 @@ class CollectCommandsTestCase(TestCase):
         self.assertIn(call().update_legislators(), mock_institution.mock_calls)
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'algo')]
+            mock_call_command.mock_calls, [call('consolidate', 'algo', incremental=True, jobs=1)]
         )
 
     @patch('montanha.management.commands.collect.Command.collection_runs')
@@ -95,7 +143,7 @@ class CollectCommandsTestCase(TestCase):
 
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'senado')]
+            mock_call_command.mock_calls, [call('consolidate', 'senado', incremental=True, jobs=1)]
         )
 
     @patch('montanha.management.commands.collect.Command.collection_runs')
@@ -114,7 +162,7 @@ class CollectCommandsTestCase(TestCase):
         self.assertIn(call().update_legislators(), mock_institution.mock_calls)
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'cmbh')]
+            mock_call_command.mock_calls, [call('consolidate', 'cmbh', incremental=True, jobs=1)]
         )
 
     @patch('montanha.management.commands.collect.Command.collection_runs')
@@ -132,7 +180,7 @@ class CollectCommandsTestCase(TestCase):
 
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'cmsp')]
+            mock_call_command.mock_calls, [call('consolidate', 'cmsp', incremental=True, jobs=1)]
         )
 
     @patch('montanha.management.commands.collect.Command.collection_runs')
@@ -150,5 +198,289 @@ class CollectCommandsTestCase(TestCase):
 
         self.assertIn(call().update_data(), mock_institution.mock_calls)
         self.assertEqual(
-            mock_call_command.mock_calls, [call('consolidate', 'cdep')]
+            mock_call_command.mock_calls, [call('consolidate', 'cdep', incremental=True, jobs=1)]
+        )
+
+    @patch('montanha.management.commands.collect.Command.collection_runs')
+    @patch('montanha.management.commands.collect.call_command')
+    @patch('montanha.management.commands.collectors.cmsp.CMSP')
+    @patch('montanha.management.commands.collectors.senado.Senado')
+    def test_with_two_instituitons_and_jobs(
+            self, mock_senado, mock_cmsp, mock_call_command, collection_runs_mock):
+
+        collection_runs_mock.__iter__.return_value = []
+
+        call_command('collect', 'senado', 'cmsp', '--jobs=2')
+
+        self.assertEqual(
+            mock_call_command.mock_calls,
+            [call('consolidate', 'senado', 'cmsp', incremental=True, jobs=2)]
+        )
+
+    def test_record_changes(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+
+        unchanged = ExpenseFactory.create(mandate=mandate, date=date(2016, 1, 10))
+        changed = ExpenseFactory.create(mandate=mandate, date=date(2016, 2, 10))
+        ExpenseFactory.create(mandate=mandate, date=date(2016, 3, 10))
+
+        for expense in [unchanged, changed]:
+            ArchivedExpenseFactory.create(
+                collection_run=collection_run, mandate=mandate, nature=expense.nature,
+                date=expense.date, expensed=expense.expensed
+            )
+        changed.expensed += 1
+        changed.save()
+        added = ArchivedExpenseFactory.create(
+            collection_run=collection_run, mandate=mandate, date=date(2016, 4, 10)
+        )
+
+        Command().record_changes(collection_run)
+
+        self.assertEqual(
+            sorted(PendingConsolidation.objects.values_list('year', 'month')),
+            [(2016, 2), (2016, 3), (2016, 4)]
+        )
+        pending = PendingConsolidation.objects.get(month=4)
+        self.assertEqual(pending.institution, self.legislature.institution)
+        self.assertEqual(pending.nature, added.nature)
+        self.assertEqual(pending.legislator, mandate.legislator)
+
+    @patch('montanha.management.commands.collect.COMMIT_CHUNK_SIZE', 2)
+    def test_commit_collection_run(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        other_mandate = MandateFactory.create()
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+
+        ExpenseFactory.create(mandate=mandate)
+        kept = ExpenseFactory.create(mandate=other_mandate)
+        archived = [
+            ArchivedExpenseFactory.create(collection_run=collection_run, mandate=mandate)
+            for x in range(5)
+        ]
+        ArchivedExpenseFactory.create(mandate=mandate)
+
+        Command().commit_collection_run(collection_run)
+
+        self.assertTrue(collection_run.committed)
+        self.assertEqual(
+            sorted(Expense.objects.filter(mandate=mandate).values_list('number', flat=True)),
+            sorted(a.number for a in archived)
+        )
+        self.assertEqual(list(Expense.objects.filter(mandate=other_mandate)), [kept])
+
+    def test_commit_collection_run_is_atomic(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        kept = ExpenseFactory.create(mandate=mandate)
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        ArchivedExpenseFactory.create(collection_run=collection_run, mandate=mandate)
+        ArchivedExpenseFactory.create(collection_run=collection_run, mandate=mandate)
+
+        execute = CursorWrapper.execute
+        inserts = []
+
+        def fail_second_insert(cursor, sql, params=None):
+            if sql.startswith('insert into montanha_expense'):
+                inserts.append(sql)
+                if len(inserts) == 2:
+                    raise DatabaseError('disk full')
+            return execute(cursor, sql, params)
+
+        with patch('montanha.management.commands.collect.COMMIT_CHUNK_SIZE', 1), \
+                patch.object(CursorWrapper, 'execute', autospec=True, side_effect=fail_second_insert):
+            with self.assertRaises(DatabaseError):
+                Command().commit_collection_run(collection_run)
+
+        self.assertEqual(list(Expense.objects.all()), [kept])
+        self.assertFalse(CollectionRun.objects.get(id=collection_run.id).committed)
+
+    @patch('montanha.management.commands.collect.invalidate_model')
+    def test_commit_collection_run_invalidates_expenses(self, invalidate_model):
+        self._create_instituiton('ALMG')
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        ArchivedExpenseFactory.create(collection_run=collection_run)
+
+        Command().commit_collection_run(collection_run)
+
+        invalidate_model.assert_called_once_with(Expense)
+
+    def test_commit_empty_collection_run(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+        ExpenseFactory.create(mandate=mandate)
+
+        Command().commit_collection_run(collection_run)
+
+        self.assertEqual(Expense.objects.count(), 0)
+
+    def test_diff_collection_run(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+
+        unchanged = ExpenseFactory.create(mandate=mandate, date=date(2016, 1, 10))
+        removed = ExpenseFactory.create(mandate=mandate, date=date(2016, 2, 10))
+        ArchivedExpenseFactory.create(
+            collection_run=collection_run, mandate=mandate, number=unchanged.number,
+            nature=unchanged.nature, supplier=unchanged.supplier, date=unchanged.date,
+            value=unchanged.value, expensed=unchanged.expensed
+        )
+        added = ArchivedExpenseFactory.create(
+            collection_run=collection_run, mandate=mandate, date=date(2016, 3, 10)
+        )
+
+        changes = Command().diff_collection_run(collection_run)
+
+        self.assertTrue(collection_run.committed)
+        self.assertEqual(
+            sorted(Expense.objects.values_list('id', 'number')),
+            sorted([(unchanged.id, unchanged.number), (Expense.objects.get(number=added.number).id, added.number)])
+        )
+        self.assertFalse(Expense.objects.filter(id=removed.id).exists())
+        self.assertEqual(changes, set([
+            (removed.nature_id, mandate.legislator_id, 2016, 2),
+            (added.nature_id, mandate.legislator_id, 2016, 3),
+        ]))
+        self.assertEqual(
+            sorted(PendingConsolidation.objects.values_list('year', 'month')),
+            [(2016, 2), (2016, 3)]
+        )
+
+    def test_diff_collection_run_with_duplicated_expenses(self):
+        self._create_instituiton('ALMG')
+        mandate = MandateFactory.create(legislature=self.legislature)
+        collection_run = CollectionRunFactory.create(legislature=self.legislature)
+
+        expense = ExpenseFactory.create(mandate=mandate, date=date(2016, 1, 10))
+        for x in range(2):
+            ArchivedExpenseFactory.create(
+                collection_run=collection_run, mandate=mandate, number=expense.number,
+                nature=expense.nature, supplier=expense.supplier, date=expense.date,
+                value=expense.value, expensed=expense.expensed
+            )
+
+        Command().diff_collection_run(collection_run)
+
+        self.assertEqual(Expense.objects.filter(number=expense.number).count(), 2)
+        self.assertTrue(Expense.objects.filter(id=expense.id).exists())
+
+    @patch('montanha.management.commands.collect.Command.diff_collection_run')
+    @patch('montanha.management.commands.collect.Command.collection_runs')
+    @patch('montanha.management.commands.collect.call_command')
+    @patch('montanha.management.commands.collectors.senado.Senado')
+    def test_with_diff_commit(
+            self, mock_institution, mock_call_command, collection_runs_mock, diff_mock):
+
+        self._create_instituiton('SENADO')
+
+        collection_run = CollectionRunFactory.create()
+        collection_runs_mock.__iter__.return_value = [collection_run]
+
+        call_command('collect', 'senado', '--commit=diff')
+
+        diff_mock.assert_called_once_with(collection_run)
+
+
+class CollectInParallelTestCase(TestCase):
+
+    def _options(self):
+        return dict(commit='replace', jobs=1, incremental=False, resume=False)
+
+    @patch('montanha.management.commands.collect.lock_writes')
+    @patch('montanha.management.commands.collectors.almg.ALMG')
+    def test_collect_task(self, mock_institution, lock_writes_mock):
+        queue = Queue()
+        write_lock = RLock()
+
+        collect_task('almg', self._options(), queue, write_lock)
+
+        self.assertIn(call().update_data(), mock_institution.mock_calls)
+        self.assertIsInstance(mock_institution.return_value.writer, QueueWriter)
+        self.assertIs(mock_institution.return_value.write_lock, write_lock)
+        lock_writes_mock.assert_called_once_with(connections['default'], write_lock)
+        self.assertEqual(queue.get(timeout=1), ('done', 'almg', []))
+
+    @patch('montanha.management.commands.collect.lock_writes')
+    @patch('montanha.management.commands.collectors.almg.ALMG')
+    def test_collect_task_with_error(self, mock_institution, lock_writes_mock):
+        mock_institution.return_value.update_data.side_effect = RuntimeError('Unable to retrieve')
+        queue = Queue()
+
+        collect_task('almg', self._options(), queue, RLock())
+
+        kind, house, error = queue.get(timeout=1)
+        self.assertEqual((kind, house), ('error', 'almg'))
+        self.assertIn('Unable to retrieve', error)
+
+    @patch('montanha.management.commands.collect.call_command')
+    def test_write_collected(self, mock_call_command):
+        mandate = MandateFactory.create()
+        collection_run = CollectionRunFactory.create(legislature=mandate.legislature)
+        expense = ArchivedExpenseFactory.build(
+            collection_run=collection_run, mandate=mandate,
+            nature=ExpenseNatureFactory.create(), supplier=SupplierFactory.create()
+        )
+
+        queue = Queue()
+        QueueWriter(queue).write(collection_run.id, [expense], {'file.xml': 1}, [])
+        queue.put(('done', 'almg', [collection_run.id]))
+
+        write_lock = MagicMock()
+        failed = Command().write_collected(queue, {'almg': Mock()}, self._options(), write_lock)
+
+        self.assertEqual(failed, set())
+        self.assertEqual(write_lock.__enter__.call_count, 2)
+        self.assertEqual(list(Expense.objects.values_list('number', flat=True)), [expense.number])
+        self.assertTrue(CollectionRun.objects.get(id=collection_run.id).committed)
+        self.assertEqual(CollectionProgress.objects.get().unit, 'file.xml')
+        self.assertEqual(
+            mock_call_command.mock_calls, [call('consolidate', 'almg', incremental=True, jobs=1)]
         )
+
+    @patch('montanha.management.commands.collect.call_command')
+    def test_write_collected_with_error(self, mock_call_command):
+        queue = Queue()
+        queue.put(('error', 'almg', 'Traceback'))
+
+        failed = Command().write_collected(queue, {'almg': Mock()}, self._options())
+
+        self.assertEqual(failed, set(['almg']))
+        self.assertFalse(mock_call_command.called)
+
+    @patch('montanha.management.commands.collect.call_command')
+    def test_write_collected_with_dead_collector(self, mock_call_command):
+        process = Mock()
+        process.is_alive.return_value = False
+
+        failed = Command().write_collected(Queue(), {'almg': process}, self._options())
+
+        self.assertEqual(failed, set(['almg']))
+
+    @patch('montanha.management.commands.collect.connections')
+    @patch('montanha.management.commands.collect.Process')
+    @patch.object(Command, 'write_collected')
+    def test_collect_in_parallel_with_writer_error(self, write_collected_mock, process_mock, connections_mock):
+        write_collected_mock.side_effect = RuntimeError('database is locked')
+        process_mock.return_value.is_alive.return_value = True
+
+        with self.assertRaises(RuntimeError):
+            Command().collect_in_parallel(['almg', 'cmbh'], self._options())
+
+        self.assertEqual(process_mock.return_value.terminate.call_count, 2)
+        self.assertEqual(process_mock.return_value.join.call_count, 2)
+
+    def test_locked_cursor_wrapper(self):
+        lock = MagicMock()
+        cursor = LockedCursorWrapper(connection.cursor().cursor, connection, lock)
+
+        cursor.execute('SELECT COUNT(*) FROM montanha_expensenature')
+        self.assertFalse(lock.__enter__.called)
+
+        cursor.execute('INSERT INTO montanha_expensenature (name) VALUES (%s)', ['Locked'])
+        self.assertEqual(lock.__enter__.call_count, 1)
+        self.assertEqual(lock.__exit__.call_count, 1)
@@ -16,23 +16,32 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import datetime, timedelta, date
+from decimal import Decimal
+from unittest import skipIf
 
 from mock import patch, call
 from django.test import TestCase
 from django.core.management import call_command
+from django.core.management.base import CommandError
 
-from montanha.management.commands.consolidate import Command
+from montanha.management.commands.consolidate import Command, consolidate_task
+from montanha.management.commands.consolidators.sql import SQLConsolidator
 from montanha.models import (
     PerNature, PerNatureByYear, PerNatureByMonth, PerLegislator,
-    BiggestSupplierForYear
+    BiggestSupplierForYear, PendingConsolidation
 )
 from montanha.tests.fixtures import (
     InstitutionFactory, LegislatureFactory, PerNatureFactory,
     PerNatureByYearFactory, PerNatureByMonthFactory, ExpenseFactory,
     MandateFactory, PerLegislatorFactory, BiggestSupplierForYearFactory,
-    SupplierFactory
+    SupplierFactory, ExpenseNatureFactory, PendingConsolidationFactory
 )
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class ConsolidateCommandsTestCase(TestCase):
 
@@ -98,6 +107,37 @@ class ConsolidateCommandsTestCase(TestCase):
         per_nature_mock.assert_not_called()
         per_legislator_mock.assert_not_called()
 
+    @patch('montanha.management.commands.consolidate.connections')
+    @patch('montanha.management.commands.consolidate.Pool')
+    def test_with_jobs(self, pool_mock, connections_mock):
+        pool_mock.return_value.map.return_value = [set(), set()]
+
+        call_command('consolidate', 'ALMG', 'ALGO', '--agnostic', '--jobs=2')
+
+        pool_mock.assert_called_once_with(2)
+        connections_mock.close_all.assert_called_once()
+        pool_mock.return_value.map.assert_called_once_with(
+            consolidate_task,
+            [('ALMG', 'sql', False), ('ALGO', 'sql', False), (None, 'sql', False)],
+            chunksize=1
+        )
+        pool_mock.return_value.join.assert_called_once()
+
+    @patch.object(Command, 'agnostic')
+    @patch.object(Command, 'per_legislator')
+    @patch.object(Command, 'per_nature')
+    def test_consolidate_task(self, per_nature_mock, per_legislator_mock, agnostic_mock):
+        consolidate_task(('ALMG', 'sql', False))
+        consolidate_task((None, 'sql', False))
+
+        per_nature_mock.assert_called_once_with(self.institutions['ALMG'])
+        per_legislator_mock.assert_called_once_with(self.institutions['ALMG'])
+        agnostic_mock.assert_called_once_with()
+
+    def test_with_invalid_jobs(self):
+        with self.assertRaises(CommandError):
+            call_command('consolidate', 'ALMG', '--jobs=0')
+
     @patch.object(Command, 'agnostic')
     @patch.object(Command, 'per_legislator')
     @patch.object(Command, 'per_nature')
@@ -121,6 +161,16 @@ class ConsolidateCommandsBaseTestCase(ConsolidateCommandsTestCase):
             date_end=self.legislature.date_end,
         )
 
+    def _consolidated(self, *args):
+        call_command('consolidate', self.institutions_siglum, *args)
+
+        data = []
+        for model in [PerNature, PerNatureByYear, PerNatureByMonth,
+                      PerLegislator, BiggestSupplierForYear]:
+            fields = [f.attname for f in model._meta.fields if f.attname != 'id']
+            data.append(sorted(model.objects.values_list(*fields)))
+        return data
+
 
 class ConsolidateCommandsPerNatureTestCase(ConsolidateCommandsBaseTestCase):
 
@@ -143,6 +193,23 @@ class ConsolidateCommandsPerNatureTestCase(ConsolidateCommandsBaseTestCase):
         self.assertEqual(by_year, 0)
         self.assertEqual(by_month, 0)
 
+    @patch.object(SQLConsolidator, 'nature_totals_by_month')
+    def test_per_nature_keeps_old_data_until_done(self, nature_totals_by_month_mock):
+        nature_totals_by_month_mock.side_effect = RuntimeError
+        institution = self.institutions[self.institutions_siglum]
+        PerNatureFactory.create(
+            institution=institution,
+            legislature=self.legislatures[self.institutions_siglum],
+        )
+        PerNatureByMonthFactory.create(institution=institution)
+        ExpenseFactory.create(mandate=self.mandate, expensed=10, value=10)
+
+        with self.assertRaises(RuntimeError):
+            call_command('consolidate', self.institutions_siglum)
+
+        self.assertEqual(PerNature.objects.count(), 1)
+        self.assertEqual(PerNatureByMonth.objects.count(), 1)
+
     def test_per_nature_totals(self):
         date = datetime.today() + timedelta(days=2)
         ExpenseFactory.create(mandate=self.mandate, date=date, expensed=10, value=10)
@@ -162,6 +229,28 @@ class ConsolidateCommandsPerNatureTestCase(ConsolidateCommandsBaseTestCase):
         self.assertEqual(per_nature[3].legislature, self.legislature)
         self.assertEqual(per_nature[3].expensed, 5)
 
+    def test_per_nature_totals_for_each_legislature(self):
+        institution = self.institutions[self.institutions_siglum]
+        next_legislature = LegislatureFactory.create(
+            date_start=self.legislature.date_end + timedelta(days=1),
+            date_end=self.legislature.date_end + timedelta(days=365 * 4),
+            institution=institution
+        )
+        date = self.legislature.date_start + timedelta(days=10)
+        ExpenseFactory.create(mandate=self.mandate, date=date, expensed=10, value=10)
+
+        call_command('consolidate', self.institutions_siglum)
+
+        per_nature = PerNature.objects.filter(legislature=self.legislature)
+        self.assertEqual(len(per_nature), 1)
+        self.assertEqual(per_nature[0].expensed, 10)
+        self.assertEqual(per_nature[0].date_start, date)
+        self.assertEqual(per_nature[0].date_end, date)
+
+        per_nature = PerNature.objects.filter(legislature=next_legislature)
+        self.assertEqual(len(per_nature), 1)
+        self.assertEqual(per_nature[0].expensed, 0)
+
     def test_per_nature_by_month_totals(self):
         date = self.legislature.date_start
         ExpenseFactory.create(mandate=self.mandate, date=date, expensed=7, value=7)
@@ -211,6 +300,42 @@ class ConsolidateCommandsPerLegislatorTestCase(ConsolidateCommandsBaseTestCase):
         self.assertEqual(per_legislator[1].legislature, None)
         self.assertEqual(per_legislator[1].expensed, 10)
 
+    def test_per_legislator_totals_for_each_legislature(self):
+        institution = self.institutions[self.institutions_siglum]
+        next_legislature = LegislatureFactory.create(
+            date_start=self.legislature.date_end + timedelta(days=1),
+            date_end=self.legislature.date_end + timedelta(days=365 * 4),
+            institution=institution
+        )
+        next_mandate = MandateFactory.create(
+            legislator=self.mandate.legislator,
+            legislature=next_legislature,
+            date_start=next_legislature.date_start,
+            date_end=next_legislature.date_end,
+        )
+        other_mandate = MandateFactory.create(
+            legislature=self.legislature,
+            date_start=self.legislature.date_start,
+            date_end=self.legislature.date_end,
+        )
+        ExpenseFactory.create(mandate=self.mandate, expensed=10, value=10)
+        ExpenseFactory.create(mandate=next_mandate, expensed=5, value=5)
+        ExpenseFactory.create(mandate=other_mandate, expensed=3, value=3)
+
+        call_command('consolidate', self.institutions_siglum)
+
+        per_legislator = PerLegislator.objects.filter(legislator=self.mandate.legislator)
+        self.assertEqual(len(per_legislator), 3)
+        self.assertEqual(per_legislator.get(legislature=self.legislature).expensed, 10)
+        self.assertEqual(per_legislator.get(legislature=next_legislature).expensed, 5)
+        self.assertEqual(per_legislator.get(legislature=None).expensed, 15)
+
+        per_legislator = PerLegislator.objects.filter(legislator=other_mandate.legislator)
+        self.assertEqual(len(per_legislator), 3)
+        self.assertEqual(per_legislator.get(legislature=self.legislature).expensed, 3)
+        self.assertEqual(per_legislator.get(legislature=next_legislature).expensed, 0)
+        self.assertEqual(per_legislator.get(legislature=None).expensed, 3)
+
 
 class ConsolidateCommandsAgnosticTestCase(ConsolidateCommandsBaseTestCase):
 
@@ -247,3 +372,101 @@ class ConsolidateCommandsAgnosticTestCase(ConsolidateCommandsBaseTestCase):
         self.assertEqual(len(biggest_supplier), 2)
         self.assertEqual(biggest_supplier[0].expensed, 12)
         self.assertEqual(biggest_supplier[1].expensed, 10)
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class ConsolidateCommandsNumpyEngineTestCase(ConsolidateCommandsBaseTestCase):
+
+    def test_same_totals_as_sql_engine(self):
+        supplier = SupplierFactory.create()
+        date = self.legislature.date_start
+        for days, expensed in [(0, '10.01'), (3, '0.02'), (40, '5.10'), (400, '7.33')]:
+            ExpenseFactory.create(
+                mandate=self.mandate, supplier=supplier, date=date + timedelta(days=days),
+                expensed=Decimal(expensed), value=Decimal(expensed)
+            )
+        ExpenseFactory.create(mandate=self.mandate, date=date, expensed=3, value=3)
+
+        self.assertEqual(self._consolidated('--agnostic'), self._consolidated('--agnostic', '--engine=numpy'))
+
+    def test_exact_cents(self):
+        for x in range(10):
+            ExpenseFactory.create(mandate=self.mandate, expensed=Decimal('0.10'), value=0)
+
+        call_command('consolidate', self.institutions_siglum, '--engine=numpy')
+
+        per_legislator = PerLegislator.objects.get(legislature=None)
+        self.assertEqual(per_legislator.expensed, Decimal('1.00'))
+
+
+class ConsolidateCommandsEngineTestCase(ConsolidateCommandsBaseTestCase):
+
+    def test_numpy_engine_without_numpy(self):
+        with patch.dict('sys.modules', {'numpy': None}):
+            with self.assertRaises(CommandError):
+                call_command('consolidate', self.institutions_siglum, '--engine=numpy')
+
+
+class ConsolidateCommandsIncrementalTestCase(ConsolidateCommandsBaseTestCase):
+
+    def _pending(self, expense):
+        PendingConsolidationFactory.create(
+            institution=self.institutions[self.institutions_siglum],
+            nature=expense.nature,
+            legislator=expense.mandate.legislator,
+            year=expense.date.year,
+            month=expense.date.month,
+        )
+
+    def test_incremental_same_totals_as_full(self):
+        natures = [ExpenseNatureFactory.create() for x in range(2)]
+        date = self.legislature.date_start
+        for days, nature in [(0, natures[0]), (40, natures[1]), (100, natures[1])]:
+            ExpenseFactory.create(mandate=self.mandate, nature=nature, date=date + timedelta(days=days))
+        self._consolidated('--agnostic')
+
+        other_mandate = MandateFactory.create(legislature=self.legislature)
+        expense = ExpenseFactory.create(
+            mandate=other_mandate, nature=natures[0], date=date + timedelta(days=70)
+        )
+        self._pending(expense)
+
+        incremental = self._consolidated('--incremental')
+        self.assertEqual(incremental, self._consolidated('--agnostic'))
+        self.assertEqual(PendingConsolidation.objects.count(), 0)
+
+    def test_incremental_with_new_year(self):
+        ExpenseFactory.create(mandate=self.mandate, date=self.legislature.date_start)
+        self._consolidated('--agnostic')
+
+        expense = ExpenseFactory.create(
+            mandate=self.mandate, date=self.legislature.date_start + timedelta(days=400)
+        )
+        self._pending(expense)
+
+        incremental = self._consolidated('--incremental')
+        self.assertEqual(incremental, self._consolidated('--agnostic'))
+
+    @patch.object(Command, 'per_legislator')
+    @patch.object(Command, 'per_nature')
+    def test_incremental_without_changes(self, per_nature_mock, per_legislator_mock):
+        PerNatureFactory.create(institution=self.institutions[self.institutions_siglum])
+        call_command('consolidate', self.institutions_siglum, '--incremental')
+
+        per_nature_mock.assert_not_called()
+        per_legislator_mock.assert_not_called()
+
+    def test_incremental_without_consolidated_data(self):
+        ExpenseFactory.create(mandate=self.mandate, date=self.legislature.date_start)
+
+        incremental = self._consolidated('--incremental')
+        self.assertNotEqual(incremental[0], [])
+        self.assertEqual(incremental, self._consolidated('--agnostic'))
+
+    def test_full_consolidation_clears_changes(self):
+        expense = ExpenseFactory.create(mandate=self.mandate, date=self.legislature.date_start)
+        self._pending(expense)
+
+        call_command('consolidate', self.institutions_siglum)
+
+        self.assertEqual(PendingConsolidation.objects.count(), 0)
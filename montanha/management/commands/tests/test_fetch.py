@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from django.test import TestCase
+
+from montanha.management.commands.collectors.fetch import Fetcher
+
+
+class FetcherTestCase(TestCase):
+
+    def test_fetch(self):
+        fetcher = Fetcher(lambda uri, suffix='': uri + suffix, workers=3)
+
+        requests = [(i, 'http://example.com/{0}'.format(i), dict(suffix='!')) for i in range(10)]
+        results = dict(fetcher.fetch(requests))
+
+        self.assertEqual(results, dict((i, 'http://example.com/{0}!'.format(i)) for i in range(10)))
+
+    def test_fetch_without_requests(self):
+        fetcher = Fetcher(lambda uri: uri)
+        self.assertEqual(list(fetcher.fetch([])), [])
+
+    def test_per_host_limit(self):
+        running = {}
+        highest = {}
+        lock = threading.Lock()
+
+        def retrieve(uri):
+            host = uri.split('/')[2]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                highest[host] = max(highest.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+            return uri
+
+        fetcher = Fetcher(retrieve, workers=8, per_host=2)
+        requests = [(i, 'http://{0}/{1}'.format(host, i), {})
+                    for i in range(8) for host in ['a.com', 'b.com']]
+        list(fetcher.fetch(requests))
+
+        self.assertEqual(highest, {'a.com': 2, 'b.com': 2})
+
+    def test_fetch_error(self):
+        def retrieve(uri):
+            if uri.endswith('3'):
+                raise RuntimeError('Unable to retrieve')
+            return uri
+
+        fetcher = Fetcher(retrieve, workers=2)
+        requests = [(i, 'http://example.com/{0}'.format(i), {}) for i in range(10)]
+
+        with self.assertRaises(RuntimeError):
+            list(fetcher.fetch(requests))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+import requests
+from django.test import TestCase
+
+from montanha.management.commands.collectors.httpcache import HTTPCache
+
+
+class HTTPCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = HTTPCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _response(self, content, headers):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update(headers)
+        response.encoding = 'utf-8'
+        response.raw = BytesIO(content)
+        return response
+
+    def _store(self, method, uri, data, response):
+        self.cache.store(method, uri, data, response)
+        return response.content
+
+    def test_get_missing_entry(self):
+        self.assertEqual(self.cache.get('GET', 'http://olhoneles.org'), None)
+
+    def test_store_and_get(self):
+        headers = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+        self._store('GET', 'http://olhoneles.org', None, self._response('<p>test</p>', headers))
+
+        entry = self.cache.get('GET', 'http://olhoneles.org')
+        self.assertEqual(entry.validators(), {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        })
+
+        response = entry.response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '<p>test</p>')
+        self.assertEqual(response.text, u'<p>test</p>')
+
+    def test_key_with_non_ascii_text(self):
+        key = self.cache.key('POST', u'http://olhoneles.org/\xe9', {u'nome': u'Jos\xe9', 'ano': 2016})
+        self.assertEqual(key, self.cache.key('POST', 'http://olhoneles.org/\xc3\xa9',
+                                             {'nome': 'Jos\xc3\xa9', 'ano': '2016'}))
+
+    def test_key_includes_method_and_body(self):
+        self._store('POST', 'http://olhoneles.org', {'mes': '01', 'ano': 2016},
+                    self._response('january', {}))
+
+        self.assertEqual(self.cache.get('GET', 'http://olhoneles.org'), None)
+        self.assertEqual(self.cache.get('POST', 'http://olhoneles.org', {'mes': '02', 'ano': 2016}), None)
+
+        entry = self.cache.get('POST', 'http://olhoneles.org', {'ano': 2016, 'mes': '01'})
+        self.assertEqual(entry.response().content, 'january')
+
+    def test_store_while_streaming(self):
+        response = self._response('a' * 10, {})
+        self.cache.store('GET', 'http://olhoneles.org', None, response)
+
+        chunks = response.iter_content(chunk_size=4)
+        self.assertEqual(next(chunks), 'aaaa')
+        self.assertEqual(self.cache.get('GET', 'http://olhoneles.org'), None)
+
+        self.assertEqual(list(chunks), ['aaaa', 'aa'])
+        entry = self.cache.get('GET', 'http://olhoneles.org')
+        self.assertEqual(list(entry.response().iter_content(chunk_size=4)), ['aaaa', 'aaaa', 'aa'])
+
+    def test_store_partially_read(self):
+        response = self._response('a' * 10, {})
+        self.cache.store('GET', 'http://olhoneles.org', None, response)
+
+        chunks = response.iter_content(chunk_size=4)
+        next(chunks)
+        chunks.close()
+
+        self.assertEqual(self.cache.get('GET', 'http://olhoneles.org'), None)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_close_cached_response(self):
+        self._store('GET', 'http://olhoneles.org', None, self._response('<p>test</p>', {}))
+
+        read = self.cache.get('GET', 'http://olhoneles.org').response()
+        self.assertEqual(read.content, '<p>test</p>')
+        read.close()
+        self.assertTrue(read.raw.closed)
+
+        unread = self.cache.get('GET', 'http://olhoneles.org').response()
+        unread.close()
+        self.assertTrue(unread.raw.closed)
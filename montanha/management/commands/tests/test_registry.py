@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.test import TestCase
+
+from montanha.management.commands.collectors.almg import ALMG
+from montanha.management.commands.collectors.registry import COLLECTORS, load_collector
+
+
+class RegistryTestCase(TestCase):
+
+    def test_load_collector(self):
+        self.assertIs(load_collector('almg'), ALMG)
+
+    def test_declared_phases(self):
+        for house, collector in COLLECTORS.items():
+            collector_class = load_collector(house)
+            for phase in collector.phases + collector.image_phases:
+                self.assertTrue(callable(getattr(collector_class, phase)), '{0}.{1}'.format(house, phase))
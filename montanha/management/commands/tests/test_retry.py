@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.test import TestCase
+from mock import patch, Mock
+
+from montanha.management.commands.collectors.retry import RetryPolicy
+
+
+class RetryPolicyTestCase(TestCase):
+
+    def test_retryable(self):
+        policy = RetryPolicy()
+
+        self.assertTrue(policy.retryable(Mock(status_code=503)))
+        self.assertTrue(policy.retryable(Mock(status_code=429)))
+        self.assertFalse(policy.retryable(Mock(status_code=404)))
+
+    @patch('random.uniform')
+    def test_exponential_delay(self, mock_uniform):
+        mock_uniform.side_effect = lambda a, b: b
+        policy = RetryPolicy(base_delay=1, max_delay=10)
+
+        self.assertEqual([policy.delay(attempt) for attempt in range(5)], [1, 2, 4, 8, 10])
+
+    def test_delay_with_jitter(self):
+        policy = RetryPolicy(base_delay=1, max_delay=60)
+
+        for x in range(10):
+            delay = policy.delay(3)
+            self.assertTrue(4 <= delay <= 8)
+
+    def test_delay_with_retry_after(self):
+        policy = RetryPolicy()
+
+        response = Mock(status_code=503, headers={'Retry-After': '7'})
+        self.assertEqual(policy.delay(0, response), 7)
+
+        response = Mock(status_code=503, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(policy.delay(0, response), 0)
+
+    def test_delay_with_retry_after_above_max_delay(self):
+        policy = RetryPolicy(max_delay=60)
+
+        response = Mock(status_code=503, headers={'Retry-After': '86400'})
+        self.assertEqual(policy.delay(0, response), 60)
+
+        response = Mock(status_code=503, headers={'Retry-After': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(policy.delay(0, response), 60)
+
+    @patch('time.time')
+    def test_host_budget(self, mock_time):
+        mock_time.return_value = 100
+        policy = RetryPolicy(host_budget=2, host_pause=30)
+
+        policy.failed('a.com', 0)
+        self.assertEqual(policy.paused_until, {})
+
+        policy.failed('a.com', 1)
+        self.assertEqual(policy.paused_until, {'a.com': 130})
+
+    @patch('time.sleep')
+    @patch('time.time')
+    def test_wait_for_paused_host(self, mock_time, mock_sleep):
+        mock_time.side_effect = [100, 130, 130]
+        policy = RetryPolicy()
+        policy.paused_until['a.com'] = 130
+
+        policy.wait('a.com')
+        mock_sleep.assert_called_once_with(30)
+
+        policy.wait('b.com')
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_success_resets_budget(self):
+        policy = RetryPolicy(host_budget=2)
+
+        policy.failed('a.com', 0)
+        policy.succeeded('a.com')
+        policy.failed('a.com', 0)
+
+        self.assertEqual(policy.paused_until, {})
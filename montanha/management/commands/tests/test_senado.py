@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (©) 2016, Marcelo Jorge Vieira <metal@alucinados.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date
+from decimal import Decimal
+
+import requests
+from django.test import TestCase
+from mock import Mock, patch
+
+from montanha.models import ArchivedExpense, Legislator, Mandate
+from montanha.tests.fixtures import (
+    CollectionRunFactory, LegislatorFactory, LegislatureFactory, MandateFactory, PoliticalPartyFactory
+)
+
+from montanha.management.commands.collectors.senado import BadCSV, Senado, iter_lines, read_expenses
+
+
+CSV = (
+    u'ULTIMA ATUALIZACAO;05/01/2016\r\n'
+    u'"ANO";"MES";"SENADOR";"TIPO_DESPESA";"CNPJ_CPF";"FORNECEDOR";"DOCUMENTO";"DATA";'
+    u'"DETALHAMENTO";"VALOR_REEMBOLSADO"\r\n'
+    u'"2015";"3";"JOSÉ";"Passagens";"123";"Companhia Aérea";"007";"04/03/2015";"";"1.234,56"\r\n'
+    u'"2015";"4";"JOSÉ";"Aluguel";"456";"Imobiliária";"";"";"linha\r\nquebrada";"100\r\n,5"\r\n'
+).encode('windows-1252')
+
+
+class ReadExpensesTestCase(TestCase):
+
+    def test_iter_lines(self):
+        chunks = ['a\r', '\nb', 'c\n', 'd']
+        self.assertEqual(list(iter_lines(chunks)), ['a\r\n', 'bc\n', 'd'])
+
+    def test_read_expenses(self):
+        chunks = [CSV[i:i + 7] for i in range(0, len(CSV), 7)]
+        self.assertEqual(list(read_expenses(iter_lines(chunks))), [
+            (u'JOSÉ', u'Passagens', u'123', u'Companhia Aérea', u'007', date(2015, 3, 4), Decimal('1234.56')),
+            (u'JOSÉ', u'Aluguel', u'456', u'Imobiliária', u'', date(2015, 4, 1), Decimal('100.5')),
+        ])
+
+    def test_read_expenses_empty(self):
+        self.assertEqual(list(read_expenses([])), [])
+
+    def test_read_expenses_bad_header(self):
+        lines = ['title\r\n', '"ANO";"MES";"SENADOR"\r\n']
+        with self.assertRaises(BadCSV):
+            list(read_expenses(lines))
+
+
+class UpdateDataForYearTestCase(TestCase):
+
+    def setUp(self):
+        self.collector = Senado([])
+        self.collector.legislature = LegislatureFactory.create(institution=self.collector.institution)
+        self.collector.collection_run = CollectionRunFactory.create()
+
+    @patch.object(Senado, 'retrieve_data_for_year')
+    def test_update_data_for_year(self, retrieve_data_for_year):
+        retrieve_data_for_year.return_value = Mock(iter_content=Mock(return_value=[CSV]))
+
+        collector = self.collector
+        collector.update_data_for_year(2015)
+        collector.flush_expenses()
+
+        expenses = ArchivedExpense.objects.order_by('date')
+        self.assertEqual([(e.nature.name, e.supplier.name, e.number, e.date, e.expensed) for e in expenses], [
+            (u'Passagens', u'Companhia Aérea', u'007', date(2015, 3, 4), Decimal('1234.56')),
+            (u'Aluguel', u'Imobiliária', u'', date(2015, 4, 1), Decimal('100.50')),
+        ])
+
+    @patch.object(Senado, 'retrieve_data_for_year')
+    def test_update_data_for_year_with_broken_download(self, retrieve_data_for_year):
+        def iter_content(chunk_size):
+            yield CSV[:-20]
+            raise requests.exceptions.ChunkedEncodingError()
+        retrieve_data_for_year.return_value = Mock(iter_content=iter_content)
+
+        self.collector.update_data_for_year(2015)
+        self.collector.flush_expenses()
+
+        self.assertEqual(ArchivedExpense.objects.count(), 0)
+
+
+class UpdateLegislatorsTestCase(TestCase):
+
+    def setUp(self):
+        self.collector = Senado([])
+        self.collector.legislature = LegislatureFactory.create(institution=self.collector.institution)
+
+        site = u'http://www25.senado.leg.br/web/senadores/senador/-/perfil/123'
+        legislator = LegislatorFactory.create(name=u'José', email=u'jose@senado.leg.br', site=site)
+        self.mandate = MandateFactory.create(
+            legislator=legislator, legislature=self.collector.legislature, original_id=u'123',
+            party=PoliticalPartyFactory.create(siglum=u'PT'), state=u'SP'
+        )
+        self.data = Mock(
+            nome=u'<a href="{0}">José</a>'.format(site), uf=u'SP', partido=u'PT',
+            correio_eletronico=u'jose@senado.leg.br'
+        )
+
+    def test_unchanged_legislators_are_not_saved(self):
+        with patch.object(Legislator, 'save') as legislator_save, patch.object(Mandate, 'save') as mandate_save:
+            self.collector._update_legislators([self.data])
+
+        self.assertFalse(legislator_save.called)
+        self.assertFalse(mandate_save.called)
+
+    def test_update_state(self):
+        self.data.uf = u'RJ'
+
+        self.collector._update_legislators([self.data])
+
+        self.mandate.refresh_from_db()
+        self.assertEqual(self.mandate.state, u'RJ')
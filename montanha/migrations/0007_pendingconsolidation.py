@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 08:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('montanha', '0006_auto_20180214_1821'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingConsolidation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('institution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.Institution')),
+                ('legislator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.Legislator')),
+                ('nature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.ExpenseNature')),
+            ],
+            options={
+                'verbose_name': 'Pending Consolidation',
+                'verbose_name_plural': 'Pending Consolidations',
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('montanha', '0007_pendingconsolidation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('closed', models.BooleanField(default=False)),
+                ('collection_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.CollectionRun')),
+                ('mandate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.Mandate')),
+            ],
+            options={
+                'verbose_name': 'Collection Checkpoint',
+                'verbose_name_plural': 'Collection Checkpoints',
+            },
+        ),
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='checkpoint',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='montanha.CollectionCheckpoint'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='collectioncheckpoint',
+            unique_together=set([('mandate', 'year', 'month')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('montanha', '0008_collectioncheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unit', models.CharField(max_length=255)),
+                ('position', models.BigIntegerField(default=0)),
+                ('collection_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='montanha.CollectionRun')),
+            ],
+            options={
+                'verbose_name': 'Collection Progress',
+                'verbose_name_plural': 'Collection Progress',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='collectionprogress',
+            unique_together=set([('collection_run', 'unit')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('montanha', '0009_collectionprogress'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedexpense',
+            name='checkpoint',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='montanha.CollectionCheckpoint'),
+        ),
+    ]
@@ -249,6 +249,49 @@ class CollectionRun(models.Model):
         return u"Collection run on %s for %s" % (self.date, unicode(self.legislature))
 
 
+class CollectionProgress(models.Model):
+    """A unit of work done by a collection run, so it can be resumed.
+
+    Units are named by the collectors, such as a mandate's month or a
+    file, with the position reached in it.
+    """
+
+    collection_run = models.ForeignKey("CollectionRun")
+    unit = models.CharField(max_length=255)
+    position = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Collection Progress")
+        verbose_name_plural = _("Collection Progress")
+        unique_together = ('collection_run', 'unit')
+
+    def __unicode__(self):
+        return u'{0} ({1})'.format(self.unit, self.position)
+
+
+class CollectionCheckpoint(models.Model):
+    """A month of a mandate's expenses and the run that last collected it.
+
+    Closed months are not expected to change anymore, so incremental
+    collections copy their archived expenses forward instead of
+    retrieving them again.
+    """
+
+    mandate = models.ForeignKey("Mandate")
+    year = models.IntegerField()
+    month = models.IntegerField()
+    collection_run = models.ForeignKey("CollectionRun")
+    closed = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name = _("Collection Checkpoint")
+        verbose_name_plural = _("Collection Checkpoints")
+        unique_together = ('mandate', 'year', 'month')
+
+    def __unicode__(self):
+        return u'{0} {1}-{2:02d}'.format(self.mandate, self.year, self.month)
+
+
 class AbstractExpense(models.Model):
 
     class Meta:
@@ -309,6 +352,8 @@ class ArchivedExpense(AbstractExpense):
 
     collection_run = models.ForeignKey("CollectionRun")
 
+    checkpoint = models.ForeignKey("CollectionCheckpoint", blank=True, null=True, on_delete=models.SET_NULL)
+
 
 class SupplierActivity(models.Model):
 
@@ -625,3 +670,20 @@ class BiggestSupplierForYear(models.Model):
 
     def __unicode__(self):
         return u'{0} ({1})'.format(self.supplier, self.expensed)
+
+
+class PendingConsolidation(models.Model):
+    """A month of expenses that changed since it was last consolidated."""
+
+    institution = models.ForeignKey("Institution")
+    nature = models.ForeignKey("ExpenseNature")
+    legislator = models.ForeignKey("Legislator")
+    year = models.IntegerField()
+    month = models.IntegerField()
+
+    class Meta:
+        verbose_name = _("Pending Consolidation")
+        verbose_name_plural = _("Pending Consolidations")
+
+    def __unicode__(self):
+        return u'{0} {1}-{2:02d}'.format(self.nature, self.year, self.month)
@@ -24,7 +24,8 @@ import factory
 from montanha.models import (
     Institution, Legislature, ArchivedExpense, CollectionRun, Expense,
     ExpenseNature, Mandate, Supplier, PoliticalParty, Legislator, PerNature,
-    PerNatureByYear, PerNatureByMonth, PerLegislator, BiggestSupplierForYear
+    PerNatureByYear, PerNatureByMonth, PerLegislator, BiggestSupplierForYear,
+    PendingConsolidation, CollectionCheckpoint
 )
 
 
@@ -176,3 +177,25 @@ class ExpenseFactory(factory.django.DjangoModelFactory):
     supplier = factory.SubFactory(SupplierFactory)
     value = factory.LazyAttribute(lambda o: Decimal(randint(5, 100)))
     expensed = factory.LazyAttribute(lambda o: Decimal(randint(5, 100)))
+
+
+class PendingConsolidationFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = PendingConsolidation
+
+    institution = factory.SubFactory(InstitutionFactory)
+    nature = factory.SubFactory(ExpenseNatureFactory)
+    legislator = factory.SubFactory(LegislatorFactory)
+    year = factory.LazyAttribute(lambda o: datetime.now().year)
+    month = factory.LazyAttribute(lambda o: datetime.now().month)
+
+
+class CollectionCheckpointFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = CollectionCheckpoint
+
+    mandate = factory.SubFactory(MandateFactory)
+    collection_run = factory.SubFactory(CollectionRunFactory)
+    year = factory.LazyAttribute(lambda o: datetime.now().year)
+    month = factory.LazyAttribute(lambda o: datetime.now().month)
+    closed = False
@@ -54,6 +54,22 @@ def get_date_ranges_from_data(institution, data, consolidated_data=False, includ
     except Exception:
         cdt = date.today()
 
+    cdf, cdt = bound_dates(cdf, cdt, get_date_bounds(institution))
+
+    cdf_string = cdf.strftime('%B de %Y')
+    cdt_string = cdt.strftime('%B de %Y')
+
+    d = dict(current_date_from=cdf_string, current_date_to=cdt_string)
+    if include_date_objects:
+        d.update(dict(cdf=cdf, cdt=cdt))
+
+    return d
+
+
+def get_date_bounds(institution):
+    """ Returns the start of the first legislature and the end of the last
+        one, which are the dates any range we show is bound to.
+    """
     if institution:
         if not isinstance(institution, Institution):
             institution = Institution.objects.get(siglum=institution)
@@ -66,8 +82,17 @@ def get_date_ranges_from_data(institution, data, consolidated_data=False, includ
         first = Legislature.objects.order_by('date_start')[0]
         last = Legislature.objects.order_by('-date_end')[0]
 
-    min_date = first.date_start
-    max_date = last.date_end
+    return first.date_start, last.date_end
+
+
+def bound_dates(cdf, cdt, date_bounds):
+    """ Bounds a (from, to) pair of dates to the (min, max) pair returned by
+        get_date_bounds(); missing dates default to today.
+    """
+    cdf = cdf or date.today()
+    cdt = cdt or date.today()
+
+    min_date, max_date = date_bounds
 
     if cdf < min_date:
         cdf = min_date
@@ -75,14 +100,7 @@ def get_date_ranges_from_data(institution, data, consolidated_data=False, includ
     if cdt > max_date:
         cdt = max_date
 
-    cdf_string = cdf.strftime('%B de %Y')
-    cdt_string = cdt.strftime('%B de %Y')
-
-    d = dict(current_date_from=cdf_string, current_date_to=cdt_string)
-    if include_date_objects:
-        d.update(dict(cdf=cdf, cdt=cdt))
-
-    return d
+    return cdf, cdt
 
 
 def ensure_years_in_range(date_ranges, years):
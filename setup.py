@@ -69,5 +69,6 @@ legislators
     ],
     extras_require={
         'tests': tests_require,
+        'numpy': ['numpy>=1.11.0,<1.17.0'],
     },
 )